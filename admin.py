@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+"""
+Lab Diary AI 数据管理脚本
+按用户分片列出、校验、恢复备份，比较备份与当前数据库的差异，汇总全实验室活动，导出大归档，执行数据库维护、并发写入压测与文档转换基准测试
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# 与 deploy.py 一样在项目根目录下运行，.env 与 data/ 都按相对路径解析
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import lab_diary_optimized as lab
+
+
+def resolve_shards(value=None):
+    """按分片目录名、登录邮箱或 local 选择分片；不指定时返回全部"""
+    shards = lab.list_shard_paths()
+    if not value:
+        return shards
+    wanted = value.strip().lower()
+    if "@" in wanted:
+        wanted = hashlib.sha256(wanted.encode("utf-8")).hexdigest()[:16]
+    matched = [shard for shard in shards if shard["user_label"] == wanted]
+    if not matched:
+        print(f"❌ 未找到分片: {value}")
+    return matched
+
+
+def resolve_backup(shard, value):
+    """按日期（YYYY-MM-DD）或文件路径定位一份完整快照"""
+    if os.path.isfile(value):
+        return value
+    for item in lab.list_backups(shard["backup_dir"]):
+        if item["day"] == value:
+            return item["path"]
+    return None
+
+
+def parse_time(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"无法解析时间: {value}（格式 YYYY-MM-DD [HH:MM[:SS]]）")
+
+
+def cmd_list(args):
+    """列出每个分片的快照与增量文件"""
+    shards = resolve_shards(args.shard)
+    for shard in shards:
+        backups = lab.list_backups(shard["backup_dir"])
+        changes = lab.list_change_files(shard["backup_dir"])
+        print(f"\n📁 {shard['user_label']}  ({shard['db_path']})")
+        if not backups:
+            print("   ⚠️ 没有完整快照")
+        for item in backups:
+            kind = "压缩" if item["compressed"] else "未压缩"
+            print(f"   {item['day']}  {lab.format_bytes(item['bytes']):>10}  {kind}")
+        if changes:
+            total = sum(os.path.getsize(item["path"]) for item in changes)
+            print(
+                f"   增量 {len(changes)} 个：序号 {changes[0]['from_seq']}–{changes[-1]['to_seq']}，"
+                f"{changes[0]['day']} ~ {changes[-1]['day']}，共 {lab.format_bytes(total)}"
+            )
+    return 0 if shards else 1
+
+
+def cmd_verify(args):
+    """跨分片并行校验所有快照与增量文件"""
+    shards = resolve_shards(args.shard)
+    jobs = []
+    for shard in shards:
+        for item in lab.list_backups(shard["backup_dir"]):
+            jobs.append((shard["user_label"], lab.verify_backup, item["path"]))
+        for item in lab.list_change_files(shard["backup_dir"]):
+            jobs.append((shard["user_label"], lab.verify_change_file, item["path"]))
+    if not jobs:
+        print("⚠️ 没有可校验的备份")
+        return 0
+    print(f"🔍 校验 {len(jobs)} 个备份文件（{args.workers} 个并行）...")
+    started = time.time()
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [(label, pool.submit(func, path)) for label, func, path in jobs]
+        for label, future in futures:
+            result = future.result()
+            name = os.path.basename(result["path"])
+            if result["ok"]:
+                detail = f"{result['tasks']} 条记录" if "tasks" in result else f"{result['changes']} 条变更"
+                print(f"   ✅ {label}/{name}  {detail}")
+            else:
+                failures += 1
+                print(f"   ❌ {label}/{name}  {result['error'] or result.get('integrity')}")
+    print(f"{'✅' if not failures else '❌'} 完成，失败 {failures} 个，用时 {time.time() - started:.1f}s")
+    return 1 if failures else 0
+
+
+def _safety_copy(shard):
+    """覆盖当前库之前先留一份在线快照，恢复错了还能退回；压缩保存，每日轮换只保留最近几份"""
+    if not os.path.exists(shard["db_path"]):
+        return None
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    dest = os.path.join(shard["backup_dir"], f"pre_restore_{stamp}.db")
+    lab.backup_database(shard["db_path"], dest, pause=0)
+    return lab.compress_backup(dest)
+
+
+def cmd_restore(args):
+    """恢复到指定快照或时间点：先写临时文件，校验后改名替换"""
+    shards = resolve_shards(args.shard)
+    if len(shards) != 1:
+        print("❌ 恢复时必须用 --shard 指定唯一的分片")
+        return 1
+    shard = shards[0]
+    dest = args.dest or shard["db_path"]
+    if dest == shard["db_path"] and not args.yes:
+        print("⚠️ 将覆盖当前数据库，请先停止应用，确认后加 --yes 重新执行")
+        return 1
+    if dest == shard["db_path"] and not args.no_safety_copy:
+        safety = _safety_copy(shard)
+        if safety:
+            print(f"💾 当前数据库已另存为 {safety}")
+    started = time.time()
+    try:
+        if args.at:
+            # 当前库里尚未导出的变更先写成增量文件再回放；导出失败时不会恢复
+            result = lab.restore_point_in_time(shard["backup_dir"], dest, args.at, live_db_path=shard["db_path"])
+        else:
+            backup_path = resolve_backup(shard, args.backup)
+            if not backup_path:
+                print(f"❌ 未找到备份: {args.backup}")
+                return 1
+            result = lab.restore_backup(backup_path, dest)
+    except Exception as e:
+        print(f"❌ 恢复失败: {e}")
+        return 1
+    if dest == shard["db_path"]:
+        # 恢复后的库开始一条新的变更时间线，立即留一份快照作为它的回放起点
+        day = datetime.now().strftime("%Y-%m-%d")
+        snapshot = lab.backup_database(dest, os.path.join(shard["backup_dir"], f"lab_data_{day}.db"), pause=0)
+        lab.compress_backup(snapshot["path"])
+    print(f"✅ 已恢复到 {dest}（用时 {time.time() - started:.1f}s）")
+    print(f"   快照: {result['snapshot']}  {result.get('snapshot_taken_at', '')}")
+    if result.get("flushed_changes"):
+        print(f"   先导出了 {result['flushed_changes']} 条未备份的变更")
+    if "applied_changes" in result:
+        print(f"   回放变更 {result['applied_changes']} 条，截至序号 {result['last_seq']}（目标时间 {result['target']}）")
+        print(f"   实际恢复点: {result['recovery_point']}")
+        if result["gap"]:
+            print("   ⚠️ 增量序号存在缺口，部分变更可能丢失")
+    return 0
+
+
+def diff_tasks(live_db, other_db, limit=20):
+    """按 tasks.id 比较两个库：新增、删除与字段有变化的记录"""
+    conn = sqlite3.connect(f"file:{os.path.abspath(live_db)}?mode=ro", uri=True)
+    try:
+        conn.execute("ATTACH DATABASE ? AS snap", (f"file:{os.path.abspath(other_db)}?mode=ro",))
+        added = conn.execute(
+            "SELECT id, date, task_name FROM main.tasks WHERE id NOT IN (SELECT id FROM snap.tasks) ORDER BY id"
+        ).fetchall()
+        removed = conn.execute(
+            "SELECT id, date, task_name FROM snap.tasks WHERE id NOT IN (SELECT id FROM main.tasks) ORDER BY id"
+        ).fetchall()
+        compare_cols = [col for col in lab.TASK_COLUMNS if col != "id"]
+        select_cols = ", ".join(f"m.{col}, s.{col}" for col in compare_cols)
+        where = " OR ".join(f"m.{col} IS NOT s.{col}" for col in compare_cols)
+        changed = []
+        for row in conn.execute(
+            f"SELECT m.id, {select_cols} FROM main.tasks m JOIN snap.tasks s ON s.id = m.id WHERE {where} ORDER BY m.id"
+        ):
+            fields = [col for idx, col in enumerate(compare_cols) if row[1 + idx * 2] != row[2 + idx * 2]]
+            changed.append((row[0], fields))
+    finally:
+        conn.close()
+
+    print(f"➕ 当前库新增 {len(added)} 条")
+    for task_id, date, name in added[:limit]:
+        print(f"   #{task_id} {date} {name}")
+    print(f"➖ 当前库缺少 {len(removed)} 条（仅存在于备份中）")
+    for task_id, date, name in removed[:limit]:
+        print(f"   #{task_id} {date} {name}")
+    print(f"✏️ 字段不同 {len(changed)} 条")
+    for task_id, fields in changed[:limit]:
+        print(f"   #{task_id} {', '.join(fields)}")
+    return {"added": len(added), "removed": len(removed), "changed": len(changed)}
+
+
+def cmd_diff(args):
+    """比较当前库与某个快照（或某个时间点）的记录差异"""
+    shards = resolve_shards(args.shard)
+    if len(shards) != 1:
+        print("❌ 比较时必须用 --shard 指定唯一的分片")
+        return 1
+    shard = shards[0]
+    fd, tmp_path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        if args.at:
+            result = lab.restore_point_in_time(shard["backup_dir"], tmp_path, args.at, live_db_path=shard["db_path"])
+            label = f"时间点 {args.at:%Y-%m-%d %H:%M:%S}（实际恢复点 {result['recovery_point']}）"
+        else:
+            backup_path = resolve_backup(shard, args.backup)
+            if not backup_path:
+                print(f"❌ 未找到备份: {args.backup}")
+                return 1
+            lab.restore_backup(backup_path, tmp_path)
+            label = os.path.basename(backup_path)
+        print(f"🔎 {shard['user_label']}: 当前库 vs {label}")
+        diff_tasks(shard["db_path"], tmp_path, args.limit)
+    except Exception as e:
+        print(f"❌ 比较失败: {e}")
+        return 1
+    finally:
+        os.remove(tmp_path)
+    return 0
+
+
+def cmd_maintain(args):
+    """对各分片执行数据库维护（checkpoint / optimize / vacuum），并打印做了什么"""
+    shards = resolve_shards(args.shard)
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [(shard, pool.submit(lab.run_sqlite_maintenance, shard["db_path"], args.force)) for shard in shards]
+        for shard, future in futures:
+            try:
+                report = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"   ❌ {shard['user_label']}  {e}")
+                continue
+            print(
+                f"   ✅ {shard['user_label']}  {'、'.join(report['actions'])}  "
+                f"库 {lab.format_bytes(report['db_bytes_before'])} → {lab.format_bytes(report['db_bytes_after'])}，"
+                f"WAL {lab.format_bytes(report['wal_bytes_before'])} → {lab.format_bytes(report['wal_bytes_after'])}，"
+                f"用时 {report['seconds']}s"
+            )
+    return 1 if failures else 0
+
+
+def _simulate_session(db_path, session_id, writes, mode, busy_timeout, barrier, latencies, errors):
+    """模拟一个页面会话：每次保存一条记录、勾选一次完成，随后像 rerun 一样读一次列表"""
+    insert_sql = "INSERT INTO tasks (date, task_name, category, is_done, details, tags) VALUES (?, ?, ?, 0, ?, ?)"
+    barrier.wait()
+    for i in range(writes):
+        started = time.perf_counter()
+        try:
+            if mode == "queue":
+                task_id = lab.submit_write(
+                    lambda conn: conn.execute(insert_sql, ("2024-01-01", f"s{session_id}-{i}", "压测", "x" * 200, "load")).lastrowid,
+                    db_path,
+                )
+                lab.submit_write(lambda conn: conn.execute("UPDATE tasks SET is_done=1 WHERE id=?", (task_id,)), db_path)
+            else:
+                # 旧写法：每次写都自开连接、自提交，靠 busy_timeout 等锁
+                for stmt in ("insert", "update"):
+                    conn = lab.get_db_connection(db_path)
+                    try:
+                        conn.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+                        if stmt == "insert":
+                            task_id = conn.execute(insert_sql, ("2024-01-01", f"s{session_id}-{i}", "压测", "x" * 200, "load")).lastrowid
+                        else:
+                            conn.execute("UPDATE tasks SET is_done=1 WHERE id=?", (task_id,))
+                        conn.commit()
+                    finally:
+                        conn.close()
+            latencies.append(time.perf_counter() - started)
+        except sqlite3.OperationalError as e:
+            errors.append(str(e))
+        conn = lab.get_db_connection(db_path)
+        try:
+            conn.execute("SELECT id, task_name FROM tasks ORDER BY id DESC LIMIT 50").fetchall()
+        finally:
+            conn.close()
+
+
+def cmd_loadtest(args):
+    """在临时库上模拟多个会话同时写入，对比写线程队列与各自提交两种方式"""
+    modes = ["queue", "direct"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        with tempfile.TemporaryDirectory(prefix="lab_loadtest_") as tmp:
+            db_path = os.path.join(tmp, "my_lab_data.db")
+            lab.init_and_migrate_db(db_path)
+            key = os.path.realpath(db_path)
+            lab._WRITE_STATS.pop(key, None)
+            barrier = threading.Barrier(args.sessions)
+            latencies, errors = [], []
+            threads = [
+                threading.Thread(
+                    target=_simulate_session,
+                    args=(db_path, n, args.writes, mode, args.busy_timeout, barrier, latencies, errors),
+                )
+                for n in range(args.sessions)
+            ]
+            started = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - started
+            conn = sqlite3.connect(db_path)
+            rows = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            conn.close()
+            latencies.sort()
+            pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0
+            print(f"📊 {mode}: {args.sessions} 个会话 × {args.writes} 次保存，用时 {elapsed:.2f}s，写入 {rows} 条")
+            print(f"   吞吐 {len(latencies) / elapsed:.0f} 次/秒，延迟 p50 {pick(0.5):.1f}ms / p95 {pick(0.95):.1f}ms / max {pick(1.0):.1f}ms")
+            if mode == "queue":
+                commits, jobs = lab._WRITE_STATS.get(key, [0, 0])
+                print(f"   合并提交 {commits} 次，平均每次 {jobs / max(commits, 1):.1f} 个写操作")
+            if errors:
+                print(f"   ❌ 失败 {len(errors)} 次，例如: {errors[0]}")
+    return 0
+
+
+def _build_bench_docx(path, pages, paragraphs, images, distinct, image_kb):
+    """生成图片密集的测试文档：每页一个标题和若干段落，图片引用均匀分布，重复引用 distinct 张不同的图"""
+    from io import BytesIO
+
+    from docx import Document
+    from docx.shared import Inches
+    from PIL import Image
+
+    edge = max(16, int((image_kb * 1024 / 3) ** 0.5))
+    blobs = []
+    for _ in range(distinct):
+        out = BytesIO()
+        # 随机噪声几乎无法压缩，PNG 大小接近 image_kb
+        Image.frombytes("RGB", (edge, edge), os.urandom(edge * edge * 3)).save(out, format="PNG")
+        blobs.append(out.getvalue())
+    doc = Document()
+    per_page = max(1, paragraphs // max(pages, 1))
+    placed = 0
+    for page in range(pages):
+        doc.add_heading(f"第 {page + 1} 页", level=2)
+        for n in range(per_page):
+            doc.add_paragraph(f"实验步骤 {page + 1}.{n + 1}：加入缓冲液 0.5 mL，37℃ 孵育 30 min，记录 OD600。")
+        while placed < images and placed * pages < (page + 1) * images:
+            doc.add_picture(BytesIO(blobs[placed % distinct]), width=Inches(2))
+            placed += 1
+        if page < pages - 1:
+            doc.add_page_break()
+    doc.save(path)
+
+
+def cmd_benchdocx(args):
+    """在临时分片上测量 DOCX 转 Markdown 的耗时（图片密集的长文档）"""
+    with tempfile.TemporaryDirectory(prefix="lab_benchdocx_") as tmp:
+        paths = {
+            "user_label": "bench",
+            "root": tmp,
+            "upload_dir": os.path.join(tmp, "uploads"),
+            "backup_dir": os.path.join(tmp, "backups"),
+            "db_path": os.path.join(tmp, "my_lab_data.db"),
+        }
+        for key in ("upload_dir", "backup_dir"):
+            os.makedirs(paths[key], exist_ok=True)
+        lab._STORAGE_PATHS_OVERRIDE = paths
+        try:
+            lab.init_and_migrate_db(paths["db_path"])
+            source = os.path.join(tmp, "bench.docx")
+            started = time.perf_counter()
+            _build_bench_docx(source, args.pages, args.paragraphs, args.images, args.distinct, args.image_kb)
+            print(
+                f"📄 {args.pages} 页 / {args.paragraphs} 段 / {args.images} 处图片引用（{args.distinct} 张不同的图，"
+                f"每张约 {args.image_kb} KB），文档 {lab.format_bytes(os.path.getsize(source))}，生成用时 {time.perf_counter() - started:.2f}s"
+            )
+            for with_images in (False, True):
+                timings = []
+                for _ in range(args.repeat):
+                    with open(source, "rb") as fh:
+                        started = time.perf_counter()
+                        markdown = lab.docx_to_markdown_with_assets(fh, "bench.docx", with_images=with_images)
+                        timings.append(time.perf_counter() - started)
+                timings.sort()
+                label = "含图片" if with_images else "仅文字"
+                print(
+                    f"📊 {label}: 最快 {timings[0]:.2f}s / 中位 {timings[len(timings) // 2]:.2f}s（{args.repeat} 次），"
+                    f"Markdown {lab.format_bytes(len(markdown.encode('utf-8')))}"
+                )
+        finally:
+            lab._STORAGE_PATHS_OVERRIDE = None
+    return 0
+
+
+REPORT_CACHE_PATH = os.path.join(lab.DATA_DIR, "admin_report_cache.json")
+
+
+def _load_report_cache():
+    try:
+        with open(REPORT_CACHE_PATH, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_report_cache(cache):
+    os.makedirs(os.path.dirname(REPORT_CACHE_PATH), exist_ok=True)
+    tmp_path = REPORT_CACHE_PATH + ".partial"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(cache, fh, ensure_ascii=False)
+    os.replace(tmp_path, REPORT_CACHE_PATH)
+
+
+def cmd_report(args):
+    """全实验室汇总：每周新增记录、各用户存储与最近活跃时间"""
+    shards = resolve_shards(args.shard)
+    cache = {} if args.no_cache else _load_report_cache()
+    started = time.time()
+    report = lab.collect_lab_report(shards, workers=args.workers, cache=cache, weeks=args.weeks)
+    if not args.no_cache:
+        # 只保留仍存在的分片，已删除用户的缓存随之清掉
+        _save_report_cache({shard["db_path"]: cache[shard["db_path"]] for shard in shards if shard["db_path"] in cache})
+    print(f"📊 {len(shards)} 个分片，重新扫描 {report['scanned']} 个，复用缓存 {report['cached']} 个，用时 {time.time() - started:.2f}s")
+    print()
+    print(f"{'用户分片':<20} {'记录':>7} {'已完成':>7} {'数据库':>10} {'附件':>10} {'备份':>10}  最近活跃")
+    for item in report["shards"]:
+        storage = item["storage"]
+        print(
+            f"{item['user_label']:<20} {item['tasks']:>7} {item['done']:>7} "
+            f"{lab.format_bytes(storage['db_bytes']):>10} {lab.format_bytes(storage['upload_bytes']):>10} "
+            f"{lab.format_bytes(storage['backup_bytes']):>10}  {item['last_active'] or '-'}"
+        )
+    totals = report["totals"]
+    print(
+        f"{'合计':<20} {totals['tasks']:>7} {totals['done']:>7} {lab.format_bytes(totals['db_bytes']):>10} "
+        f"{lab.format_bytes(totals['upload_bytes']):>10} {lab.format_bytes(totals['backup_bytes']):>10}"
+    )
+    print()
+    print("每周新增记录:")
+    peak = max(report["per_week"].values(), default=0) or 1
+    for week, count in report["per_week"].items():
+        print(f"   {week}  {'█' * round(count * 40 / peak):<40} {count}")
+    for item in report["errors"]:
+        print(f"   ❌ {item['user_label']}  {item['error']}")
+    return 1 if report["errors"] else 0
+
+
+def cmd_export(args):
+    """把一个分片的全部记录导出为文件；直接写磁盘，内存占用与归档大小无关"""
+    shards = resolve_shards(args.shard)
+    if len(shards) != 1:
+        return 1
+    shard = shards[0]
+    ext, _, writer = lab.ARCHIVE_EXPORT_FORMATS[args.format]
+    dest = args.out or f"lab_archive_{shard['user_label']}_{datetime.now().strftime('%Y%m%d')}{ext}"
+    tmp_path = f"{dest}.partial"
+    lab._STORAGE_PATHS_OVERRIDE = dict(shard)
+    started = time.time()
+    query = "SELECT * FROM tasks ORDER BY date DESC"
+    total = lab.run_query("SELECT COUNT(*) AS n FROM tasks", fetch=True)["n"][0]
+
+    def _progress(done, count):
+        print(f"\r   已导出 {done}/{count} 条", end="", flush=True)
+
+    try:
+        with open(tmp_path, "wb") as out:
+            writer(lab.iter_query_chunks(query, (), lab.EXPORT_CHUNK_SIZE), out, _progress, total)
+        os.replace(tmp_path, dest)
+    except Exception as e:
+        print(f"\n❌ 导出失败: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return 1
+    print(f"\n✅ {dest}（{total} 条，{lab.format_bytes(os.path.getsize(dest))}，{time.time() - started:.1f}s）")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Lab Diary AI 数据管理工具")
+    sub = parser.add_subparsers(dest="command")
+
+    p_list = sub.add_parser("list", help="列出各分片的备份")
+    p_list.add_argument("--shard", help="分片目录名、登录邮箱或 local")
+    p_list.set_defaults(func=cmd_list)
+
+    p_verify = sub.add_parser("verify", help="并行校验备份")
+    p_verify.add_argument("--shard", help="只校验指定分片")
+    p_verify.add_argument("--workers", type=int, default=min(8, os.cpu_count() or 1), help="并行数")
+    p_verify.set_defaults(func=cmd_verify)
+
+    p_restore = sub.add_parser("restore", help="从快照或时间点恢复")
+    p_restore.add_argument("--shard", required=True, help="分片目录名、登录邮箱或 local")
+    target = p_restore.add_mutually_exclusive_group(required=True)
+    target.add_argument("--backup", help="快照日期 YYYY-MM-DD 或文件路径")
+    target.add_argument("--at", type=parse_time, help="恢复到该时间点：快照 + 增量回放")
+    p_restore.add_argument("--dest", help="写到其他路径而不是覆盖当前库")
+    p_restore.add_argument("--yes", action="store_true", help="确认覆盖当前数据库")
+    p_restore.add_argument("--no-safety-copy", action="store_true", help="覆盖前不另存当前库")
+    p_restore.set_defaults(func=cmd_restore)
+
+    p_diff = sub.add_parser("diff", help="按记录 ID 比较当前库与备份")
+    p_diff.add_argument("--shard", required=True, help="分片目录名、登录邮箱或 local")
+    target = p_diff.add_mutually_exclusive_group(required=True)
+    target.add_argument("--backup", help="快照日期 YYYY-MM-DD 或文件路径")
+    target.add_argument("--at", type=parse_time, help="与该时间点的状态比较")
+    p_diff.add_argument("--limit", type=int, default=20, help="每类最多列出的记录数")
+    p_diff.set_defaults(func=cmd_diff)
+
+    p_maintain = sub.add_parser("maintain", help="数据库维护：checkpoint、optimize、按阈值 vacuum")
+    p_maintain.add_argument("--shard", help="只维护指定分片")
+    p_maintain.add_argument("--force", action="store_true", help="忽略阈值，全部执行")
+    p_maintain.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="并行数")
+    p_maintain.set_defaults(func=cmd_maintain)
+
+    p_report = sub.add_parser("report", help="跨分片汇总活动与存储占用")
+    p_report.add_argument("--shard", help="只汇总指定分片")
+    p_report.add_argument("--weeks", type=int, default=12, help="每周统计覆盖的周数")
+    p_report.add_argument("--workers", type=int, default=min(8, (os.cpu_count() or 1) * 2), help="并行数")
+    p_report.add_argument("--no-cache", action="store_true", help="忽略缓存，全部重新扫描")
+    p_report.set_defaults(func=cmd_report)
+
+    p_export = sub.add_parser("export", help="把一个分片的记录导出为 MD / DOCX / ZIP 文件")
+    p_export.add_argument("--shard", required=True, help="分片目录名、登录邮箱或 local")
+    p_export.add_argument("--format", choices=list(lab.ARCHIVE_EXPORT_FORMATS), default="ZIP", help="导出格式")
+    p_export.add_argument("--out", help="输出文件路径（默认写到当前目录）")
+    p_export.set_defaults(func=cmd_export)
+
+    p_load = sub.add_parser("loadtest", help="在临时库上模拟多会话并发写入")
+    p_load.add_argument("--sessions", type=int, default=20, help="并发会话数")
+    p_load.add_argument("--writes", type=int, default=50, help="每个会话保存的次数")
+    p_load.add_argument("--mode", choices=["queue", "direct", "both"], default="both", help="写入方式")
+    p_load.add_argument("--busy-timeout", type=float, default=5.0, help="direct 模式等锁的秒数")
+    p_load.set_defaults(func=cmd_loadtest)
+
+    p_bench = sub.add_parser("benchdocx", help="测量图片密集长文档的 DOCX 转 Markdown 耗时")
+    p_bench.add_argument("--pages", type=int, default=100, help="页数")
+    p_bench.add_argument("--paragraphs", type=int, default=1000, help="正文段落总数")
+    p_bench.add_argument("--images", type=int, default=100, help="图片引用次数")
+    p_bench.add_argument("--distinct", type=int, default=20, help="不同图片的数量")
+    p_bench.add_argument("--image-kb", type=int, default=360, help="每张图片的大小（KB）")
+    p_bench.add_argument("--repeat", type=int, default=3, help="每种模式重复次数")
+    p_bench.set_defaults(func=cmd_benchdocx)
+    return parser
+
+
+def main():
+    """主函数"""
+    print("🔬 Lab Diary AI 数据管理工具")
+    print("=" * 50)
+    parser = build_parser()
+    args = parser.parse_args()
+    if not getattr(args, "func", None):
+        parser.print_help()
+        return 0
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,20 +13,35 @@ import wave
 import struct
 import gzip
 import hashlib
+import errno
+import functools
 import secrets as py_secrets
 import hmac
 import smtplib
 import ssl
 import zipfile
 import base64
+import urllib.parse
+import codecs
 import tempfile
+import threading
+import subprocess
+import queue
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import OrderedDict, deque
 from io import BytesIO
 from email.message import EmailMessage
 from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.oxml.ns import qn
 from docx.oxml.table import CT_Tbl
 from docx.oxml.text.paragraph import CT_P
 from docx.table import Table, _Cell
 from docx.text.paragraph import Paragraph
+from lxml import etree
 from openai import OpenAI
 
 try:
@@ -80,8 +95,22 @@ except Exception:
     win32com = None
     pythoncom = None
 
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except Exception:
+    Image = None
+    ImageOps = None
+    pil_features = None
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
 HAS_PYPANDOC = pypandoc is not None
 HAS_WIN32_COM = win32com is not None
+HAS_PIL = Image is not None
+HAS_ZSTD = zstandard is not None
 
 # --- 配置区 ---
 LEGACY_UPLOAD_DIR = "uploads"
@@ -339,12 +368,18 @@ def require_app_login() -> None:
     st.stop()
 
 
+_STORAGE_PATHS_OVERRIDE: dict | None = None
+
+
 def get_storage_paths() -> dict:
     """
     Multi-user isolation:
     - If Streamlit provides a signed-in user email, store data in `data/users/<hash>/`.
     - Otherwise (local/dev), fall back to legacy paths in the repo root.
+    - Worker processes (no Streamlit session) use the paths pinned by their pool initializer.
     """
+    if _STORAGE_PATHS_OVERRIDE is not None:
+        return dict(_STORAGE_PATHS_OVERRIDE)
     session_email = str(st.session_state.get("auth_email", "")).strip().lower()
     override_email = _get_setting("LAB_DIARY_USER_EMAIL", "").strip().lower()
     email = session_email or override_email or _get_streamlit_user_email()
@@ -371,6 +406,32 @@ def get_storage_paths() -> dict:
         "db_path": db_path,
     }
 
+def list_shard_paths() -> list[dict]:
+    """枚举磁盘上已有的全部分片（不依赖会话），供后台任务与管理脚本使用"""
+    shards = []
+    if os.path.exists(LEGACY_DB_PATH):
+        shards.append({
+            "user_label": "local",
+            "root": ".",
+            "upload_dir": LEGACY_UPLOAD_DIR,
+            "backup_dir": LEGACY_BACKUP_DIR,
+            "db_path": LEGACY_DB_PATH,
+        })
+    users_dir = os.path.join(DATA_DIR, "users")
+    if os.path.isdir(users_dir):
+        for name in sorted(os.listdir(users_dir)):
+            root = os.path.join(users_dir, name)
+            db_path = os.path.join(root, "my_lab_data.db")
+            if os.path.isfile(db_path):
+                shards.append({
+                    "user_label": name,
+                    "root": root,
+                    "upload_dir": os.path.join(root, "uploads"),
+                    "backup_dir": os.path.join(root, "backups"),
+                    "db_path": db_path,
+                })
+    return shards
+
 # --- 语音识别（暂时下线）---
 # 你之前配置的火山引擎语音识别相关代码已单独存档，方便之后恢复：
 # 见 `archived/volc_asr_reference.py`
@@ -379,6 +440,8 @@ def get_storage_paths() -> dict:
 DEEPSEEK_API_KEY = _get_setting("DEEPSEEK_API_KEY", "")
 DEEPSEEK_BASE_URL = _get_setting("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 DEEPSEEK_MODEL = _get_setting("DEEPSEEK_MODEL", "deepseek-chat")
+# 日程解析时参考文件可占用的 token 预算
+AI_ATTACHMENT_TOKEN_BUDGET = int(str(_get_setting("LAB_DIARY_AI_ATTACHMENT_TOKENS", "6000")).strip() or "6000")
 
 # --- 设计风格配置 ---
 # 色彩系统
@@ -407,17 +470,126 @@ for d in [LEGACY_UPLOAD_DIR, LEGACY_BACKUP_DIR]:
     os.makedirs(d, exist_ok=True)
 
 # ==================== 工具函数 ====================
-def get_versioned_upload_path(filename):
-    """Return upload path plus versioned filename to avoid overwriting."""
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def get_versioned_upload_path(filename, digest):
+    """按内容哈希生成版本化文件名（同名不同内容自然区分，无需逐个探测）"""
     upload_dir = get_storage_paths()["upload_dir"]
-    base, ext = os.path.splitext(filename)
-    candidate = filename
-    idx = 1
-    while os.path.exists(os.path.join(upload_dir, candidate)):
-        candidate = f"{base}_v{idx}{ext}"
-        idx += 1
+    base, ext = os.path.splitext(os.path.basename(filename))
+    candidate = f"{sanitize_filename(base, 'upload')}_{digest[:10]}{ext.lower()}"
     return os.path.join(upload_dir, candidate), candidate
 
+
+def _lookup_upload_by_digest(digest: str) -> str | None:
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT stored_name FROM upload_assets WHERE sha256=?", (digest,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def _register_upload(digest: str, stored_name: str, original_name: str, size: int) -> None:
+    submit_write(lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO upload_assets (sha256, stored_name, original_name, size) VALUES (?, ?, ?, ?)",
+        (digest, stored_name, original_name, size)
+    ))
+
+
+def _hash_stream(src) -> tuple[str, int]:
+    hasher = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = src.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+def _is_cheaply_rewindable(src) -> bool:
+    """内存缓冲或磁盘文件可以廉价地重读；压缩流等来源只读一遍"""
+    if isinstance(src, (BytesIO, tempfile.SpooledTemporaryFile)) or hasattr(src, "getbuffer"):
+        return True
+    try:
+        src.fileno()
+        return src.seekable()
+    except Exception:
+        return False
+
+
+def store_upload_stream(src, filename: str) -> tuple[str, str, bool]:
+    """
+    内容寻址保存上传文件，返回 (保存路径, 存储文件名, 是否新写入)。
+    - 可廉价重读的来源先计算哈希，已存在相同内容时完全跳过写盘；
+    - 其他来源（如 zip 条目）边写临时文件边计算哈希，重复内容写完即丢弃。
+    """
+    upload_dir = get_storage_paths()["upload_dir"]
+    seekable = _is_cheaply_rewindable(src)
+    tmp_path = None
+    if seekable:
+        src.seek(0)
+        digest, size = _hash_stream(src)
+        existing = _lookup_upload_by_digest(digest)
+        if not (existing and os.path.exists(os.path.join(upload_dir, existing))):
+            enforce_quota(size)
+    else:
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix=".incoming_")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = src.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        digest = hasher.hexdigest()
+
+    existing = _lookup_upload_by_digest(digest)
+    if existing and os.path.exists(os.path.join(upload_dir, existing)):
+        if tmp_path:
+            os.remove(tmp_path)
+        return os.path.join(upload_dir, existing), existing, False
+    if tmp_path:
+        try:
+            enforce_quota(size)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+    save_path, stored_name = get_versioned_upload_path(filename, digest)
+    written = False
+    if os.path.exists(save_path):
+        if tmp_path:
+            os.remove(tmp_path)
+    elif tmp_path:
+        os.replace(tmp_path, save_path)
+        written = True
+    else:
+        src.seek(0)
+        fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix=".incoming_")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+            os.replace(tmp_path, save_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        written = True
+    if written:
+        record_usage("upload_bytes", size)
+    _register_upload(digest, stored_name, os.path.basename(filename), size)
+    return save_path, stored_name, written
+
 def normalize_task_row(row):
     if isinstance(row, dict):
         return row
@@ -532,6 +704,74 @@ def ai_parse_schedule(client, text, attachment_notes=None):
         print(f"AI Parse Error: {e}")
         return []
 
+ATTACHMENT_TEXT_EXTS = {".txt", ".md", ".markdown", ".csv", ".tsv", ".json", ".log"}
+ATTACHMENT_DOC_EXTS = {".docx", ".doc", ".rtf"}
+ATTACHMENT_MAX_CHARS = 40000
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token：中日韩字符约 1 个/字，其余约 4 个字符 1 个"""
+    wide = sum(1 for ch in text if ord(ch) > 0x2E7F)
+    return wide + (len(text) - wide + 3) // 4
+
+def _truncate_to_tokens(text: str, budget: int) -> str:
+    if estimate_tokens(text) <= budget:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip() + "…"
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def extract_attachment_text(digest: str, name: str, _data: bytes) -> str:
+    """按文件哈希缓存的参考文件文本提取；文档只取文字，不落盘图片"""
+    ext = os.path.splitext(name)[1].lower()
+    try:
+        if ext in ATTACHMENT_DOC_EXTS:
+            text = convert_document_bytes_to_markdown(_data, name, ext, with_images=False)
+        elif ext in ATTACHMENT_TEXT_EXTS:
+            text = _decode_text_preview(_data, ATTACHMENT_MAX_CHARS)
+        else:
+            return ""
+    except Exception as e:
+        print(f"Attachment extract error ({name}): {e}")
+        return ""
+    text = re.sub(r"\n{3,}", "\n\n", text or "").strip()
+    return text[:ATTACHMENT_MAX_CHARS]
+
+def build_attachment_notes(files, token_budget: int | None = None) -> str:
+    """
+    把侧栏上传的参考文件整理为 attachment_notes。
+    预算在文件间平分，短文件用不完的额度留给后面的长文件。
+    """
+    budget = AI_ATTACHMENT_TOKEN_BUDGET if token_budget is None else token_budget
+    extracted = []
+    skipped = []
+    for f in files or []:
+        data = f.getvalue()
+        text = extract_attachment_text(hashlib.sha256(data).hexdigest(), f.name, data)
+        if text:
+            extracted.append((f.name, text))
+        else:
+            skipped.append(f.name)
+    extracted.sort(key=lambda item: estimate_tokens(item[1]))
+    notes = []
+    for idx, (name, text) in enumerate(extracted):
+        header = f"### {name}"
+        share = (budget - estimate_tokens(header)) // (len(extracted) - idx)
+        if share <= 0:
+            skipped.append(name)
+            continue
+        body = _truncate_to_tokens(text, share)
+        budget -= estimate_tokens(header) + estimate_tokens(body)
+        notes.append(f"{header}\n{body}")
+    if skipped:
+        notes.append(f"（未能提取文字的文件：{'、'.join(skipped)}）")
+    return "\n\n".join(notes)
+
 def ai_generate_weekly_report(client, records, start_date, end_date):
     """基于近 7 天的记录自动生成周报内容"""
     if not records:
@@ -569,7 +809,7 @@ FONT_CANDIDATES = [
 ]
 TEXT_LIKE_EXTS = {".txt", ".md", ".markdown", ".csv", ".tsv", ".json", ".yaml", ".yml", ".log"}
 LEGACY_TEXT_EXTS = {".md", ".markdown", ".txt", ".docx", ".doc", ".rtf"}
-LEGACY_IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff", ".svg"}
+LEGACY_IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff", ".svg", ".webp"}
 IMAGE_MIME_MAP = {
     ".png": "image/png",
     ".jpg": "image/jpeg",
@@ -579,169 +819,1187 @@ IMAGE_MIME_MAP = {
     ".tif": "image/tiff",
     ".tiff": "image/tiff",
     ".svg": "image/svg+xml",
+    ".webp": "image/webp",
 }
 
-def _decode_text_preview(data: bytes, max_chars: int = 1500) -> str:
-    """尝试多种编码获取文本片段"""
-    for enc in ("utf-8", "gbk", "latin-1"):
+TEXT_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+ENCODING_SNIFF_BYTES = 64 * 1024
+
+
+# GBK 文本里常见的非 ASCII 字符：中日韩文字与全角标点，以及实验记录常用的符号
+# （° ± × ·、希腊字母 μ、℃ 等字母式符号、罗马数字、箭头、数学运算符、①、制表符与几何图形）
+GBK_TEXT_RANGES = (
+    (0x4E00, 0x9FFF), (0x3400, 0x4DBF), (0x3000, 0x303F), (0xFF00, 0xFFEF),
+    (0x00A0, 0x00FF), (0x0370, 0x03FF), (0x0400, 0x04FF), (0x2000, 0x206F),
+    (0x2100, 0x22FF), (0x2460, 0x24FF), (0x2500, 0x25FF),
+)
+
+
+def _looks_like_cjk_text(text: str) -> bool:
+    """非 ASCII 字符里没有控制符/私用区，且以中日韩文字、全角标点和常用符号为主"""
+    non_ascii = [ch for ch in text if ord(ch) > 127]
+    if not non_ascii:
+        return True
+    known = 0
+    for ch in non_ascii:
+        code = ord(ch)
+        if 0x80 <= code <= 0x9F or 0xE000 <= code <= 0xF8FF or ch == "\ufffd":
+            return False
+        if any(low <= code <= high for low, high in GBK_TEXT_RANGES):
+            known += 1
+    return known / len(non_ascii) >= 0.6
+
+
+def detect_text_encoding(sample: bytes, complete: bool = False) -> str | None:
+    """
+    根据前缀判断编码：先看 BOM，再看无 BOM 的 UTF-16 零字节规律，
+    然后依次严格试解 UTF-8、GB18030（兼容 GBK）并检查解出的文字是否合理，最后退回 latin-1。
+    complete=False 表示样本是截断的前缀，末尾不完整的多字节字符不算错误。
+    纯 ASCII 前缀无法区分，返回 None 由调用方继续往后看。
+    """
+    for bom, encoding in TEXT_BOMS:
+        if sample.startswith(bom):
+            return encoding
+    if not sample:
+        return None
+    head = sample[:4096]
+    if len(head) >= 4 and head.count(0) >= max(2, len(head) // 64):
+        even_zeros = head[0::2].count(0)
+        odd_zeros = head[1::2].count(0)
+        if odd_zeros > even_zeros * 4:
+            return "utf-16-le"
+        if even_zeros > odd_zeros * 4:
+            return "utf-16-be"
+    if sample.isascii():
+        return None
+    for encoding in ("utf-8", "gb18030"):
+        decoder = codecs.getincrementaldecoder(encoding)(errors="strict")
         try:
-            text = data.decode(enc)
-            break
+            text = decoder.decode(sample, final=complete)
         except UnicodeDecodeError:
             continue
-    else:
-        text = data.decode("utf-8", errors="ignore")
+        if encoding == "utf-8" or _looks_like_cjk_text(text):
+            return encoding
+    return "latin-1"
+
+
+def decode_text_stream(source, encoding: str | None = None) -> str:
+    """
+    分块增量解码整份文本（bytes 或二进制流），时间与文件大小成线性。
+    开头连续的纯 ASCII 块在各候选编码下结果相同，直接按 ASCII 解出，
+    遇到第一个含非 ASCII 字节的块再判定编码。
+    """
+    stream = _as_binary_stream(source)
+    parts = []
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace") if encoding else None
+    first = True
+    while True:
+        size = ENCODING_SNIFF_BYTES if decoder is None else UPLOAD_CHUNK_SIZE
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        if decoder is None:
+            detected = None
+            if first or not chunk.isascii():
+                detected = detect_text_encoding(chunk, complete=len(chunk) < size)
+            if detected is None:
+                parts.append(chunk.decode("ascii"))
+                first = False
+                continue
+            decoder = codecs.getincrementaldecoder(detected)(errors="replace")
+        first = False
+        parts.append(decoder.decode(chunk))
+    if decoder is not None:
+        parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
+
+def _decode_text_preview(data: bytes, max_chars: int = 1500) -> str:
+    """按检测出的编码只解码开头一段，获取文本片段"""
+    sample = data[:ENCODING_SNIFF_BYTES]
+    encoding = detect_text_encoding(sample, complete=len(data) <= ENCODING_SNIFF_BYTES) or "utf-8"
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    text = decoder.decode(data[: max_chars * 4 + 4], final=False)
     text = text.strip()
     return (text[:max_chars] + "…") if len(text) > max_chars else text
 
-def _decode_text_full(data: bytes, strip: bool = True) -> str:
-    """尝试多种编码解码为完整字符串"""
-    for enc in ("utf-8", "utf-16", "gbk", "latin-1"):
-        try:
-            text = data.decode(enc)
-            break
-        except UnicodeDecodeError:
-            continue
-    else:
-        text = data.decode("utf-8", errors="ignore")
+def _decode_text_full(data, strip: bool = True) -> str:
+    """检测编码并解码为完整字符串（data 可为 bytes 或二进制流）"""
+    text = decode_text_stream(data)
     return text.strip() if strip else text
 
-def _persist_image_as_markdown(data: bytes, original_name: str) -> str:
-    """保存图片到 uploads，并返回内联 Markdown"""
+INLINE_IMAGE_MAX_BYTES = int(str(_get_setting("LAB_DIARY_INLINE_IMAGE_MAX_BYTES", str(512 * 1024))).strip() or "0")
+
+
+def _as_binary_stream(source):
+    """bytes 或文件对象统一为从头读取的二进制流"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return BytesIO(source)
+    if hasattr(source, "seek"):
+        try:
+            source.seek(0)
+        except Exception:
+            pass
+    return source
+
+
+def _spool_stream(source, max_memory: int = 8 * 1024 * 1024):
+    """把只能顺序读取的来源分块转存到 SpooledTemporaryFile，超过阈值自动落盘"""
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    shutil.copyfileobj(source, spool, UPLOAD_CHUNK_SIZE)
+    spool.seek(0)
+    return spool
+
+
+def _copy_stream_to_tempfile(source, suffix: str) -> str:
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, "wb") as out:
+        shutil.copyfileobj(_as_binary_stream(source), out, UPLOAD_CHUNK_SIZE)
+    return path
+
+
+def _encode_file_base64(path: str) -> str:
+    """分块 base64 编码（块大小为 3 的倍数，拼接结果与整体编码一致）"""
+    parts = []
+    with open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(3 * 256 * 1024)
+            if not chunk:
+                break
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+def _persist_image_as_markdown(source, original_name: str, original_note_path: str | None = None) -> tuple[str, str]:
+    """
+    保存图片到 uploads，返回 (Markdown, 附件路径)。
+    小图内联为 data URI；超过 LAB_DIARY_INLINE_IMAGE_MAX_BYTES 的大图只引用附件路径，
+    避免整图在内存和数据库里再复制一份 base64。
+    original_note_path：图片经过重新压缩且保留了原图时，注释里指向原图。
+    """
     ext = os.path.splitext(original_name)[1].lower()
     if ext not in IMAGE_MIME_MAP:
         ext = ".png"
     base = sanitize_filename(os.path.splitext(original_name)[0] or "legacy_image")
     filename = f"{base}{ext}"
-    save_path, stored_name = get_versioned_upload_path(filename)
-    with open(save_path, "wb") as fh:
-        fh.write(data)
+    save_path, stored_name, _ = store_upload_stream(_as_binary_stream(source), filename)
+    image_path = save_path.replace("\\", "/")
+    note_path = (original_note_path or save_path).replace("\\", "/")
+    if os.path.getsize(save_path) > INLINE_IMAGE_MAX_BYTES:
+        ensure_image_preview(save_path, os.path.splitext(stored_name)[0])
+        if original_note_path:
+            return f"![{stored_name}]({image_path})\n\n_原图已保存：{note_path}_", image_path
+        return f"![{stored_name}]({image_path})", image_path
     mime = IMAGE_MIME_MAP.get(ext, "application/octet-stream")
-    payload = base64.b64encode(data).decode("ascii")
+    payload = _encode_file_base64(save_path)
+    ensure_image_preview(save_path, _data_uri_preview_key(payload))
     data_uri = f"data:{mime};base64,{payload}"
-    note_path = save_path.replace("\\", "/")
-    return f"![{stored_name}]({data_uri})\n\n_原图已保存：{note_path}_"
+    return f"![{stored_name}]({data_uri})\n\n_原图已保存：{note_path}_", image_path
 
-def docx_to_markdown_with_assets(docx_bytes: bytes, origin_name: str) -> str:
-    """将 DOCX 转 Markdown，保留段落、表格、图片"""
-    doc = Document(BytesIO(docx_bytes))
-    lines = []
+# ==================== 导入图片压缩 ====================
+RECOMPRESSIBLE_IMAGE_EXTS = {".png", ".bmp", ".tif", ".tiff", ".jpg", ".jpeg"}
+IMAGE_FORMAT_EXTS = {"WEBP": ".webp", "JPEG": ".jpg", "PNG": ".png"}
+
+
+def new_image_import_stage(recompress: bool | None = None) -> dict:
+    """
+    一次导入批次的图片处理配置与统计。
+    recompress=None 时读取 LAB_DIARY_IMPORT_RECOMPRESS。
+    """
+    if recompress is None:
+        recompress = str(_get_setting("LAB_DIARY_IMPORT_RECOMPRESS", "0")).strip().lower() in ("1", "true", "yes")
+    fmt = str(_get_setting("LAB_DIARY_IMPORT_IMAGE_FORMAT", "webp")).strip().upper() or "WEBP"
+    if fmt == "JPG":
+        fmt = "JPEG"
+    if fmt not in IMAGE_FORMAT_EXTS or (fmt == "WEBP" and _preview_format()[0] != "WEBP"):
+        fmt = "JPEG"
+    return {
+        "recompress": bool(recompress) and HAS_PIL,
+        "format": fmt,
+        "quality": int(str(_get_setting("LAB_DIARY_IMPORT_IMAGE_QUALITY", "85")).strip() or "85"),
+        "max_edge": int(str(_get_setting("LAB_DIARY_IMPORT_IMAGE_MAX_EDGE", "2560")).strip() or "0"),
+        "min_bytes": int(str(_get_setting("LAB_DIARY_IMPORT_IMAGE_MIN_BYTES", str(256 * 1024))).strip() or "0"),
+        "keep_originals": str(_get_setting("LAB_DIARY_IMPORT_KEEP_ORIGINALS", "1")).strip().lower() in ("1", "true", "yes"),
+        "workers": int(str(_get_setting("LAB_DIARY_IMPORT_IMAGE_WORKERS", str(min(4, os.cpu_count() or 1)))).strip() or "1"),
+        "executor": None,
+        "images": 0,
+        "recompressed": 0,
+        "original_bytes": 0,
+        "stored_bytes": 0,
+    }
+
+
+def _image_stage_executor(image_stage: dict):
+    """按需创建进程池；workers<=1 时在当前进程内串行处理"""
+    if image_stage["executor"] is None and image_stage["workers"] > 1:
+        image_stage["executor"] = ProcessPoolExecutor(max_workers=image_stage["workers"])
+    return image_stage["executor"]
+
+
+def close_image_import_stage(image_stage: dict | None) -> None:
+    if image_stage and image_stage.get("executor") is not None:
+        image_stage["executor"].shutdown(wait=True)
+        image_stage["executor"] = None
+
+
+def _recompress_image_file(src_path: str, dst_path: str, fmt: str, quality: int, max_edge: int) -> int | None:
+    """进程池任务：重新编码单张图片，返回输出字节数；无法处理时返回 None"""
+    try:
+        with Image.open(src_path) as img:
+            img.load()
+            img = ImageOps.exif_transpose(img)
+            if max_edge > 0:
+                img.thumbnail((max_edge, max_edge))
+            img = _image_mode_for_format(img, fmt)
+            params = {"optimize": True}
+            if fmt in ("JPEG", "WEBP"):
+                params["quality"] = quality
+            img.save(dst_path, format=fmt, **params)
+        return os.path.getsize(dst_path)
+    except Exception:
+        return None
+
+
+def _persist_image_batch(items, image_stage: dict | None = None) -> list[tuple[str, str]]:
+    """
+    保存一组图片并按输入顺序返回 (Markdown, 附件路径)。
+    items: [(原始文件名, 打开二进制流的函数)]。
+    启用压缩时先落到临时目录，再交给进程池并行重新编码；结果比原图大则保留原图。
+    """
+    if not items:
+        return []
+    if not image_stage or not image_stage["recompress"]:
+        persisted = []
+        for name, opener in items:
+            with opener() as fh:
+                md, stored_path = _persist_image_as_markdown(fh, name)
+            persisted.append((md, stored_path))
+            if image_stage is not None:
+                size = os.path.getsize(stored_path)
+                image_stage["images"] += 1
+                image_stage["original_bytes"] += size
+                image_stage["stored_bytes"] += size
+        return persisted
+
+    fmt = image_stage["format"]
+    target_ext = IMAGE_FORMAT_EXTS[fmt]
+    persisted = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        sources = []
+        jobs = {}
+        for idx, (name, opener) in enumerate(items):
+            ext = os.path.splitext(name)[1].lower()
+            src_path = os.path.join(work_dir, f"{idx}_src{ext}")
+            with opener() as fh, open(src_path, "wb") as out:
+                shutil.copyfileobj(fh, out, UPLOAD_CHUNK_SIZE)
+            size = os.path.getsize(src_path)
+            sources.append((name, src_path, size))
+            if ext in RECOMPRESSIBLE_IMAGE_EXTS and size >= image_stage["min_bytes"]:
+                jobs[idx] = os.path.join(work_dir, f"{idx}_dst{target_ext}")
+
+        job_args = {
+            idx: (sources[idx][1], dst, fmt, image_stage["quality"], image_stage["max_edge"])
+            for idx, dst in jobs.items()
+        }
+        results = {}
+        executor = _image_stage_executor(image_stage) if len(job_args) > 1 else None
+        if executor is not None:
+            futures = {executor.submit(_recompress_image_file, *args): idx for idx, args in job_args.items()}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception:
+                    results[futures[future]] = None
+        else:
+            for idx, args in job_args.items():
+                results[idx] = _recompress_image_file(*args)
+
+        for idx, (name, src_path, size) in enumerate(sources):
+            new_size = results.get(idx)
+            image_stage["images"] += 1
+            image_stage["original_bytes"] += size
+            if new_size and new_size < size:
+                original_note = None
+                if image_stage["keep_originals"]:
+                    with open(src_path, "rb") as fh:
+                        original_note, _, original_written = store_upload_stream(fh, name)
+                    # 保留的原图同样占盘，计入存储量（内容已存在而未重复写入时不计）
+                    if original_written:
+                        image_stage["stored_bytes"] += size
+                base = os.path.splitext(name)[0]
+                with open(jobs[idx], "rb") as fh:
+                    persisted.append(_persist_image_as_markdown(fh, f"{base}{target_ext}", original_note_path=original_note))
+                image_stage["recompressed"] += 1
+                image_stage["stored_bytes"] += new_size
+            else:
+                with open(src_path, "rb") as fh:
+                    persisted.append(_persist_image_as_markdown(fh, name))
+                image_stage["stored_bytes"] += size
+    return persisted
+
+
+# ==================== 图片预览 ====================
+PREVIEW_DIR_NAME = "previews"
+PREVIEW_MAX_EDGE = int(str(_get_setting("LAB_DIARY_PREVIEW_MAX_EDGE", "640")).strip() or "640")
+PREVIEW_QUALITY = int(str(_get_setting("LAB_DIARY_PREVIEW_QUALITY", "75")).strip() or "75")
+MARKDOWN_IMAGE_RE = re.compile(r"!\[([^\]]*)\]\(([^)\s]+)\)")
+DATA_URI_RE = re.compile(r"^data:([\w/+.-]+);base64,(.*)$", re.S)
+MARKDOWN_LINK_TITLE_RE = re.compile(r"^(.*?)\s+(\"[^\"]*\"|'[^']*')$", re.S)
+
+
+def iter_markdown_link_targets(text: str):
+    """
+    逐个产出 Markdown 链接/图片目标 (起点, 终点, 目标)：目标可以含空格与成对括号
+    （如 `uploads/photo (1).png`），也支持 `](<...>)` 写法；可选的 "标题" 不计入目标。
+    """
+    for match in re.finditer(r"\]\(", text):
+        start = match.end()
+        if text.startswith("<", start):
+            close = text.find(">", start)
+            if close != -1 and "\n" not in text[start:close]:
+                yield start + 1, close, text[start + 1:close]
+            continue
+        depth = 0
+        for pos in range(start, len(text)):
+            char = text[pos]
+            if char == "\n":
+                break
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                if depth:
+                    depth -= 1
+                    continue
+                target = text[start:pos]
+                titled = MARKDOWN_LINK_TITLE_RE.match(target)
+                if titled:
+                    target = titled.group(1)
+                stripped = target.strip()
+                offset = start + target.find(stripped) if stripped else start
+                yield offset, offset + len(stripped), stripped
+                break
+
+
+def _preview_format() -> tuple[str, str]:
+    """优先 WebP，Pillow 未编译 WebP 支持时退回 JPEG"""
+    try:
+        if pil_features is not None and pil_features.check("webp"):
+            return "WEBP", ".webp"
+    except Exception:
+        pass
+    return "JPEG", ".jpg"
+
+
+def get_preview_path(key: str, upload_dir: str | None = None) -> str:
+    upload_dir = upload_dir or get_storage_paths()["upload_dir"]
+    _, ext = _preview_format()
+    return os.path.join(upload_dir, PREVIEW_DIR_NAME, f"{sanitize_filename(key, 'preview')}_{PREVIEW_MAX_EDGE}{ext}")
+
+
+def _image_mode_for_format(img, fmt: str):
+    """转换到目标格式可写的色彩模式；JPEG 不支持透明，铺白底"""
+    if fmt == "PNG" or (fmt != "JPEG" and img.mode in ("RGB", "RGBA")):
+        return img
+    if fmt == "JPEG" and img.mode == "RGB":
+        return img
+    if fmt == "JPEG" and img.mode in ("RGBA", "LA", "P"):
+        rgba = img.convert("RGBA")
+        canvas = Image.new("RGB", rgba.size, (255, 255, 255))
+        canvas.paste(rgba, mask=rgba.split()[-1])
+        return canvas
+    return img.convert("RGBA" if "A" in img.mode else "RGB")
+
+
+def ensure_image_preview(source, key: str, upload_dir: str | None = None) -> str | None:
+    """
+    生成（或复用）尺寸受限的预览图，缓存在附件目录的 previews/ 下。
+    source 可以是文件路径或可读的二进制文件对象；无法解码（如 SVG）时返回 None。
+    """
+    if not HAS_PIL:
+        return None
+    preview_path = get_preview_path(key, upload_dir)
+    if os.path.exists(preview_path):
+        return preview_path
+    fmt, _ = _preview_format()
+    try:
+        with Image.open(source) as img:
+            if img.format == "JPEG":
+                img.draft("RGB", (PREVIEW_MAX_EDGE, PREVIEW_MAX_EDGE))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((PREVIEW_MAX_EDGE, PREVIEW_MAX_EDGE))
+            img = _image_mode_for_format(img, fmt)
+            os.makedirs(os.path.dirname(preview_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(preview_path), prefix=".preview_")
+            with os.fdopen(fd, "wb") as out:
+                img.save(out, format=fmt, quality=PREVIEW_QUALITY)
+        # 用硬链接落位：别的会话抢先生成了同一张预览时，这里失败并丢弃自己的副本，只由生成者入账
+        try:
+            os.link(tmp_path, preview_path)
+            created = True
+        except FileExistsError:
+            created = False
+        except OSError:
+            # 文件系统不支持硬链接时退回覆盖写
+            created = not os.path.exists(preview_path)
+            os.replace(tmp_path, preview_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # 显式指定 upload_dir 时目录不一定属于当前分片，不入账
+        if created and upload_dir is None:
+            record_usage("upload_bytes", os.path.getsize(preview_path))
+        return preview_path
+    except Exception:
+        return None
+
+
+def _data_uri_preview_key(payload: str) -> str:
+    return "inline_" + hashlib.sha256(payload.encode("ascii", errors="ignore")).hexdigest()[:16]
+
+
+def _resolve_local_upload(target: str) -> str | None:
+    """仅允许解析到附件目录内部的本地路径，避免 Markdown 读取任意文件"""
+    if re.match(r"^[a-zA-Z][\w+.-]*://", target):
+        return None
+    roots = {os.path.realpath(get_storage_paths()["upload_dir"]), os.path.realpath(LEGACY_UPLOAD_DIR)}
+    real = os.path.realpath(target)
+    if not os.path.isfile(real):
+        return None
+    if not any(real.startswith(root + os.sep) for root in roots):
+        return None
+    return real
+
+
+def render_markdown_with_previews(markdown_text: str, key_prefix: str) -> None:
+    """列表视图渲染：图片显示为预览图，原图按需展开"""
+    text = markdown_text or ""
+    cursor = 0
+    buffer = []
+    for idx, match in enumerate(MARKDOWN_IMAGE_RE.finditer(text)):
+        alt, target = match.group(1), match.group(2)
+        preview = None
+        original = None
+        data_match = DATA_URI_RE.match(target)
+        if data_match:
+            payload = data_match.group(2)
+            key = _data_uri_preview_key(payload)
+            preview = get_preview_path(key)
+            if not os.path.exists(preview):
+                try:
+                    preview = ensure_image_preview(BytesIO(base64.b64decode(payload)), key)
+                except Exception:
+                    preview = None
+            original = target
+        else:
+            local_path = _resolve_local_upload(target)
+            if local_path:
+                preview = ensure_image_preview(local_path, os.path.splitext(os.path.basename(local_path))[0])
+                original = local_path
+        if not preview:
+            continue
+        buffer.append(text[cursor:match.start()])
+        cursor = match.end()
+        chunk = "".join(buffer).strip()
+        if chunk:
+            st.markdown(chunk)
+        buffer = []
+        st.image(preview, caption=alt or None)
+        if st.checkbox("查看原图", key=f"{key_prefix}_original_{idx}"):
+            if original.startswith("data:"):
+                st.markdown(f"![{alt}]({original})")
+            else:
+                st.image(original)
+    buffer.append(text[cursor:])
+    chunk = "".join(buffer).strip()
+    if chunk:
+        st.markdown(chunk)
+
+
+def docx_to_markdown_with_assets(docx_source, origin_name: str, image_stage: dict | None = None, with_images: bool = True) -> str:
+    """
+    将 DOCX 转 Markdown，保留段落、表格、图片（docx_source 可为 bytes 或文件对象）。
+    单遍遍历正文：图片按 a:blip / v:imagedata 的关系 ID 解析，插入到所在段落/表格之后；
+    每个媒体部件只读取一次，未被正文引用的媒体不会落盘。with_images=False 时只取文字。
+    """
+    doc = Document(_as_binary_stream(docx_source))
+    style_names = _docx_style_names(doc)
+    label_prefix = sanitize_filename(os.path.splitext(origin_name)[0] or "legacy_doc")
+    blocks = []
+    media = {}
+    rid_to_media = {}
     for block in _iter_docx_block_items(doc):
         if isinstance(block, Paragraph):
-            chunk = _docx_paragraph_to_markdown(block)
-            if chunk:
-                lines.append(chunk)
-        elif isinstance(block, Table):
-            table_md = _docx_table_to_markdown(block)
-            if table_md:
-                lines.append(table_md)
-    image_lines = _collect_docx_image_markdown(docx_bytes, origin_name)
-    if image_lines:
-        lines.append("### 附件图片")
-        lines.extend(image_lines)
+            chunk = _docx_paragraph_to_markdown(block, style_names)
+            element = block._p
+        else:
+            chunk = _docx_table_to_markdown(block)
+            element = block._tbl
+        if chunk:
+            blocks.append(chunk)
+        if not with_images:
+            continue
+        refs = []
+        for rid in _docx_image_rids(element):
+            if rid not in rid_to_media:
+                rel = doc.part.rels.get(rid)
+                if rel is None or rel.is_external:
+                    continue
+                part = rel.target_part
+                partname = str(part.partname)
+                media.setdefault(partname, part)
+                rid_to_media[rid] = partname
+            refs.append(rid_to_media[rid])
+        if refs:
+            blocks.append(refs)
+
+    items = [
+        (f"{label_prefix}_{os.path.basename(partname)}", lambda part=part: BytesIO(part.blob))
+        for partname, part in media.items()
+    ]
+    persisted = dict(zip(media.keys(), _persist_image_batch(items, image_stage)))
+    lines = []
+    emitted = set()
+    for block in blocks:
+        if isinstance(block, str):
+            lines.append(block)
+            continue
+        for partname in block:
+            md, stored_path = persisted[partname]
+            if partname in emitted:
+                # 同一图片再次出现时只引用附件路径，不重复内联 base64
+                lines.append(f"![{os.path.basename(stored_path)}]({stored_path})")
+            else:
+                lines.append(md)
+                emitted.add(partname)
     return "\n\n".join(lines).strip()
 
-def convert_document_bytes_to_markdown(data_bytes: bytes, origin_name: str, ext: str) -> str:
-    """统一入口：将 doc/docx/rtf 转为 Markdown"""
+def convert_document_bytes_to_markdown(data_source, origin_name: str, ext: str, image_stage: dict | None = None, with_images: bool = True) -> str:
+    """统一入口：将 doc/docx/rtf 转为 Markdown（data_source 可为 bytes 或文件对象）"""
     ext = ext.lower()
     if ext == ".docx":
-        return docx_to_markdown_with_assets(data_bytes, origin_name)
+        return docx_to_markdown_with_assets(data_source, origin_name, image_stage, with_images)
     if ext == ".doc":
-        converted = _pandoc_convert(data_bytes, ".doc", "docx")
+        converted = _pandoc_convert(data_source, ".doc", "docx")
         if not converted:
-            converted = _convert_doc_via_win32(data_bytes)
+            converted = _convert_doc_via_win32(data_source)
         if converted:
-            return docx_to_markdown_with_assets(converted, origin_name)
-        fallback = _pandoc_convert(data_bytes, ".doc", "md")
+            return docx_to_markdown_with_assets(converted, origin_name, image_stage, with_images)
+        fallback = _pandoc_convert(data_source, ".doc", "md")
         if fallback:
             return fallback.decode("utf-8")
         return ""
     if ext == ".rtf":
-        converted = _pandoc_convert(data_bytes, ".rtf", "md")
+        converted = _pandoc_convert(data_source, ".rtf", "md")
         if converted:
             return converted.decode("utf-8")
-        return _decode_text_full(data_bytes)
+        return _decode_text_full(data_source)
     return ""
 
-# ==================== 数据库操作 ====================
-def get_db_connection():
-    db_path = get_storage_paths()["db_path"]
-    conn = sqlite3.connect(db_path, timeout=30)
-    try:
-        conn.execute("PRAGMA journal_mode=WAL;")
-    except Exception:
-        pass
-    return conn
+# ==================== 并行文档转换 ====================
+CONVERT_WORKERS = int(str(_get_setting("LAB_DIARY_CONVERT_WORKERS", str(min(4, os.cpu_count() or 1)))).strip() or "1")
+CONVERT_TIMEOUT = float(str(_get_setting("LAB_DIARY_CONVERT_TIMEOUT", "120")).strip() or "120")
 
-def init_and_migrate_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT, task_name TEXT, category TEXT, is_done INTEGER, details TEXT, tags TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    # 添加字段（如果不存在）
-    c.execute("PRAGMA table_info(tasks)")
-    cols = [i[1] for i in c.fetchall()]
-    if 'tags' not in cols:
+
+def _init_storage_worker(paths: dict) -> None:
+    """转换子进程初始化：子进程没有 Streamlit 会话，直接固定为发起导入的用户分片"""
+    global _STORAGE_PATHS_OVERRIDE, _USAGE_LOCK
+    _STORAGE_PATHS_OVERRIDE = dict(paths)
+    _reset_writer_after_fork()
+    # 子进程账本从 0 开始，只记本进程新写入的附件字节，随结果交给父进程入账
+    _USAGE_LOCK = threading.Lock()
+    _USAGE_LEDGERS.clear()
+    _USAGE_LEDGERS[os.path.realpath(paths["root"])] = {"upload_bytes": 0, "reconciled_at": time.time()}
+
+
+def _convert_document_file(path: str, origin_name: str, ext: str, recompress: bool) -> dict:
+    """转换子进程任务：转换单个文档；图片压缩在本进程内串行，避免嵌套进程池"""
+    image_stage = new_image_import_stage(recompress)
+    image_stage["workers"] = 1
+    # 工作进程会连续处理多个文件，账本是累计值，只上报本文件新增的部分
+    ledger = _USAGE_LEDGERS[os.path.realpath(get_storage_paths()["root"])]
+    written_before = ledger["upload_bytes"]
+    with open(path, "rb") as fh:
+        markdown = convert_document_bytes_to_markdown(fh, origin_name, ext, image_stage)
+    return {
+        "markdown": markdown,
+        "image_bytes_saved": image_stage["original_bytes"] - image_stage["stored_bytes"],
+        "images": image_stage["images"],
+        "recompressed": image_stage["recompressed"],
+        "original_bytes": image_stage["original_bytes"],
+        "stored_bytes": image_stage["stored_bytes"],
+        "upload_bytes_written": ledger["upload_bytes"] - written_before,
+    }
+
+
+def _conversion_worker_main(conn, paths: dict) -> None:
+    """转换子进程主循环：逐个接收 (路径, 文件名, 扩展名, 是否压缩图片)，回传 ("ok", 结果) 或 ("error", 异常)"""
+    _init_storage_worker(paths)
+    while True:
         try:
-            c.execute("ALTER TABLE tasks ADD COLUMN tags TEXT DEFAULT ''")
-            conn.commit()
-        except:
-            pass
-    conn.commit()
-    conn.close()
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        try:
+            reply = ("ok", _convert_document_file(*task))
+        except Exception as exc:
+            reply = ("error", exc)
+        try:
+            conn.send(reply)
+        except Exception:
+            # 异常对象无法序列化时只回传文字
+            conn.send(("error", RuntimeError(f"{type(reply[1]).__name__}: {reply[1]}")))
 
-def auto_backup():
-    paths = get_storage_paths()
-    db_path = paths["db_path"]
-    backup_dir = paths["backup_dir"]
-    if os.path.exists(db_path):
-        d_str = datetime.now().strftime("%Y-%m-%d")
-        bk_p = os.path.join(backup_dir, f"lab_data_{d_str}.db")
-        if not os.path.exists(bk_p):
+
+class _ConversionWorker:
+    """由本进程直接管理的转换子进程：一次只分配一个文件，便于按文件计时，超时时单独结束"""
+
+    def __init__(self, paths: dict):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_conversion_worker_main, args=(child_conn, paths), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = 0.0
+
+    def assign(self, task: tuple, args: tuple) -> None:
+        self.task = task
+        self.started = time.monotonic()
+        self.conn.send(args)
+
+    def stop(self, kill: bool = False) -> None:
+        if not kill and self.process.is_alive():
             try:
-                shutil.copy(db_path, bk_p)
-            except:
+                self.conn.send(None)
+            except OSError:
                 pass
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
 
-def run_query(q, p=(), fetch=False):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute(q, p)
-    if fetch:
-        d = c.fetchall()
-        cols = [desc[0] for desc in c.description]
-        conn.close()
-        return pd.DataFrame(d, columns=cols)
-    conn.commit()
-    conn.close()
-
-def insert_task_record(date_str: str, task_name: str, category: str, details: str, tags: str) -> int:
-    """插入一条任务记录并返回自增 ID"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO tasks (date, task_name, category, is_done, details, tags) VALUES (?, ?, ?, ?, ?, ?)",
-        (date_str, task_name, category, 0, details or "", tags or "")
-    )
-    new_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return new_id
 
-def get_distinct_tags():
-    """获取现有标签下拉选项"""
-    df = run_query("SELECT tags FROM tasks WHERE tags IS NOT NULL AND TRIM(tags)!=''", fetch=True)
-    if df.empty:
-        return []
-    tags = set()
-    for raw in df["tags"]:
-        if not raw:
+def convert_documents_streaming(documents, image_stage: dict | None = None, workers: int | None = None, timeout: float | None = None):
+    """
+    批量转换 doc/docx/rtf，按完成顺序产出 (文件名, 结果 dict 或异常)。
+    documents: [(文件名, 扩展名, 二进制流)]。
+    先查转换缓存，命中的文件直接产出；其余多个文件时分发给自管的转换子进程，每个子进程一次只处理一个文件。
+    timeout 按单个文件计：某个文件转换超过 timeout 秒时只结束处理它的子进程并记为超时，
+    排队中的文件不受影响，交给新启动的子进程继续转换。
+    """
+    workers = CONVERT_WORKERS if workers is None else workers
+    timeout = CONVERT_TIMEOUT if timeout is None else timeout
+    pending_docs = []
+    for name, ext, stream in documents:
+        stream = _as_binary_stream(stream)
+        digest, _ = _hash_stream(stream)
+        stream.seek(0)
+        cache_key = conversion_cache_key(digest, ext, image_stage)
+        cached = load_cached_conversion(cache_key)
+        if cached is not None:
+            yield name, {"markdown": cached, "image_bytes_saved": 0, "cached": True}
+            continue
+        pending_docs.append((name, ext, stream, cache_key))
+    if not pending_docs:
+        return
+
+    if workers <= 1 or len(pending_docs) == 1:
+        for name, ext, stream, cache_key in pending_docs:
+            before = image_stage["original_bytes"] - image_stage["stored_bytes"] if image_stage else 0
+            try:
+                markdown = convert_document_bytes_to_markdown(stream, name, ext, image_stage)
+            except Exception as exc:
+                yield name, exc
+                continue
+            after = image_stage["original_bytes"] - image_stage["stored_bytes"] if image_stage else 0
+            store_cached_conversion(cache_key, markdown)
+            yield name, {"markdown": markdown, "image_bytes_saved": after - before}
+        return
+
+    recompress = bool(image_stage and image_stage["recompress"])
+    paths = get_storage_paths()
+    max_workers = min(workers, len(pending_docs))
+    pool = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        queued = deque()
+        for idx, (name, ext, stream, cache_key) in enumerate(pending_docs):
+            path = os.path.join(work_dir, f"{idx}{ext}")
+            with open(path, "wb") as out:
+                shutil.copyfileobj(stream, out, UPLOAD_CHUNK_SIZE)
+            queued.append(((name, cache_key), (path, name, ext, recompress)))
+        try:
+            while queued or any(worker.task for worker in pool):
+                # 空闲子进程领取排队的文件；超时被结束的子进程按需补上
+                for worker in pool:
+                    if worker.task is None and queued:
+                        worker.assign(*queued.popleft())
+                while queued and len(pool) < max_workers:
+                    worker = _ConversionWorker(paths)
+                    pool.append(worker)
+                    worker.assign(*queued.popleft())
+
+                busy = [worker for worker in pool if worker.task]
+                remaining = min(worker.started + timeout for worker in busy) - time.monotonic()
+                ready = wait_connections([worker.conn for worker in busy], timeout=max(0.0, remaining))
+                now = time.monotonic()
+                for worker in busy:
+                    name, cache_key = worker.task
+                    if worker.conn in ready:
+                        try:
+                            status, payload = worker.conn.recv()
+                        except (EOFError, OSError):
+                            status, payload = "crashed", RuntimeError("转换进程意外退出")
+                    elif now - worker.started >= timeout:
+                        status, payload = "crashed", TimeoutError(f"转换超时（{timeout:.0f} 秒）")
+                    else:
+                        continue
+                    worker.task = None
+                    if status == "crashed":
+                        # 卡死或崩溃的子进程无法复用，结束后由下一轮补一个新的
+                        worker.stop(kill=True)
+                        pool.remove(worker)
+                    if status != "ok":
+                        yield name, payload
+                        continue
+                    if image_stage is not None:
+                        for key in ("images", "recompressed", "original_bytes", "stored_bytes"):
+                            image_stage[key] += payload[key]
+                    record_usage("upload_bytes", payload["upload_bytes_written"])
+                    store_cached_conversion(cache_key, payload["markdown"])
+                    yield name, payload
+        finally:
+            for worker in pool:
+                worker.stop(kill=worker.task is not None)
+
+
+# ==================== 转换结果缓存 ====================
+# 转换器输出格式变化时递增，旧缓存自动失效
+CONVERTER_VERSION = "3"
+CONVERT_CACHE_MAX_BYTES = int(str(_get_setting("LAB_DIARY_CONVERT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))).strip() or "0")
+
+
+def _conversion_cache_dir() -> str:
+    return os.path.join(get_storage_paths()["root"], "cache", "conversions")
+
+
+def conversion_cache_key(digest: str, ext: str, image_stage: dict | None = None) -> str:
+    """缓存键：内容 SHA-256 + 扩展名 + 转换器版本 + 影响输出的图片选项"""
+    options = f"inline={INLINE_IMAGE_MAX_BYTES}"
+    if image_stage and image_stage["recompress"]:
+        options += "|recompress={format}:{quality}:{max_edge}:{min_bytes}:{keep_originals}".format(**image_stage)
+    raw = "|".join([digest, ext.lower(), CONVERTER_VERSION, options])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def load_cached_conversion(cache_key: str) -> str | None:
+    """命中时返回 Markdown 并刷新最近使用时间；引用的附件已被清理则视为未命中"""
+    path = os.path.join(_conversion_cache_dir(), f"{cache_key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            entry = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    upload_dir = get_storage_paths()["upload_dir"]
+    if any(not os.path.exists(os.path.join(upload_dir, name)) for name in entry.get("assets", [])):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return entry.get("markdown")
+
+
+def store_cached_conversion(cache_key: str, markdown: str) -> None:
+    if not markdown or CONVERT_CACHE_MAX_BYTES <= 0:
+        return
+    cache_dir = _conversion_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    upload_dir = get_storage_paths()["upload_dir"]
+    assets = sorted(
+        name for name in extract_asset_refs(markdown)
+        if not name.startswith("inline_") and os.path.isfile(os.path.join(upload_dir, name))
+    )
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".entry_")
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        json.dump({"version": CONVERTER_VERSION, "markdown": markdown, "assets": assets}, fh, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(cache_dir, f"{cache_key}.json"))
+    evict_conversion_cache()
+
+
+def evict_conversion_cache(max_bytes: int | None = None) -> int:
+    """按最近使用时间（mtime）做 LRU 淘汰，直到总大小不超过上限；返回释放字节数"""
+    max_bytes = CONVERT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    cache_dir = _conversion_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        freed += size
+    return freed
+
+
+# ==================== 数据库操作 ====================
+TASK_COLUMNS = ("id", "date", "task_name", "category", "is_done", "details", "tags", "created_at", "updated_at")
+# 连接参数：WAL 下 synchronous=NORMAL 已足够安全；负数 cache_size 单位为 KiB
+SQLITE_CACHE_KB = int(str(_get_setting("LAB_DIARY_SQLITE_CACHE_KB", "16384")).strip() or "16384")
+SQLITE_MMAP_MB = int(str(_get_setting("LAB_DIARY_SQLITE_MMAP_MB", "128")).strip() or "128")
+
+def get_db_connection(db_path: str | None = None):
+    """打开分片数据库；后台线程没有会话，需显式传入 db_path"""
+    db_path = db_path or get_storage_paths()["db_path"]
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        # auto_vacuum 只对还没建表的新库生效，必须在切换 WAL 之前设置；旧库由后台维护转换。
+        # 已有库上设置它也会产生一次写入，所以只在空库上设置
+        if not conn.execute("PRAGMA page_count;").fetchone()[0]:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB};")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024};")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+    except Exception:
+        pass
+    return conn
+
+# 单写线程：每个分片一个写线程，各会话的写操作排队后合并为一次提交（group commit），
+# 不再在 busy 锁上互相等待；读操作照旧各开连接，在 WAL 快照上并发进行
+WRITE_BATCH_MAX = int(str(_get_setting("LAB_DIARY_WRITE_BATCH_MAX", "64")).strip() or "64")
+WRITER_IDLE_SECONDS = 60
+_WRITE_QUEUES: dict[str, queue.Queue] = {}
+_WRITE_QUEUES_LOCK = threading.Lock()
+# db_path → [提交次数, 写操作数]，供压测与管理脚本观察合并效果
+_WRITE_STATS: dict[str, list[int]] = {}
+# db_path → 本进程写线程的提交计数，是分片数据版本的一部分
+_DATA_GENERATIONS: dict[str, int] = {}
+_WRITER_STATE = threading.local()
+# 转换/压缩进程池的子进程里为 True：直接开连接写入，不经写线程
+_WRITE_DIRECT = False
+
+
+def _reset_writer_after_fork() -> None:
+    """
+    fork 出的子进程会继承父进程的写队列，却没有消费它的写线程（也可能继承一把被别的线程持有的锁），
+    这里全部换成新的；子进程改为直连写入
+    """
+    global _WRITE_QUEUES, _WRITE_QUEUES_LOCK, _WRITER_STATE, _WRITE_DIRECT
+    _WRITE_QUEUES = {}
+    _WRITE_QUEUES_LOCK = threading.Lock()
+    _WRITER_STATE = threading.local()
+    _WRITE_DIRECT = True
+
+
+os.register_at_fork(after_in_child=_reset_writer_after_fork)
+
+
+def _writer_loop(key: str, jobs: queue.Queue) -> None:
+    """取出队列中已到达的全部写操作，逐个放进 SAVEPOINT，一次 COMMIT；空闲一段时间后退出"""
+    conn = None
+    while True:
+        try:
+            batch = [jobs.get(timeout=WRITER_IDLE_SECONDS)]
+        except queue.Empty:
+            with _WRITE_QUEUES_LOCK:
+                if jobs.empty():
+                    _WRITE_QUEUES.pop(key, None)
+                    break
+            continue
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(jobs.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            if conn is None:
+                conn = get_db_connection(key)
+                conn.isolation_level = None
+            _WRITER_STATE.active = (key, conn)
+            conn.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                # 单个写操作失败只回滚它自己，不连累同批的其他会话
+                conn.execute("SAVEPOINT write_job")
+                try:
+                    job["result"] = job["fn"](conn)
+                    conn.execute("RELEASE write_job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_job")
+                    conn.execute("RELEASE write_job")
+                    job["error"] = e
+            conn.execute("COMMIT")
+            _DATA_GENERATIONS[key] = _DATA_GENERATIONS.get(key, 0) + 1
+            invalidate_query_cache(key)
+            stats = _WRITE_STATS.setdefault(key, [0, 0])
+            stats[0] += 1
+            stats[1] += len(batch)
+        except Exception as e:
+            print(f"Writer error: {e}")
+            for job in batch:
+                if job["error"] is None:
+                    job["error"] = e
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+        finally:
+            _WRITER_STATE.active = None
+            for job in batch:
+                job["done"].set()
+    if conn is not None:
+        conn.close()
+
+
+def submit_write(fn, db_path: str | None = None):
+    """
+    把写操作交给分片写线程执行并等待结果。
+    fn(conn) 在写线程的事务内运行，返回值原样带回；不要在 fn 里 commit。
+    """
+    key = os.path.realpath(db_path or get_storage_paths()["db_path"])
+    if _WRITE_DIRECT:
+        conn = get_db_connection(key)
+        try:
+            result = fn(conn)
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+    active = getattr(_WRITER_STATE, "active", None)
+    if active and active[0] == key:
+        return fn(active[1])
+    job = {"fn": fn, "done": threading.Event(), "result": None, "error": None}
+    with _WRITE_QUEUES_LOCK:
+        jobs = _WRITE_QUEUES.get(key)
+        if jobs is None:
+            jobs = _WRITE_QUEUES[key] = queue.Queue()
+            threading.Thread(target=_writer_loop, args=(key, jobs), name="lab-diary-writer", daemon=True).start()
+        jobs.put(job)
+    job["done"].wait()
+    if job["error"] is not None:
+        raise job["error"]
+    return job["result"]
+
+def shard_data_version(db_path: str | None = None) -> tuple:
+    """
+    分片数据版本：本进程的提交计数 + 库文件与 WAL 的 (mtime_ns, size)。
+    其他进程（管理脚本、恢复）的写入体现在文件状态上，本进程的写入即使落在同一时间片也能由计数区分。
+    """
+    key = os.path.realpath(db_path or get_storage_paths()["db_path"])
+    version = [_DATA_GENERATIONS.get(key, 0)]
+    for suffix in ("", "-wal"):
+        try:
+            info = os.stat(key + suffix)
+        except OSError:
+            info = None
+        # 空 WAL 与不存在等价：只读连接打开时可能重新建出一个空 WAL
+        if info is None or (suffix and not info.st_size):
+            version += [0, 0]
+        else:
+            version += [info.st_mtime_ns, info.st_size]
+    return tuple(version)
+
+def init_and_migrate_db(db_path: str | None = None):
+    conn = get_db_connection(db_path)
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT, task_name TEXT, category TEXT, is_done INTEGER, details TEXT, tags TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 添加字段（如果不存在）
+    c.execute("PRAGMA table_info(tasks)")
+    cols = [i[1] for i in c.fetchall()]
+    if 'tags' not in cols:
+        try:
+            c.execute("ALTER TABLE tasks ADD COLUMN tags TEXT DEFAULT ''")
+            conn.commit()
+        except:
+            pass
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_assets (
+            sha256 TEXT PRIMARY KEY,
+            stored_name TEXT NOT NULL,
+            original_name TEXT,
+            size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 附件引用索引：触发器只标记变动的记录，清理时增量重建，无需每次全表扫描 details
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='asset_refs'")
+    seed_refs = c.fetchone() is None
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS asset_refs (
+            task_id INTEGER NOT NULL,
+            ref TEXT NOT NULL,
+            PRIMARY KEY (task_id, ref)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_asset_refs_ref ON asset_refs(ref)")
+    c.execute("CREATE TABLE IF NOT EXISTS asset_refs_dirty (task_id INTEGER PRIMARY KEY)")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_asset_refs_insert AFTER INSERT ON tasks BEGIN
+            INSERT OR IGNORE INTO asset_refs_dirty (task_id) VALUES (NEW.id);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_asset_refs_update AFTER UPDATE OF details ON tasks BEGIN
+            INSERT OR IGNORE INTO asset_refs_dirty (task_id) VALUES (NEW.id);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_asset_refs_delete AFTER DELETE ON tasks BEGIN
+            DELETE FROM asset_refs WHERE task_id = OLD.id;
+            DELETE FROM asset_refs_dirty WHERE task_id = OLD.id;
+        END
+    ''')
+    if seed_refs:
+        c.execute("INSERT OR IGNORE INTO asset_refs_dirty (task_id) SELECT id FROM tasks")
+    # 变更日志：触发器记录每次增删改后的整行，增量备份只导出上次导出之后的行
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS tasks_changelog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+            op TEXT NOT NULL,
+            task_id INTEGER NOT NULL,
+            row_json TEXT
+        )
+    ''')
+    row_image = "json_object(" + ", ".join(f"'{col}', NEW.{col}" for col in TASK_COLUMNS) + ")"
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_changelog_insert AFTER INSERT ON tasks BEGIN
+            INSERT INTO tasks_changelog (op, task_id, row_json) VALUES ('insert', NEW.id, {row_image});
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_changelog_update AFTER UPDATE ON tasks BEGIN
+            INSERT INTO tasks_changelog (op, task_id, row_json) VALUES ('update', NEW.id, {row_image});
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_changelog_delete AFTER DELETE ON tasks BEGIN
+            INSERT INTO tasks_changelog (op, task_id, row_json) VALUES ('delete', OLD.id, NULL);
+        END
+    ''')
+    conn.commit()
+    conn.close()
+
+# 读缓存：每次 rerun 页面上的查询大多结果不变，按 (分片, SQL, 参数) 缓存 DataFrame，
+# 命中时再核对分片数据版本；按内存占用做 LRU 淘汰
+QUERY_CACHE_MAX_BYTES = int(float(str(_get_setting("LAB_DIARY_QUERY_CACHE_MB", "64")).strip() or "0") * 1024 * 1024)
+_QUERY_CACHE: OrderedDict = OrderedDict()
+_QUERY_CACHE_LOCK = threading.Lock()
+_QUERY_CACHE_BYTES = 0
+
+
+def invalidate_query_cache(db_path: str | None = None) -> None:
+    """丢弃某个分片（或全部）的缓存结果；写线程提交后自动调用"""
+    global _QUERY_CACHE_BYTES
+    key = os.path.realpath(db_path) if db_path else None
+    with _QUERY_CACHE_LOCK:
+        for cache_key in [k for k in _QUERY_CACHE if key is None or k[0] == key]:
+            _QUERY_CACHE_BYTES -= _QUERY_CACHE.pop(cache_key)[2]
+
+
+def _cache_query_result(cache_key: tuple, version: tuple, df: pd.DataFrame) -> None:
+    global _QUERY_CACHE_BYTES
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    if size > QUERY_CACHE_MAX_BYTES:
+        return
+    with _QUERY_CACHE_LOCK:
+        old = _QUERY_CACHE.pop(cache_key, None)
+        if old is not None:
+            _QUERY_CACHE_BYTES -= old[2]
+        _QUERY_CACHE[cache_key] = (version, df, size)
+        _QUERY_CACHE_BYTES += size
+        while _QUERY_CACHE_BYTES > QUERY_CACHE_MAX_BYTES and _QUERY_CACHE:
+            _QUERY_CACHE_BYTES -= _QUERY_CACHE.popitem(last=False)[1][2]
+
+
+def run_query(q, p=(), fetch=False):
+    if not fetch:
+        submit_write(lambda conn: conn.execute(q, p))
+        return
+    db_path = get_storage_paths()["db_path"]
+    cache_key = None
+    if QUERY_CACHE_MAX_BYTES:
+        # 版本在查询之前取：查询期间若有写入，缓存项带的是旧版本，下次自然失效
+        version = shard_data_version(db_path)
+        cache_key = (os.path.realpath(db_path), q, tuple(p))
+        with _QUERY_CACHE_LOCK:
+            hit = _QUERY_CACHE.get(cache_key)
+            if hit is not None and hit[0] == version:
+                _QUERY_CACHE.move_to_end(cache_key)
+                # 返回副本，调用方改列不会污染缓存
+                return hit[1].copy()
+    conn = get_db_connection(db_path)
+    c = conn.cursor()
+    c.execute(q, p)
+    d = c.fetchall()
+    cols = [desc[0] for desc in c.description]
+    conn.close()
+    df = pd.DataFrame(d, columns=cols)
+    if cache_key is not None:
+        _cache_query_result(cache_key, version, df.copy())
+    return df
+
+def iter_query_chunks(q, p=(), chunk_size=500):
+    """按批读取查询结果，每批为字典列表，避免一次性载入全部记录"""
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute(q, p)
+        cols = [desc[0] for desc in c.description]
+        while True:
+            batch = c.fetchmany(chunk_size)
+            if not batch:
+                break
+            yield [dict(zip(cols, item)) for item in batch]
+    finally:
+        conn.close()
+
+def insert_task_record(date_str: str, task_name: str, category: str, details: str, tags: str) -> int:
+    """插入一条任务记录并返回自增 ID"""
+    return submit_write(lambda conn: conn.execute(
+        "INSERT INTO tasks (date, task_name, category, is_done, details, tags) VALUES (?, ?, ?, ?, ?, ?)",
+        (date_str, task_name, category, 0, details or "", tags or "")
+    ).lastrowid)
+
+def get_distinct_tags():
+    """获取现有标签下拉选项"""
+    df = run_query("SELECT tags FROM tasks WHERE tags IS NOT NULL AND TRIM(tags)!=''", fetch=True)
+    if df.empty:
+        return []
+    tags = set()
+    for raw in df["tags"]:
+        if not raw:
             continue
         parts = re.split(r"[,，\\s]+", str(raw))
         for part in parts:
@@ -750,98 +2008,1205 @@ def get_distinct_tags():
                 tags.add(part)
     return sorted(tags)
 
+# ==================== 备份与后台维护 ====================
+BACKUP_PAGES_PER_STEP = int(str(_get_setting("LAB_DIARY_BACKUP_PAGES_PER_STEP", "256")).strip() or "256")
+BACKUP_STEP_PAUSE = float(str(_get_setting("LAB_DIARY_BACKUP_STEP_PAUSE", "0.005")).strip() or "0")
+BACKUP_NAME_RE = re.compile(r"^lab_data_(\d{4}-\d{2}-\d{2})\.db(\.gz|\.zst)?$")
+# auto：装了 zstandard 用 zstd，否则 gzip；none 保留未压缩的 .db
+BACKUP_COMPRESSION = str(_get_setting("LAB_DIARY_BACKUP_COMPRESSION", "auto")).strip().lower() or "auto"
+BACKUP_KEEP_DAILY = int(str(_get_setting("LAB_DIARY_BACKUP_KEEP_DAILY", "7")).strip() or "7")
+BACKUP_KEEP_WEEKLY = int(str(_get_setting("LAB_DIARY_BACKUP_KEEP_WEEKLY", "4")).strip() or "4")
+BACKUP_FULL_INTERVAL_DAYS = int(str(_get_setting("LAB_DIARY_BACKUP_FULL_INTERVAL_DAYS", "7")).strip() or "7")
+CHANGES_NAME_RE = re.compile(r"^lab_changes_(\d{4}-\d{2}-\d{2})_(\d+)-(\d+)\.jsonl\.gz$")
+BACKUP_KEEP_MONTHLY = int(str(_get_setting("LAB_DIARY_BACKUP_KEEP_MONTHLY", "12")).strip() or "12")
+# admin.py restore 覆盖当前库前留下的安全副本，只保留最近几份
+SAFETY_COPY_NAME_RE = re.compile(r"^pre_restore_(\d{8}_\d{6})\.db(\.gz|\.zst)?$")
+BACKUP_KEEP_SAFETY_COPIES = int(str(_get_setting("LAB_DIARY_BACKUP_KEEP_SAFETY_COPIES", "3")).strip() or "0")
+
+# 进程内标记：db_path → 今天已安排过备份的日期，rerun 时只查字典
+_BACKUP_MARKERS: dict[str, str] = {}
+_SHARD_JOBS: dict[tuple[str, str], threading.Thread] = {}
+_SHARD_JOBS_LOCK = threading.Lock()
+# 最近一次后台维护的结果（backup / sqlite 两类），供页面与管理脚本展示
+_MAINTENANCE_REPORTS: dict[str, dict] = {}
+# 进程内标记：db_path → 上次安排数据库维护的时间戳
+_MAINTENANCE_MARKERS: dict[str, float] = {}
+MAINTENANCE_INTERVAL_MIN = float(str(_get_setting("LAB_DIARY_MAINTENANCE_INTERVAL_MIN", "60")).strip() or "60")
+WAL_CHECKPOINT_BYTES = int(str(_get_setting("LAB_DIARY_WAL_CHECKPOINT_MB", "64")).strip() or "64") * 1024 * 1024
+VACUUM_FREE_RATIO = float(str(_get_setting("LAB_DIARY_VACUUM_FREE_RATIO", "0.2")).strip() or "0.2")
+VACUUM_MIN_BYTES = int(str(_get_setting("LAB_DIARY_VACUUM_MIN_MB", "8")).strip() or "8") * 1024 * 1024
+
+
+def _submit_shard_job(db_path: str, name: str, target, *args) -> bool:
+    """同一分片的同名后台任务同时只跑一个；已在运行时返回 False"""
+    key = (os.path.realpath(db_path), name)
+    with _SHARD_JOBS_LOCK:
+        running = _SHARD_JOBS.get(key)
+        if running is not None and running.is_alive():
+            return False
+        worker = threading.Thread(target=target, args=args, name=f"lab-diary-{name}", daemon=True)
+        _SHARD_JOBS[key] = worker
+        worker.start()
+    return True
+
+
+def backup_database(db_path: str, dest_path: str, pages: int | None = None, pause: float | None = None) -> dict:
+    """
+    用 SQLite 在线备份 API 分批复制页面（包含 WAL 中已提交的内容），
+    每批之间稍作停顿让出写锁；写到临时文件并通过 integrity_check 后再改名。
+    """
+    pages = BACKUP_PAGES_PER_STEP if pages is None else pages
+    pause = BACKUP_STEP_PAUSE if pause is None else pause
+    started = time.time()
+    tmp_path = f"{dest_path}.partial"
+    try:
+        src = sqlite3.connect(db_path, timeout=30)
+        try:
+            dst = sqlite3.connect(tmp_path)
+            try:
+                src.backup(dst, pages=pages, progress=(lambda *_: time.sleep(pause)) if pause > 0 else None)
+                # 在副本里记下快照时间与变更日志水位，时间点恢复从这里接着回放增量
+                row = None
+                if dst.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_sequence'").fetchone():
+                    row = dst.execute("SELECT seq FROM sqlite_sequence WHERE name='tasks_changelog'").fetchone()
+                watermark = row[0] if row else 0
+                taken_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:23]
+                dst.execute("CREATE TABLE IF NOT EXISTS backup_meta (key TEXT PRIMARY KEY, value TEXT)")
+                dst.executemany(
+                    "INSERT OR REPLACE INTO backup_meta (key, value) VALUES (?, ?)",
+                    [("taken_at", taken_at), ("changelog_seq", str(watermark))]
+                )
+                dst.commit()
+                integrity = dst.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        if integrity != "ok":
+            raise sqlite3.DatabaseError(f"backup integrity_check failed: {integrity}")
+    except BaseException:
+        # 复制中断或校验失败：不留半截 .partial 占用备份目录
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(tmp_path, dest_path)
+    return {
+        "path": dest_path,
+        "bytes": os.path.getsize(dest_path),
+        "integrity": integrity,
+        "taken_at": taken_at,
+        "changelog_seq": watermark,
+        "seconds": round(time.time() - started, 3),
+    }
+
+
+def _backup_codec() -> str | None:
+    if BACKUP_COMPRESSION in ("none", "off", "0"):
+        return None
+    if BACKUP_COMPRESSION == "zstd" or (BACKUP_COMPRESSION == "auto" and HAS_ZSTD):
+        return "zst" if HAS_ZSTD else "gz"
+    return "gz"
+
+
+def open_backup(path: str):
+    """按扩展名打开备份，返回解压后的只读二进制流"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        if not HAS_ZSTD:
+            raise RuntimeError("读取 .zst 备份需要安装 zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def compress_backup(path: str, codec: str | None = None) -> str:
+    """流式压缩一个 .db 备份，成功后删除原文件，返回压缩文件路径"""
+    codec = codec or _backup_codec()
+    if not codec:
+        return path
+    dest = f"{path}.{codec}"
+    tmp_path = f"{dest}.partial"
+    try:
+        with open(path, "rb") as src:
+            if codec == "zst":
+                with open(tmp_path, "wb") as raw:
+                    zstandard.ZstdCompressor(level=10, threads=-1).copy_stream(src, raw)
+            else:
+                with gzip.open(tmp_path, "wb", compresslevel=6) as out:
+                    shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+    except BaseException:
+        # 压缩中断（磁盘满等）：删掉半截的 .partial，原 .db 保持不动
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(tmp_path, dest)
+    os.remove(path)
+    return dest
+
+
+def list_backups(backup_dir: str) -> list[dict]:
+    """列出目录中的每日备份（新的在前），同一天只取一份，压缩版本优先"""
+    found = {}
+    try:
+        names = os.listdir(backup_dir)
+    except OSError:
+        return []
+    for name in names:
+        match = BACKUP_NAME_RE.match(name)
+        if not match:
+            continue
+        day = match.group(1)
+        path = os.path.join(backup_dir, name)
+        entry = {"day": day, "path": path, "bytes": os.path.getsize(path), "compressed": bool(match.group(2))}
+        if day not in found or (entry["compressed"] and not found[day]["compressed"]):
+            found[day] = entry
+    return sorted(found.values(), key=lambda item: item["day"], reverse=True)
+
+
+def select_backups_to_keep(days: list[str], keep_daily: int, keep_weekly: int, keep_monthly: int) -> set[str]:
+    """祖父-父-子轮换：保留最近 N 天、最近 N 周与最近 N 个月里各自最新的一份"""
+    keep = set()
+    ordered = sorted(set(days), reverse=True)
+    keep.update(ordered[:keep_daily])
+    weeks, months = [], []
+    for day in ordered:
+        parsed = datetime.strptime(day, "%Y-%m-%d")
+        week = parsed.isocalendar()[:2]
+        if week not in weeks and len(weeks) < keep_weekly:
+            weeks.append(week)
+            keep.add(day)
+        month = day[:7]
+        if month not in months and len(months) < keep_monthly:
+            months.append(month)
+            keep.add(day)
+    return keep
+
+
+def rotate_backups(backup_dir: str, keep_daily: int | None = None, keep_weekly: int | None = None, keep_monthly: int | None = None) -> dict:
+    """
+    按保留策略删除过期备份，并把保留下来的未压缩 .db 压缩，
+    返回处理数量与回收的空间。
+    """
+    keep_daily = BACKUP_KEEP_DAILY if keep_daily is None else keep_daily
+    keep_weekly = BACKUP_KEEP_WEEKLY if keep_weekly is None else keep_weekly
+    keep_monthly = BACKUP_KEEP_MONTHLY if keep_monthly is None else keep_monthly
+    summary = {"kept": 0, "deleted": 0, "compressed": 0, "reclaimed_bytes": 0}
+    files = []
+    for name in os.listdir(backup_dir):
+        match = BACKUP_NAME_RE.match(name)
+        if match:
+            files.append((match.group(1), os.path.join(backup_dir, name), bool(match.group(2))))
+    keep = select_backups_to_keep([day for day, _, _ in files], keep_daily, keep_weekly, keep_monthly)
+    # 早于最老一份保留快照的增量文件已无法回放，一并清理
+    oldest_kept = min(keep) if keep else None
+    for name in os.listdir(backup_dir):
+        match = CHANGES_NAME_RE.match(name)
+        if match and oldest_kept and match.group(1) < oldest_kept:
+            path = os.path.join(backup_dir, name)
+            try:
+                summary["reclaimed_bytes"] += os.path.getsize(path)
+                os.remove(path)
+                summary["deleted"] += 1
+            except OSError as e:
+                print(f"Backup rotation error ({path}): {e}")
+    # 恢复前的安全副本不参与按天轮换，按时间只留最近几份，留下的一并压缩
+    safety_copies = []
+    for name in os.listdir(backup_dir):
+        match = SAFETY_COPY_NAME_RE.match(name)
+        if match:
+            safety_copies.append((match.group(1), os.path.join(backup_dir, name), bool(match.group(2))))
+    safety_copies.sort(reverse=True)
+    for index, (_, path, compressed) in enumerate(safety_copies):
+        try:
+            size = os.path.getsize(path)
+            if index >= BACKUP_KEEP_SAFETY_COPIES:
+                os.remove(path)
+                summary["deleted"] += 1
+                summary["reclaimed_bytes"] += size
+            elif not compressed and _backup_codec():
+                packed = compress_backup(path)
+                summary["compressed"] += 1
+                summary["reclaimed_bytes"] += size - os.path.getsize(packed)
+        except OSError as e:
+            print(f"Backup rotation error ({path}): {e}")
+    compressed_days = {day for day, _, compressed in files if compressed}
+    for day, path, compressed in files:
+        size = os.path.getsize(path)
+        try:
+            # 不在保留名单内，或同一天已有压缩版本的旧 .db，直接删除
+            if day not in keep or (not compressed and day in compressed_days):
+                os.remove(path)
+                summary["deleted"] += 1
+                summary["reclaimed_bytes"] += size
+                continue
+            summary["kept"] += 1
+            if not compressed and _backup_codec():
+                packed = compress_backup(path)
+                summary["compressed"] += 1
+                summary["reclaimed_bytes"] += size - os.path.getsize(packed)
+        except OSError as e:
+            print(f"Backup rotation error ({path}): {e}")
+    return summary
+
+
+def list_change_files(backup_dir: str) -> list[dict]:
+    """列出增量变更文件，按起始序号排序"""
+    files = []
+    try:
+        names = os.listdir(backup_dir)
+    except OSError:
+        return []
+    for name in names:
+        match = CHANGES_NAME_RE.match(name)
+        if match:
+            files.append({
+                "day": match.group(1),
+                "from_seq": int(match.group(2)),
+                "to_seq": int(match.group(3)),
+                "path": os.path.join(backup_dir, name),
+            })
+    return sorted(files, key=lambda item: item["from_seq"])
+
+
+def export_changelog(db_path: str, backup_dir: str, day: str) -> dict | None:
+    """
+    把变更日志里尚未导出的行写成一个 gzip 压缩的 JSON Lines 增量文件，
+    写成功后从库里删掉这些行；没有变更时不产生文件。
+    """
+    conn = get_db_connection(db_path)
+    try:
+        first_seq, last_seq = conn.execute("SELECT MIN(seq), MAX(seq) FROM tasks_changelog").fetchone()
+        if last_seq is None:
+            return None
+        dest = os.path.join(backup_dir, f"lab_changes_{day}_{first_seq}-{last_seq}.jsonl.gz")
+        tmp_path = f"{dest}.partial"
+        count = 0
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as out:
+            rows = conn.execute(
+                "SELECT seq, changed_at, op, task_id, row_json FROM tasks_changelog WHERE seq <= ? ORDER BY seq",
+                (last_seq,)
+            )
+            for seq, changed_at, op, task_id, row_json in rows:
+                out.write(json.dumps({
+                    "seq": seq,
+                    "at": changed_at,
+                    "op": op,
+                    "id": task_id,
+                    "row": json.loads(row_json) if row_json else None,
+                }, ensure_ascii=False))
+                out.write("\n")
+                count += 1
+        os.replace(tmp_path, dest)
+        conn.execute("DELETE FROM tasks_changelog WHERE seq <= ?", (last_seq,))
+        conn.commit()
+    finally:
+        conn.close()
+    return {"path": dest, "changes": count, "from_seq": first_seq, "to_seq": last_seq, "bytes": os.path.getsize(dest)}
+
+
+def _replace_database_file(tmp_path: str, dest_path: str) -> None:
+    """用整理好的库文件原子替换目标库；先删掉旧库残留的 -wal/-shm，避免被回放到新文件上"""
+    for suffix in ("-wal", "-shm"):
+        try:
+            os.remove(dest_path + suffix)
+        except FileNotFoundError:
+            pass
+    os.replace(tmp_path, dest_path)
+
+
+def _apply_change(conn, change: dict) -> None:
+    if change["op"] == "delete":
+        conn.execute("DELETE FROM tasks WHERE id = ?", (change["id"],))
+        return
+    row = change["row"] or {}
+    cols = [col for col in TASK_COLUMNS if col in row]
+    conn.execute(
+        f"INSERT OR REPLACE INTO tasks ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)})",
+        [row[col] for col in cols]
+    )
+
+
+def _materialize_backup(backup_path: str, tmp_path: str) -> dict:
+    """把（可能压缩的）快照解压成可打开的库文件，返回其中的 backup_meta"""
+    with open_backup(backup_path) as src, open(tmp_path, "wb") as out:
+        shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='backup_meta'").fetchone():
+            return dict(conn.execute("SELECT key, value FROM backup_meta").fetchall())
+        return {}
+    finally:
+        conn.close()
+
+
+def _finalize_restored_db(conn, tmp_path: str, dest_path: str, backup_dir: str) -> None:
+    """清掉备份专用的表、校验，然后原子替换目标库（会关闭 conn）"""
+    try:
+        # 恢复出的库从干净的变更日志重新开始；序号越过已有增量文件，新旧两条时间线不会混用同一序号
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='tasks_changelog'").fetchone():
+            conn.execute("DELETE FROM tasks_changelog")
+            floor = max((item["to_seq"] for item in list_change_files(backup_dir)), default=0)
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='tasks_changelog'").fetchone()
+            if row is None:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('tasks_changelog', ?)", (floor,))
+            elif row[0] < floor:
+                conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name='tasks_changelog'", (floor,))
+        conn.execute("DROP TABLE IF EXISTS backup_meta")
+        conn.commit()
+        integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+    if integrity != "ok":
+        os.remove(tmp_path)
+        raise sqlite3.DatabaseError(f"restored database failed integrity_check: {integrity}")
+    _replace_database_file(tmp_path, dest_path)
+
+
+def restore_backup(backup_path: str, dest_path: str) -> dict:
+    """把一份完整快照原样恢复到 dest_path（先写临时文件，校验后改名）"""
+    tmp_path = f"{dest_path}.partial"
+    meta = _materialize_backup(backup_path, tmp_path)
+    _finalize_restored_db(sqlite3.connect(tmp_path), tmp_path, dest_path, os.path.dirname(backup_path))
+    return {"snapshot": backup_path, "snapshot_taken_at": meta.get("taken_at", ""), "bytes": os.path.getsize(dest_path)}
+
+
+def verify_backup(backup_path: str) -> dict:
+    """解压到临时文件做 integrity_check 并统计记录数，不改动备份本身"""
+    started = time.time()
+    fd, tmp_path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    result = {"path": backup_path, "ok": False, "integrity": "", "tasks": None, "error": ""}
+    try:
+        _materialize_backup(backup_path, tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            result["integrity"] = conn.execute("PRAGMA integrity_check").fetchone()[0]
+            result["tasks"] = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        finally:
+            conn.close()
+        result["ok"] = result["integrity"] == "ok"
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        os.remove(tmp_path)
+    result["seconds"] = round(time.time() - started, 3)
+    return result
+
+
+def verify_change_file(path: str) -> dict:
+    """逐行解析增量文件，检查 gzip 完整性与序号连续性"""
+    result = {"path": path, "ok": False, "changes": 0, "error": ""}
+    try:
+        previous = None
+        with gzip.open(path, "rt", encoding="utf-8") as fh:
+            for line in fh:
+                seq = json.loads(line)["seq"]
+                if previous is not None and seq != previous + 1:
+                    raise ValueError(f"序号不连续：{previous} → {seq}")
+                previous = seq
+                result["changes"] += 1
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def restore_point_in_time(backup_dir: str, dest_path: str, target: datetime | None = None,
+                          live_db_path: str | None = None) -> dict:
+    """
+    时间点恢复：取不晚于 target 的最近一份完整快照，按序号回放其后的增量变更
+    （只回放 target 之前发生的），校验通过后原子替换 dest_path。
+    传入 live_db_path 时先把该库里尚未导出的变更写成增量文件，否则最近一次每日导出之后的变更不会被回放；
+    导出失败直接抛出。返回的 recovery_point 是实际恢复到的时间（最后一条回放变更或快照时间）。
+    """
+    target = target or datetime.now()
+    flushed = None
+    if live_db_path and os.path.exists(live_db_path):
+        flushed = export_changelog(live_db_path, backup_dir, datetime.now().strftime("%Y-%m-%d"))
+    target_str = f"{target:%Y-%m-%d %H:%M:%S}.{target.microsecond // 1000:03d}"
+    tmp_path = f"{dest_path}.partial"
+    snapshot = None
+    for candidate in list_backups(backup_dir):
+        if candidate["day"] > target_str[:10]:
+            continue
+        meta = _materialize_backup(candidate["path"], tmp_path)
+        # 早于变更日志的旧备份没有元数据，按当天零点、水位 0 处理
+        taken_at = meta.get("taken_at", f"{candidate['day']} 00:00:00.000")
+        if taken_at <= target_str:
+            snapshot = dict(candidate, taken_at=taken_at, changelog_seq=int(meta.get("changelog_seq", 0)))
+            break
+    if snapshot is None:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise FileNotFoundError(f"{backup_dir} 中没有早于 {target_str} 的完整备份")
+
+    applied = 0
+    last_seq = snapshot["changelog_seq"]
+    last_at = None
+    gap = False
+    conn = sqlite3.connect(tmp_path)
+    try:
+        for change_file in list_change_files(backup_dir):
+            if change_file["to_seq"] <= last_seq:
+                continue
+            with gzip.open(change_file["path"], "rt", encoding="utf-8") as fh:
+                for line in fh:
+                    change = json.loads(line)
+                    if change["seq"] <= last_seq or change["at"] > target_str:
+                        continue
+                    if change["seq"] != last_seq + 1:
+                        gap = True
+                    _apply_change(conn, change)
+                    last_seq = change["seq"]
+                    last_at = change["at"]
+                    applied += 1
+        conn.commit()
+    except Exception:
+        conn.close()
+        os.remove(tmp_path)
+        raise
+    _finalize_restored_db(conn, tmp_path, dest_path, backup_dir)
+    return {
+        "snapshot": snapshot["path"],
+        "snapshot_taken_at": snapshot["taken_at"],
+        "applied_changes": applied,
+        "last_seq": last_seq,
+        "gap": gap,
+        "target": target_str,
+        "recovery_point": last_at or snapshot["taken_at"],
+        "flushed_changes": flushed["changes"] if flushed else 0,
+    }
+
+
+def _run_daily_backup(paths: dict, day: str) -> None:
+    """
+    每日后台维护：先把变更日志导出为增量文件；距上次完整快照满
+    LAB_DIARY_BACKUP_FULL_INTERVAL_DAYS 天时再做一次在线快照，然后压缩与轮换备份目录。
+    """
+    dest = os.path.join(paths["backup_dir"], f"lab_data_{day}.db")
+    try:
+        report = {}
+        report["changes"] = export_changelog(paths["db_path"], paths["backup_dir"], day)
+        backups = list_backups(paths["backup_dir"])
+        last_full = datetime.strptime(backups[0]["day"], "%Y-%m-%d") if backups else None
+        if last_full is None or (datetime.strptime(day, "%Y-%m-%d") - last_full).days >= BACKUP_FULL_INTERVAL_DAYS:
+            # 超出硬配额时不再新增完整快照（旧快照加增量文件仍可恢复），避免备份把卷撑满
+            if quota_status(os.path.getsize(paths["db_path"]), paths) == "hard":
+                report["snapshot_skipped"] = "quota"
+            else:
+                report["snapshot"] = backup_database(paths["db_path"], dest)
+        report["finished_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        report["backups"] = rotate_backups(paths["backup_dir"])
+        # 每天对账一次，纠正管理脚本等账本之外的附件增减
+        reconcile_usage(paths)
+        _MAINTENANCE_REPORTS.setdefault(paths["db_path"], {})["backup"] = report
+    except Exception as e:
+        # 失败时清掉标记，下次 rerun 会重试
+        _BACKUP_MARKERS.pop(paths["db_path"], None)
+        print(f"Backup error ({paths['db_path']}): {e}")
+
+
+def run_sqlite_maintenance(db_path: str, force: bool = False) -> dict:
+    """
+    单个分片的数据库维护，按阈值决定做哪些事并返回报告：
+    WAL 超过阈值时 wal_checkpoint(TRUNCATE)；PRAGMA optimize（从未统计过时先 ANALYZE）；
+    空闲页占比和大小都超过阈值时回收空间——已是增量模式就 incremental_vacuum，
+    否则做一次 VACUUM 把库转换为增量模式。force=True 时忽略阈值全部执行。
+    """
+    started = time.time()
+    wal_path = f"{db_path}-wal"
+    report = {
+        "db_path": db_path,
+        "actions": [],
+        "wal_bytes_before": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+    }
+    conn = get_db_connection(db_path)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        report["free_bytes_before"] = free_pages * page_size
+        report["db_bytes_before"] = page_count * page_size
+
+        if force or not conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone():
+            conn.execute("ANALYZE")
+            report["actions"].append("analyze")
+        conn.execute("PRAGMA optimize")
+        report["actions"].append("optimize")
+
+        free_ratio = free_pages / page_count if page_count else 0
+        if free_pages and (force or (free_ratio >= VACUUM_FREE_RATIO and report["free_bytes_before"] >= VACUUM_MIN_BYTES)):
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                conn.execute(f"PRAGMA incremental_vacuum({free_pages})").fetchall()
+                report["actions"].append("incremental_vacuum")
+            else:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+                report["actions"].append("vacuum")
+        conn.commit()
+
+        if force or report["wal_bytes_before"] >= WAL_CHECKPOINT_BYTES or "vacuum" in report["actions"] or "incremental_vacuum" in report["actions"]:
+            busy, log_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            report["actions"].append("checkpoint" if not busy else "checkpoint_busy")
+            report["checkpoint"] = {"busy": busy, "log_frames": log_frames, "checkpointed": checkpointed}
+
+        report["free_bytes_after"] = conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+        report["db_bytes_after"] = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+    finally:
+        conn.close()
+    report["wal_bytes_after"] = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    report["reclaimed_bytes"] = max(0, report["db_bytes_before"] - report["db_bytes_after"]) + max(0, report["wal_bytes_before"] - report["wal_bytes_after"])
+    report["seconds"] = round(time.time() - started, 3)
+    report["finished_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return report
+
+
+def _run_sqlite_maintenance(db_path: str, force: bool) -> None:
+    try:
+        _MAINTENANCE_REPORTS.setdefault(db_path, {})["sqlite"] = run_sqlite_maintenance(db_path, force)
+    except Exception as e:
+        _MAINTENANCE_MARKERS.pop(db_path, None)
+        print(f"Maintenance error ({db_path}): {e}")
+
+
+def schedule_maintenance(force: bool = False) -> bool:
+    """
+    当前分片距上次维护超过 LAB_DIARY_MAINTENANCE_INTERVAL_MIN 分钟时，放到后台线程执行；
+    大批量导入、删除之后用 force=True 立即检查一次（阈值仍然生效）。
+    """
+    db_path = get_storage_paths()["db_path"]
+    now = time.time()
+    if not force and now - _MAINTENANCE_MARKERS.get(db_path, 0) < MAINTENANCE_INTERVAL_MIN * 60:
+        return False
+    if not os.path.exists(db_path):
+        return False
+    _MAINTENANCE_MARKERS[db_path] = now
+    return _submit_shard_job(db_path, "maintenance", _run_sqlite_maintenance, db_path, False)
+
+
+def auto_backup():
+    """每个分片每天一次在线备份，在后台线程执行，不阻塞页面渲染"""
+    paths = get_storage_paths()
+    db_path = paths["db_path"]
+    today = datetime.now().strftime("%Y-%m-%d")
+    if _BACKUP_MARKERS.get(db_path) == today or not os.path.exists(db_path):
+        return
+    _BACKUP_MARKERS[db_path] = today
+    _submit_shard_job(db_path, "backup", _run_daily_backup, paths, today)
+
+
+# ==================== 存储管理 ====================
+GC_GRACE_DAYS = float(str(_get_setting("LAB_DIARY_GC_GRACE_DAYS", "7")).strip() or "7")
+UPLOAD_REF_RE = re.compile(r"uploads[\\/]+([^\s()\[\]<>\"'\\/]+)")
+UPLOAD_TARGET_RE = re.compile(r"uploads[\\/]+([^\\/]+)")
+
+
+def extract_asset_refs(details: str) -> set[str]:
+    """从记录正文中提取引用的附件文件名与内联图片的预览键"""
+    refs = set()
+    text = details or ""
+    for match in UPLOAD_REF_RE.finditer(text):
+        name = match.group(1)
+        refs.add(name)
+        # `_原图已保存：path_` 的斜体结尾会被一并匹配到
+        refs.add(name.rstrip("_"))
+    # 链接目标整体解析：旧附件沿用原始文件名，可能含空格或括号，如 `photo (1).png`
+    for _, _, target in iter_markdown_link_targets(text):
+        for match in UPLOAD_TARGET_RE.finditer(target):
+            refs.add(match.group(1))
+            refs.add(urllib.parse.unquote(match.group(1)))
+    for match in MARKDOWN_IMAGE_RE.finditer(text):
+        data_match = DATA_URI_RE.match(match.group(2))
+        if data_match:
+            refs.add(_data_uri_preview_key(data_match.group(2)))
+    refs.discard("")
+    return refs
+
+
+def refresh_asset_reference_index() -> int:
+    """只重新解析被触发器标记为变动的记录，返回处理条数"""
+    def refresh(conn):
+        rows = conn.execute(
+            "SELECT d.task_id, t.details FROM asset_refs_dirty d LEFT JOIN tasks t ON t.id = d.task_id"
+        ).fetchall()
+        for task_id, details in rows:
+            conn.execute("DELETE FROM asset_refs WHERE task_id=?", (task_id,))
+            if details:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO asset_refs (task_id, ref) VALUES (?, ?)",
+                    [(task_id, ref) for ref in extract_asset_refs(details)]
+                )
+            conn.execute("DELETE FROM asset_refs_dirty WHERE task_id=?", (task_id,))
+        return len(rows)
+
+    return submit_write(refresh)
+
+
+def _dir_usage(path: str) -> tuple[int, int]:
+    total = 0
+    count = 0
+    if not os.path.isdir(path):
+        return 0, 0
+    for entry in os.scandir(path):
+        if entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+            count += 1
+        elif entry.is_dir(follow_symlinks=False):
+            sub_total, sub_count = _dir_usage(entry.path)
+            total += sub_total
+            count += sub_count
+    return total, count
+
+
+def get_shard_storage_report(paths: dict | None = None) -> dict:
+    """当前用户分片的存储占用：数据库（含 WAL）、附件、预览图、备份"""
+    paths = paths or get_storage_paths()
+    db_bytes = 0
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            db_bytes += os.path.getsize(paths["db_path"] + suffix)
+        except OSError:
+            pass
+    upload_total, upload_count = _dir_usage(paths["upload_dir"])
+    preview_bytes, preview_count = _dir_usage(os.path.join(paths["upload_dir"], PREVIEW_DIR_NAME))
+    backup_bytes, backup_count = _dir_usage(paths["backup_dir"])
+    cache_bytes, _ = _dir_usage(os.path.join(paths["root"], "cache"))
+    return {
+        "db_bytes": db_bytes,
+        "upload_bytes": upload_total - preview_bytes,
+        "upload_count": upload_count - preview_count,
+        "preview_bytes": preview_bytes,
+        "preview_count": preview_count,
+        "backup_bytes": backup_bytes,
+        "backup_count": backup_count,
+        "cache_bytes": cache_bytes,
+        "total_bytes": db_bytes + upload_total + backup_bytes + cache_bytes,
+    }
+
+
+# 配额按分片总占用（数据库 + 附件 + 备份）计算，0 表示不限
+QUOTA_SOFT_BYTES = int(float(str(_get_setting("LAB_DIARY_QUOTA_SOFT_MB", "0")).strip() or "0") * 1024 * 1024)
+QUOTA_HARD_BYTES = int(float(str(_get_setting("LAB_DIARY_QUOTA_HARD_MB", "0")).strip() or "0") * 1024 * 1024)
+# 进程内用量账本：分片根目录 → 附件字节数；首次使用时扫描一次目录，之后随写入增减。
+# 备份目录是扁平的几十个文件，由备份线程、管理脚本在账本之外增删，每次直接 stat
+_USAGE_LEDGERS: dict[str, dict] = {}
+_USAGE_LOCK = threading.Lock()
+
+
+def reconcile_usage(paths: dict | None = None) -> dict:
+    """重新扫描分片目录，校正账本"""
+    paths = paths or get_storage_paths()
+    report = get_shard_storage_report(paths)
+    ledger = {
+        "upload_bytes": report["upload_bytes"] + report["preview_bytes"],
+        "reconciled_at": time.time(),
+    }
+    with _USAGE_LOCK:
+        _USAGE_LEDGERS[os.path.realpath(paths["root"])] = ledger
+    return ledger
+
+
+def record_usage(kind: str, delta: int, paths: dict | None = None) -> None:
+    """按写入/删除的字节数增减账本；账本尚未建立时忽略（建立时的扫描会包含这次变化）"""
+    key = os.path.realpath((paths or get_storage_paths())["root"])
+    with _USAGE_LOCK:
+        ledger = _USAGE_LEDGERS.get(key)
+        if ledger is not None:
+            ledger[kind] = max(0, ledger.get(kind, 0) + delta)
+
+
+def get_shard_usage(paths: dict | None = None) -> dict:
+    """当前分片用量与配额状态；数据库与备份直接 stat，附件取账本"""
+    paths = paths or get_storage_paths()
+    with _USAGE_LOCK:
+        ledger = _USAGE_LEDGERS.get(os.path.realpath(paths["root"]))
+    if ledger is None:
+        ledger = reconcile_usage(paths)
+    db_bytes = 0
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            db_bytes += os.path.getsize(paths["db_path"] + suffix)
+        except OSError:
+            pass
+    backup_bytes, _ = _dir_usage(paths["backup_dir"])
+    total = db_bytes + ledger["upload_bytes"] + backup_bytes
+    return {
+        "db_bytes": db_bytes,
+        "upload_bytes": ledger["upload_bytes"],
+        "backup_bytes": backup_bytes,
+        "total_bytes": total,
+        "soft_bytes": QUOTA_SOFT_BYTES,
+        "hard_bytes": QUOTA_HARD_BYTES,
+        "level": _quota_level(total),
+    }
+
+
+def _quota_level(total: int) -> str:
+    if QUOTA_HARD_BYTES and total >= QUOTA_HARD_BYTES:
+        return "hard"
+    if QUOTA_SOFT_BYTES and total >= QUOTA_SOFT_BYTES:
+        return "soft"
+    return "ok"
+
+
+def quota_status(incoming_bytes: int = 0, paths: dict | None = None) -> str:
+    """再写入 incoming_bytes 后的配额状态：ok / soft / hard"""
+    if not (QUOTA_SOFT_BYTES or QUOTA_HARD_BYTES):
+        return "ok"
+    return _quota_level(get_shard_usage(paths)["total_bytes"] + incoming_bytes)
+
+
+def enforce_quota(incoming_bytes: int = 0, paths: dict | None = None) -> None:
+    """写入会超出硬配额时抛出 OSError(EDQUOT)"""
+    if quota_status(incoming_bytes, paths) == "hard":
+        raise OSError(errno.EDQUOT, f"存储配额已满（上限 {format_bytes(QUOTA_HARD_BYTES)}），请先清理附件或备份")
+
+
+def _shard_report_version(shard: dict) -> list:
+    """汇总缓存的键：数据版本加上附件、备份目录的 mtime（增删文件时目录 mtime 会变）"""
+    version = list(shard_data_version(shard["db_path"]))
+    for path in (shard["upload_dir"], shard["backup_dir"]):
+        try:
+            version.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            version.append(0)
+    return version
+
+
+def summarize_shard(shard: dict) -> dict:
+    """单个分片的活动与存储摘要；用只读连接打开，不占写锁"""
+    conn = sqlite3.connect(f"file:{os.path.abspath(shard['db_path'])}?mode=ro", uri=True)
+    try:
+        total, done = conn.execute("SELECT COUNT(*), COALESCE(SUM(is_done), 0) FROM tasks").fetchone()
+        per_week = dict(conn.execute(
+            "SELECT strftime('%Y-W%W', created_at, 'localtime') AS week, COUNT(*) FROM tasks "
+            "WHERE created_at IS NOT NULL GROUP BY week"
+        ).fetchall())
+        last_active = conn.execute("SELECT MAX(datetime(created_at, 'localtime')) FROM tasks").fetchone()[0]
+        # 编辑不会更新 created_at，变更日志里有最近一次增删改的时间
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='tasks_changelog'").fetchone():
+            last_change = conn.execute("SELECT MAX(changed_at) FROM tasks_changelog").fetchone()[0]
+            if last_change:
+                last_active = max(last_active or "", last_change[:19])
+    finally:
+        conn.close()
+    return {
+        "user_label": shard["user_label"],
+        "tasks": total,
+        "done": done,
+        "per_week": per_week,
+        "last_active": last_active,
+        "storage": get_shard_storage_report(shard),
+    }
+
+
+def collect_lab_report(shards: list[dict] | None = None, workers: int = 4, cache: dict | None = None,
+                       weeks: int = 12) -> dict:
+    """
+    并行汇总全部分片的活动与存储。
+    cache 形如 {db_path: {"version": [...], "summary": {...}}}，就地更新；版本未变的分片不再打开数据库。
+    """
+    shards = list_shard_paths() if shards is None else shards
+    cache = {} if cache is None else cache
+    summaries = []
+    stale = []
+    for shard in shards:
+        version = _shard_report_version(shard)
+        entry = cache.get(shard["db_path"])
+        if entry and entry.get("version") == version:
+            summaries.append(entry["summary"])
+        else:
+            stale.append((shard, version))
+
+    errors = []
+    if stale:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(summarize_shard, shard): (shard, version) for shard, version in stale}
+            for future in as_completed(futures):
+                shard, version = futures[future]
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    errors.append({"user_label": shard["user_label"], "error": str(e)})
+                    continue
+                # 版本取自扫描之前：扫描期间若有写入，下次会重新扫描
+                cache[shard["db_path"]] = {"version": version, "summary": summary}
+                summaries.append(summary)
+    summaries.sort(key=lambda item: item["user_label"])
+
+    today = datetime.now()
+    week_keys = [(today - timedelta(weeks=n)).strftime("%Y-W%W") for n in range(weeks - 1, -1, -1)]
+    per_week = {key: sum(item["per_week"].get(key, 0) for item in summaries) for key in week_keys}
+    storage_keys = ("db_bytes", "upload_bytes", "preview_bytes", "backup_bytes", "total_bytes")
+    return {
+        "shards": summaries,
+        "per_week": per_week,
+        "totals": {
+            "tasks": sum(item["tasks"] for item in summaries),
+            "done": sum(item["done"] for item in summaries),
+            **{key: sum(item["storage"][key] for item in summaries) for key in storage_keys},
+        },
+        "scanned": len(stale) - len(errors),
+        "cached": len(shards) - len(stale),
+        "errors": errors,
+    }
+
+
+def collect_orphaned_uploads(grace_days: float = GC_GRACE_DAYS, dry_run: bool = True) -> dict:
+    """
+    列出未被任何记录引用的附件；超过宽限期的在非 dry-run 模式下删除。
+    宽限期用于保护刚上传、还没粘贴进记录正文的文件。
+    """
+    refresh_asset_reference_index()
+    upload_dir = get_storage_paths()["upload_dir"]
+    conn = get_db_connection()
+    try:
+        referenced = {row[0] for row in conn.execute("SELECT DISTINCT ref FROM asset_refs")}
+    finally:
+        conn.close()
+
+    now = time.time()
+    cutoff = now - grace_days * 86400
+    orphans = []
+    kept_stems = set()
+    for entry in os.scandir(upload_dir):
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        stat = entry.stat(follow_symlinks=False)
+        if entry.name in referenced:
+            kept_stems.add(os.path.splitext(entry.name)[0])
+            continue
+        expired = stat.st_mtime <= cutoff
+        if not expired:
+            kept_stems.add(os.path.splitext(entry.name)[0])
+        orphans.append({
+            "name": entry.name,
+            "path": entry.path,
+            "size": stat.st_size,
+            "age_days": round((now - stat.st_mtime) / 86400, 1),
+            "expired": expired,
+        })
+
+    preview_dir = os.path.join(upload_dir, PREVIEW_DIR_NAME)
+    if os.path.isdir(preview_dir):
+        for entry in os.scandir(preview_dir):
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            key = os.path.splitext(entry.name)[0].rsplit("_", 1)[0]
+            if key in referenced or key in kept_stems:
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            orphans.append({
+                "name": f"{PREVIEW_DIR_NAME}/{entry.name}",
+                "path": entry.path,
+                "size": stat.st_size,
+                "age_days": round((now - stat.st_mtime) / 86400, 1),
+                "expired": True,
+            })
+
+    reclaimed = 0
+    deleted_names = []
+    if not dry_run:
+        for item in orphans:
+            if not item["expired"]:
+                continue
+            try:
+                os.remove(item["path"])
+            except OSError:
+                continue
+            item["deleted"] = True
+            reclaimed += item["size"]
+            deleted_names.append(os.path.basename(item["name"]))
+        if deleted_names:
+            submit_write(lambda conn: conn.executemany(
+                "DELETE FROM upload_assets WHERE stored_name=?", [(n,) for n in deleted_names]
+            ))
+        record_usage("upload_bytes", -reclaimed)
+    return {
+        "dry_run": dry_run,
+        "grace_days": grace_days,
+        "orphans": orphans,
+        "expired_bytes": sum(item["size"] for item in orphans if item["expired"]),
+        "reclaimed_bytes": reclaimed,
+    }
+
+
+def format_bytes(num: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num) < 1024 or unit == "GB":
+            return f"{num:.0f} {unit}" if unit == "B" else f"{num:.1f} {unit}"
+        num /= 1024
+    return f"{num:.1f} GB"
+
 # ==================== 优化的历史记录导入 ====================
-def import_legacy_records_preserve_original(files, *, default_category: str, default_tags: str, default_date, prefer_filename_date: bool = True, use_ai_metadata: bool = True):
+def import_legacy_records_preserve_original(files, *, default_category: str, default_tags: str, default_date, prefer_filename_date: bool = True, use_ai_metadata: bool = True, recompress_images: bool | None = None):
     """
     优化版本：保留原始记录内容，AI只提取元数据
+    recompress_images：是否对文档内嵌图片重新压缩（None 读取配置）；
+    每条结果带 image_bytes_saved，便于汇总整批节省的空间。
     """
     results = []
     if not files:
         return results
     
+    image_stage = new_image_import_stage(recompress_images)
+    try:
+        return _import_legacy_records(
+            files, results, image_stage,
+            default_category=default_category,
+            default_tags=default_tags,
+            default_date=default_date,
+            prefer_filename_date=prefer_filename_date,
+            use_ai_metadata=use_ai_metadata,
+        )
+    finally:
+        close_image_import_stage(image_stage)
+        schedule_maintenance(force=True)
+
+
+def _read_import_stream(file_item):
+    """直接复用上传对象本身的缓冲区（不再 getvalue() 复制）；空文件或不可读返回 None"""
+    try:
+        if _is_cheaply_rewindable(file_item):
+            stream = _as_binary_stream(file_item)
+        elif hasattr(file_item, "read"):
+            stream = _spool_stream(file_item)
+        else:
+            return None
+        stream.seek(0, os.SEEK_END)
+        if stream.tell() == 0:
+            return None
+        stream.seek(0)
+        return stream
+    except Exception:
+        return None
+
+
+def _import_legacy_records(files, results, image_stage, *, default_category, default_tags, default_date, prefer_filename_date, use_ai_metadata):
+    """
+    逐个文件解析并写入数据库（图片处理状态由调用方统一创建和关闭）。
+    文本类文件就地解码；doc/docx/rtf 交给转换进程池，结果按完成顺序逐条入库。
+    """
     if isinstance(default_date, datetime):
         fallback_date = default_date
     else:
         fallback_date = datetime.combine(default_date, datetime.min.time())
     
     client = get_ai_client() if use_ai_metadata else None
+
+    item_meta = {}
+
+    def commit(name, original_text, image_bytes_saved=0):
+        original_text = (original_text or "").strip()
+        if not original_text:
+            return {"file": name, "success": False, "message": "未解析出内容"}
+        if quota_status(len(original_text.encode("utf-8"))) == "hard":
+            return {"file": name, "success": False, "message": "存储配额已满，已停止导入"}
+        
+        # 提取元数据
+        date_str = guess_record_date_from_filename(name, fallback_date) if prefer_filename_date else fallback_date.strftime("%Y-%m-%d")
+        task_name = build_task_name_from_filename(name)
+        category = default_category
+        tags = default_tags
+        
+        # 使用AI提取更准确的元数据（可选）
+        if client and use_ai_metadata:
+            metadata = ai_extract_metadata(client, original_text[:1000])  # 只分析前1000字符
+            if metadata:
+                task_name = metadata.get('task_name', task_name)
+                category = metadata.get('category', category)
+                tags = metadata.get('tags', tags)
+                # 如果AI提取了日期，使用它
+                if metadata.get('date'):
+                    try:
+                        datetime.strptime(metadata['date'], '%Y-%m-%d')
+                        date_str = metadata['date']
+                    except:
+                        pass
+        
+        # 压缩包导入时，文件夹路径作为附加标签或类别
+        meta = item_meta.get(name) or {}
+        if meta.get("extra_tags"):
+            tags = f"{tags} {meta['extra_tags']}".strip() if tags else meta["extra_tags"]
+        if meta.get("category"):
+            category = meta["category"]
+        
+        # 插入记录，原始内容一字不改
+        new_id = insert_task_record(date_str, task_name, category, original_text, tags)
+        return {
+            "file": name, 
+            "success": True, 
+            "task_id": new_id, 
+            "date": date_str,
+            "task_name": task_name,
+            "category": category,
+            "tags": tags,
+            "content_preview": original_text[:100] + "..." if len(original_text) > 100 else original_text,
+            "image_bytes_saved": image_bytes_saved,
+        }
     
+    documents = []
     for file_item in files:
         name = getattr(file_item, "name", "legacy_record")
         ext = os.path.splitext(name)[1].lower()
-        data = None
-        
-        try:
-            if hasattr(file_item, "getvalue"):
-                data = file_item.getvalue()
-            elif hasattr(file_item, "read"):
-                data = file_item.read()
-        except Exception:
-            data = None
-        
-        if not data:
+        if quota_status() == "hard":
+            results.append({"file": name, "success": False, "message": "存储配额已满，已停止导入"})
+            continue
+        item_meta[name] = {
+            "extra_tags": getattr(file_item, "extra_tags", ""),
+            "category": getattr(file_item, "category", None),
+        }
+        stream = _read_import_stream(file_item)
+        if stream is None:
             results.append({"file": name, "success": False, "message": "无法读取文件内容"})
             continue
-        
+        if ext in LEGACY_IMAGE_EXTS:
+            results.append({"file": name, "success": False, "message": "请将图片嵌入文档一起导入"})
+            continue
+        if ext in (".docx", ".doc", ".rtf"):
+            documents.append((name, ext, stream))
+            continue
         try:
             # 提取原始文本内容
-            if ext in (".md", ".markdown", ".txt", ".csv", ".tsv"):
-                original_text = _decode_text_full(data)
-                if ext in (".csv", ".tsv"):
-                    original_text = f"```\n{original_text}\n```"
-            elif ext in (".docx", ".doc", ".rtf"):
-                original_text = convert_document_bytes_to_markdown(data, name, ext)
-            elif ext in LEGACY_IMAGE_EXTS:
-                results.append({"file": name, "success": False, "message": "请将图片嵌入文档一起导入"})
-                continue
-            else:
-                original_text = _decode_text_full(data)
-            
-            original_text = (original_text or "").strip()
-            if not original_text:
-                results.append({"file": name, "success": False, "message": "未解析出内容"})
-                continue
-            
-            # 提取元数据
-            date_str = guess_record_date_from_filename(name, fallback_date) if prefer_filename_date else fallback_date.strftime("%Y-%m-%d")
-            task_name = build_task_name_from_filename(name)
-            category = default_category
-            tags = default_tags
-            
-            # 使用AI提取更准确的元数据（可选）
-            if client and use_ai_metadata:
-                metadata = ai_extract_metadata(client, original_text[:1000])  # 只分析前1000字符
-                if metadata:
-                    task_name = metadata.get('task_name', task_name)
-                    category = metadata.get('category', category)
-                    tags = metadata.get('tags', tags)
-                    # 如果AI提取了日期，使用它
-                    if metadata.get('date'):
-                        try:
-                            datetime.strptime(metadata['date'], '%Y-%m-%d')
-                            date_str = metadata['date']
-                        except:
-                            pass
-            
-            # 插入记录，原始内容一字不改
-            new_id = insert_task_record(date_str, task_name, category, original_text, tags)
-            results.append({
-                "file": name, 
-                "success": True, 
-                "task_id": new_id, 
-                "date": date_str,
-                "task_name": task_name,
-                "category": category,
-                "tags": tags,
-                "content_preview": original_text[:100] + "..." if len(original_text) > 100 else original_text
-            })
-            
+            original_text = _decode_text_full(stream)
+            if ext in (".csv", ".tsv"):
+                original_text = f"```\n{original_text}\n```"
+            results.append(commit(name, original_text))
+        except Exception as exc:
+            results.append({"file": name, "success": False, "message": str(exc)})
+
+    for name, outcome in convert_documents_streaming(documents, image_stage):
+        if isinstance(outcome, Exception):
+            results.append({"file": name, "success": False, "message": str(outcome) or type(outcome).__name__})
+            continue
+        try:
+            results.append(commit(name, outcome["markdown"], outcome["image_bytes_saved"]))
         except Exception as exc:
             results.append({"file": name, "success": False, "message": str(exc)})
     
     return results
 
+# ==================== 压缩包批量导入 ====================
+ZIP_IMPORT_BATCH_SIZE = int(str(_get_setting("LAB_DIARY_ZIP_BATCH_SIZE", "20")).strip() or "20")
+ZIP_MAX_ENTRY_BYTES = int(str(_get_setting("LAB_DIARY_ZIP_MAX_ENTRY_BYTES", str(200 * 1024 * 1024))).strip() or "0")
+CATEGORY_OPTIONS = ["科研", "临床", "课程", "其他"]
+
+
+class _ArchiveMember(tempfile.SpooledTemporaryFile):
+    """压缩包条目的导入适配：内容分块转存（超过阈值自动落盘），name 为包内路径"""
+
+    def __init__(self, member_name: str, extra_tags: str = "", category: str | None = None):
+        super().__init__(max_size=8 * 1024 * 1024)
+        self._member_name = member_name
+        self.extra_tags = extra_tags
+        self.category = category
+
+    @property
+    def name(self):
+        return self._member_name
+
+
+def _zip_member_name(info: zipfile.ZipInfo) -> str:
+    """未设置 UTF-8 标志的条目名按 cp437 解出，中文 Windows 打包的实际是 GBK"""
+    name = info.filename
+    if not info.flag_bits & 0x800:
+        try:
+            name = name.encode("cp437").decode("gbk")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return name.replace("\\", "/")
+
+
+def _folder_metadata(member_name: str, folder_mode: str) -> tuple[str, str | None]:
+    folders = [part.strip() for part in member_name.split("/")[:-1] if part.strip()]
+    if folder_mode == "tags":
+        return " ".join("#" + re.sub(r"\s+", "_", part) for part in folders), None
+    if folder_mode == "category":
+        for part in folders:
+            if part in CATEGORY_OPTIONS:
+                return "", part
+    return "", None
+
+
+def list_zip_import_members(archive: zipfile.ZipFile) -> list[zipfile.ZipInfo]:
+    """筛选可导入的条目：跳过目录、隐藏文件、__MACOSX 和超大条目"""
+    members = []
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        name = _zip_member_name(info)
+        parts = name.split("/")
+        if any(part.startswith(".") or part == "__MACOSX" for part in parts):
+            continue
+        if os.path.splitext(name)[1].lower() not in LEGACY_TEXT_EXTS | {".csv", ".tsv", ".markdown"}:
+            continue
+        members.append(info)
+    return members
+
+
+def import_legacy_zip_archive(zip_source, *, folder_mode: str = "tags", progress=None, batch_size: int | None = None, **import_kwargs) -> list[dict]:
+    """
+    导入整个压缩包（例如多年的实验记录文件夹）。
+    条目逐个流式读出、分批交给 import_legacy_records_preserve_original，
+    同一时间只保留一个批次的条目，内存占用与压缩包大小无关。
+    folder_mode: "tags"（文件夹作为标签）/ "category"（匹配到的文件夹作为类别）/ "none"。
+    progress(done, total)：每批完成后回调。
+    """
+    batch_size = batch_size or ZIP_IMPORT_BATCH_SIZE
+    results = []
+    with zipfile.ZipFile(_as_binary_stream(zip_source)) as archive:
+        members = list_zip_import_members(archive)
+        total = len(members)
+        done = 0
+        for start in range(0, total, batch_size):
+            if quota_status() == "hard":
+                # 配额已满：剩余条目不再解压
+                results.extend(
+                    {"file": _zip_member_name(info), "success": False, "message": "存储配额已满，已停止导入"}
+                    for info in members[start:]
+                )
+                break
+            batch = []
+            try:
+                for info in members[start:start + batch_size]:
+                    name = _zip_member_name(info)
+                    if ZIP_MAX_ENTRY_BYTES and info.file_size > ZIP_MAX_ENTRY_BYTES:
+                        results.append({"file": name, "success": False, "message": f"文件过大（{format_bytes(info.file_size)}）"})
+                        continue
+                    extra_tags, category = _folder_metadata(name, folder_mode)
+                    member = _ArchiveMember(name, extra_tags, category)
+                    # 单个条目损坏（CRC 错误、加密、不支持的压缩方式）只记这一条失败，同批其余条目照常导入
+                    try:
+                        with archive.open(info) as src:
+                            shutil.copyfileobj(src, member, UPLOAD_CHUNK_SIZE)
+                    except Exception as exc:
+                        member.close()
+                        results.append({"file": name, "success": False, "message": f"解压失败：{exc}"})
+                        continue
+                    member.seek(0)
+                    batch.append(member)
+                results.extend(import_legacy_records_preserve_original(batch, **import_kwargs))
+            except Exception as exc:
+                results.extend({"file": m.name, "success": False, "message": str(exc)} for m in batch)
+            finally:
+                for member in batch:
+                    member.close()
+            done = min(total, start + batch_size)
+            if progress:
+                progress(done, total)
+    return results
+
 # ==================== 导出功能 ====================
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+EXPORT_CHUNK_SIZE = int(str(_get_setting("LAB_DIARY_EXPORT_CHUNK_SIZE", "50")).strip() or "50")
+EXPORT_SPOOL_BYTES = 16 * 1024 * 1024
+# 已压缩的图片格式写入压缩包时直接存储
+STORED_ASSET_EXTS = set(IMAGE_MIME_MAP) - {".bmp", ".tif", ".tiff", ".svg"}
+
 def build_record_markdown(row):
     row = normalize_task_row(row)
     details = row.get("details") or "(暂无实验记录)"
@@ -857,15 +3222,228 @@ def build_record_markdown(row):
     ]
     return "\n".join(md)
 
-def build_record_docx_bytes(row):
+def _docx_style_ids(doc) -> dict:
+    """小写样式名 → styleId，供批量写段落时直接引用"""
+    return {name: style_id for style_id, name in _docx_style_names(doc).items() if style_id}
+
+def _add_docx_paragraph(doc, text: str = "", style: str | None = None, style_ids: dict | None = None):
+    """追加段落；有 style_ids 时直接写 styleId，跳过 python-docx 每段的线性样式查找"""
+    style_id = style_ids.get(style.lower()) if style and style_ids else None
+    if style and not style_id:
+        return doc.add_paragraph(text, style)
+    paragraph = doc.add_paragraph(text)
+    if style_id:
+        paragraph._p.style = style_id
+    return paragraph
+
+MD_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+MD_LIST_RE = re.compile(r"^(\s*)([-*+]|\d+[.)])\s+(.*)$")
+MD_TABLE_SEP_RE = re.compile(r"^\s*\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?\s*$")
+MD_INLINE_RE = re.compile(r"(\*\*[^*]+\*\*|`[^`]+`|\*[^*\s][^*]*\*)")
+DOCX_NATIVE_IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff"}
+
+def _split_markdown_row(line: str) -> list[str]:
+    cells = re.split(r"(?<!\\)\|", line.strip().strip("|"))
+    return [cell.strip().replace("\\|", "|") for cell in cells]
+
+def _add_markdown_runs(paragraph, text: str) -> None:
+    """行内 **粗体**、*斜体*、`代码` 拆成不同格式的 run"""
+    for part in MD_INLINE_RE.split(text):
+        if not part:
+            continue
+        if part.startswith("**") and part.endswith("**") and len(part) > 4:
+            paragraph.add_run(part[2:-2]).bold = True
+        elif part.startswith("`") and part.endswith("`") and len(part) > 2:
+            paragraph.add_run(part[1:-1]).font.name = "Consolas"
+        elif part.startswith("*") and part.endswith("*") and len(part) > 2:
+            paragraph.add_run(part[1:-1]).italic = True
+        else:
+            paragraph.add_run(part)
+
+def _image_bytes_to_png(stream) -> bytes | None:
+    if not HAS_PIL:
+        return None
+    try:
+        with Image.open(stream) as img:
+            img.load()
+            converted = BytesIO()
+            _image_mode_for_format(img, "PNG").save(converted, "PNG")
+    except Exception:
+        return None
+    return converted.getvalue()
+
+# 同一张图片在一次归档导出里反复出现时，只解码转换一次
+@functools.lru_cache(maxsize=16)
+def _upload_png_for_docx(path: str, mtime_ns: int, size: int) -> bytes | None:
+    with open(path, "rb") as handle:
+        return _image_bytes_to_png(handle)
+
+# 内嵌图片按内容摘要缓存转换结果，不把几 MB 的 data URI 字符串本身留作缓存键
+_INLINE_PNG_CACHE: OrderedDict[str, bytes | None] = OrderedDict()
+_INLINE_PNG_CACHE_LOCK = threading.Lock()
+_INLINE_PNG_CACHE_MAX = 16
+
+def _inline_png_for_docx(payload: str) -> bytes | None:
+    digest = hashlib.sha256(payload.encode("ascii", "ignore")).hexdigest()
+    with _INLINE_PNG_CACHE_LOCK:
+        if digest in _INLINE_PNG_CACHE:
+            _INLINE_PNG_CACHE.move_to_end(digest)
+            return _INLINE_PNG_CACHE[digest]
+    try:
+        data = _image_bytes_to_png(BytesIO(base64.b64decode(payload)))
+    except (ValueError, TypeError):
+        data = None
+    with _INLINE_PNG_CACHE_LOCK:
+        _INLINE_PNG_CACHE[digest] = data
+        while len(_INLINE_PNG_CACHE) > _INLINE_PNG_CACHE_MAX:
+            _INLINE_PNG_CACHE.popitem(last=False)
+    return data
+
+def _docx_image_stream(target: str):
+    """把 Markdown 图片地址解析为 Word 能嵌入的图片流；WebP/SVG 等先转成 PNG"""
+    data_match = DATA_URI_RE.match(target)
+    if data_match:
+        ext = next((e for e, m in IMAGE_MIME_MAP.items() if m == data_match.group(1)), "")
+        if ext not in DOCX_NATIVE_IMAGE_EXTS:
+            data = _inline_png_for_docx(data_match.group(2))
+            return BytesIO(data) if data else None
+        try:
+            return BytesIO(base64.b64decode(data_match.group(2)))
+        except (ValueError, TypeError):
+            return None
+    local = _resolve_local_upload(target)
+    if not local:
+        return None
+    if os.path.splitext(local)[1].lower() in DOCX_NATIVE_IMAGE_EXTS:
+        return open(local, "rb")
+    stat = os.stat(local)
+    data = _upload_png_for_docx(local, stat.st_mtime_ns, stat.st_size)
+    return BytesIO(data) if data else None
+
+def _add_docx_image(doc, target: str, alt: str, max_width: int) -> bool:
+    """
+    嵌入图片并按版心宽度等比缩小。python-docx 按内容 SHA1 复用同一图片部件，
+    同一文档里重复出现的图片只存一份。
+    """
+    stream = _docx_image_stream(target)
+    if stream is None:
+        return False
+    try:
+        with stream:
+            shape = doc.add_paragraph().add_run().add_picture(stream)
+    except Exception:
+        return False
+    if max_width and shape.width > max_width:
+        shape.height = int(shape.height * max_width / shape.width)
+        shape.width = max_width
+    if alt:
+        shape._inline.docPr.set("descr", alt)
+    return True
+
+def render_markdown_to_docx(doc, markdown_text: str, style_ids: dict | None = None, heading_offset: int = 2) -> None:
+    """把记录正文的 Markdown 渲染为段落：标题、列表、引用、代码块、表格与图片"""
+    section = doc.sections[-1]
+    max_width = section.page_width - section.left_margin - section.right_margin
+    lines = (markdown_text or "").splitlines()
+    buffer = []
+
+    def flush():
+        if buffer:
+            paragraph = doc.add_paragraph()
+            _add_markdown_runs(paragraph, "\n".join(buffer))
+            buffer.clear()
+
+    idx = 0
+    while idx < len(lines):
+        line = lines[idx]
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            flush()
+            code = []
+            idx += 1
+            while idx < len(lines) and not lines[idx].strip().startswith("```"):
+                code.append(lines[idx])
+                idx += 1
+            doc.add_paragraph().add_run("\n".join(code)).font.name = "Consolas"
+            idx += 1
+            continue
+        if not stripped or re.fullmatch(r"(-{3,}|\*{3,}|_{3,})", stripped):
+            flush()
+            idx += 1
+            continue
+        if stripped.startswith("|") and idx + 1 < len(lines) and MD_TABLE_SEP_RE.match(lines[idx + 1]):
+            flush()
+            rows = [_split_markdown_row(stripped)]
+            idx += 2
+            while idx < len(lines) and lines[idx].strip().startswith("|"):
+                rows.append(_split_markdown_row(lines[idx]))
+                idx += 1
+            width = max(len(r) for r in rows)
+            table = doc.add_table(rows=len(rows), cols=width)
+            table.style = "Table Grid"
+            for row_idx, (table_row, values) in enumerate(zip(table.rows, rows)):
+                for cell, value in zip(table_row.cells, values):
+                    paragraph = cell.paragraphs[0]
+                    _add_markdown_runs(paragraph, value)
+                    if row_idx == 0:
+                        for run in paragraph.runs:
+                            run.bold = True
+            continue
+        image_match = MARKDOWN_IMAGE_RE.fullmatch(stripped)
+        if image_match:
+            flush()
+            alt, target = image_match.group(1), image_match.group(2)
+            if not _add_docx_image(doc, target, alt, max_width):
+                doc.add_paragraph(f"[图片：{alt or os.path.basename(target)[:80]}]")
+            idx += 1
+            continue
+        heading = MD_HEADING_RE.match(stripped)
+        if heading:
+            flush()
+            level = min(len(heading.group(1)) + heading_offset, 9)
+            _add_docx_paragraph(doc, heading.group(2).strip(), f"Heading {level}", style_ids)
+            idx += 1
+            continue
+        list_match = MD_LIST_RE.match(line)
+        if list_match:
+            flush()
+            depth = min(len(list_match.group(1).expandtabs(4)) // 2, 2)
+            style = "List Bullet" if list_match.group(2) in "-*+" else "List Number"
+            if depth:
+                style = f"{style} {depth + 1}"
+            _add_markdown_runs(_add_docx_paragraph(doc, "", style, style_ids), list_match.group(3))
+            idx += 1
+            continue
+        if stripped.startswith(">"):
+            flush()
+            _add_markdown_runs(_add_docx_paragraph(doc, "", "Quote", style_ids), stripped.lstrip("> ").strip())
+            idx += 1
+            continue
+        if len(stripped) > 2 and stripped[0] == stripped[-1] == "_":
+            flush()
+            doc.add_paragraph().add_run(stripped[1:-1]).italic = True
+            idx += 1
+            continue
+        buffer.append(stripped)
+        idx += 1
+    flush()
+
+def append_record_to_docx(doc, row, style_ids: dict | None = None):
+    """把一条记录写入 DOCX 文档对象"""
     row = normalize_task_row(row)
-    doc = Document()
-    doc.add_heading(row.get("task_name", "实验记录"), level=1)
+    _add_docx_paragraph(doc, row.get("task_name", "实验记录"), "Heading 1", style_ids)
     doc.add_paragraph(f"日期：{row.get('date', '-')}")
     doc.add_paragraph(f"类型：{row.get('category', '-')}")
     doc.add_paragraph(f"标签：{row.get('tags') or '-'}")
-    doc.add_heading("实验记录", level=2)
-    doc.add_paragraph(row.get("details") or "(暂无实验记录)")
+    _add_docx_paragraph(doc, "实验记录", "Heading 2", style_ids)
+    if row.get("details"):
+        render_markdown_to_docx(doc, row["details"], style_ids)
+    else:
+        doc.add_paragraph("(暂无实验记录)")
+
+def build_record_docx_bytes(row):
+    doc = Document()
+    append_record_to_docx(doc, row)
     bio = BytesIO()
     doc.save(bio)
     return bio.getvalue()
@@ -877,7 +3455,7 @@ def get_record_exports(row):
     docx_bytes = build_record_docx_bytes(row)
     return [
         ("MD", f"{base}.md", markdown_bytes, "text/markdown"),
-        ("DOCX", f"{base}.docx", docx_bytes, "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+        ("DOCX", f"{base}.docx", docx_bytes, DOCX_MIME),
     ]
 
 # ==================== Streamlit UI 组件 ====================
@@ -1045,11 +3623,22 @@ def show_record_editor_dialog(task_id: int):
         st.info("📎 附件上传")
         uploads = st.file_uploader("选择文件", accept_multiple_files=True, key=f"upload_{task_id}")
         if uploads:
+            # 每次 rerun 都会重新拿到同一批文件：按 file_id 记住已处理结果，避免重复哈希/写盘
+            handled = st.session_state.setdefault(f"upload_snippets_{task_id}", {})
             for f in uploads:
-                save_path, display_name = get_versioned_upload_path(f.name)
-                with open(save_path, "wb") as w:
-                    w.write(f.getbuffer())
-                snippet = f"![{display_name}]({save_path})" if f.type and f.type.startswith("image") else f"[{display_name}]({save_path})"
+                file_key = getattr(f, "file_id", None) or f"{f.name}:{f.size}"
+                snippet = handled.get(file_key)
+                if snippet is None:
+                    try:
+                        save_path, display_name, _ = store_upload_stream(f, f.name)
+                    except OSError as e:
+                        st.error(f"{f.name}: {e}")
+                        continue
+                    link_path = save_path.replace("\\", "/")
+                    snippet = f"![{display_name}]({link_path})" if f.type and f.type.startswith("image") else f"[{display_name}]({link_path})"
+                    handled[file_key] = snippet
+                    if f.type and f.type.startswith("image"):
+                        ensure_image_preview(save_path, os.path.splitext(display_name)[0])
                 st.code(snippet)
 
 @st.dialog("🤖 AI 任务预览与确认", width="large")
@@ -1199,6 +3788,19 @@ def render_sidebar():
         """, unsafe_allow_html=True)
         if storage.get("user_label") and storage["user_label"] != "local":
             st.caption(f"当前用户：{storage['user_label']}")
+        usage = get_shard_usage(storage)
+        usage_text = (
+            f"存储 {format_bytes(usage['total_bytes'])}"
+            f"（数据库 {format_bytes(usage['db_bytes'])} · 附件 {format_bytes(usage['upload_bytes'])} · 备份 {format_bytes(usage['backup_bytes'])}）"
+        )
+        if usage["hard_bytes"]:
+            st.progress(min(1.0, usage["total_bytes"] / usage["hard_bytes"]), text=f"{usage_text} / {format_bytes(usage['hard_bytes'])}")
+        else:
+            st.caption(usage_text)
+        if usage["level"] == "hard":
+            st.error("存储配额已满：上传与导入已暂停，请清理附件或备份")
+        elif usage["level"] == "soft":
+            st.warning("存储用量已超过提醒线，接近配额上限")
         
         st.divider()
         
@@ -1245,7 +3847,8 @@ def render_sidebar():
                     st.error("AI 服务未配置")
                 else:
                     with st.spinner("AI 正在分析..."):
-                        tasks = ai_parse_schedule(client, user_prompt)
+                        attachment_notes = build_attachment_notes(uploaded_files) if uploaded_files else None
+                        tasks = ai_parse_schedule(client, user_prompt, attachment_notes)
                         if tasks:
                             for task in tasks:
                                 task['task_name'] = shorten_task_name(task.get('task_name', ''))
@@ -1255,6 +3858,50 @@ def render_sidebar():
         
         return page
 
+def build_calendar_events(df: pd.DataFrame) -> list[dict]:
+    """把任务表转换为 FullCalendar 事件：颜色、标题前缀、摘要按列整体计算，最后一次性组装"""
+    if df.empty:
+        return []
+    category_color = {
+        "科研": COLORS["research"],
+        "临床": COLORS["clinical"],
+        "课程": COLORS["course"],
+        "其他": COLORS["other"],
+    }
+    details = df["details"].fillna("").astype(str).str.strip()
+    filled = details.str.len() > 0
+    colors = df["category"].fillna("").astype(str).str.strip().map(category_color).fillna(COLORS["other"])
+    head = details.str.slice(0, 80)
+    previews = head.where(details.str.len() <= 80, head + "...")
+    names = df["task_name"].fillna("")
+    titles = filled.map({True: "✅ ", False: "⬜ "}) + names.astype(str)
+    columns = zip(
+        df["id"].astype(int).tolist(), titles.tolist(), df["date"].tolist(), colors.tolist(),
+        names.tolist(), df["category"].tolist(), df["tags"].fillna("").tolist(),
+        df["is_done"].fillna(0).astype(bool).tolist(), filled.tolist(), previews.tolist(),
+    )
+    return [
+        {
+            "id": str(task_id),
+            "title": title,
+            "start": date,
+            "backgroundColor": color,
+            "borderColor": color,
+            "allDay": True,
+            "extendedProps": {
+                "task_id": task_id,
+                "task_name": name,
+                "date": date,
+                "category": category,
+                "tags": tags,
+                "is_done": is_done,
+                "details_filled": record_done,
+                "details_preview": preview,
+            },
+        }
+        for task_id, title, date, color, name, category, tags, is_done, record_done, preview in columns
+    ]
+
 def render_calendar_page():
     """渲染日历页面"""
     st.markdown(f"""
@@ -1304,44 +3951,17 @@ def render_calendar_page():
         params.append(category_filter)
 
     where_sql = (" WHERE " + " AND ".join(where_parts)) if where_parts else ""
-    df = run_query("SELECT * FROM tasks" + where_sql + " ORDER BY date", tuple(params), fetch=True)
     df_list = run_query("SELECT * FROM tasks" + where_sql + " ORDER BY date DESC, id DESC", tuple(params), fetch=True)
-    events = []
-    
-    if not df.empty:
-        category_color = {
-            "科研": COLORS["research"],
-            "临床": COLORS["clinical"],
-            "课程": COLORS["course"],
-            "其他": COLORS["other"],
-        }
-        for _, r in df.iterrows():
-            task_id = int(r['id'])
-            color = category_color.get(str(r.get("category", "")).strip(), COLORS["other"])
-            
-            details_text = (r['details'] or "").strip()
-            record_done = bool(details_text)
-            prefix = "✅ " if record_done else "⬜ "
-            
-            event = {
-                "id": str(task_id),
-                "title": prefix + r['task_name'],
-                "start": r['date'],
-                "backgroundColor": color,
-                "borderColor": color,
-                "allDay": True,
-                "extendedProps": {
-                    "task_id": task_id,
-                    "task_name": r['task_name'],
-                    "date": r['date'],
-                    "category": r['category'],
-                    "tags": r['tags'] or "",
-                    "is_done": bool(r['is_done']),
-                    "details_filled": record_done,
-                    "details_preview": details_text[:80] + "..." if len(details_text) > 80 else details_text
-                }
-            }
-            events.append(event)
+    # 悬停、勾选等 rerun 不改数据时直接复用上次构建的事件列表
+    db_path = get_storage_paths()["db_path"]
+    events_key = (os.path.realpath(db_path), search_term, category_filter, shard_data_version(db_path))
+    cached_events = st.session_state.get("calendar_events_cache")
+    if cached_events and cached_events[0] == events_key:
+        events = cached_events[1]
+    else:
+        df = run_query("SELECT * FROM tasks" + where_sql + " ORDER BY date", tuple(params), fetch=True)
+        events = build_calendar_events(df)
+        st.session_state["calendar_events_cache"] = (events_key, events)
     
     # 渲染日历（移除右侧快速统计栏）
     cal = calendar(
@@ -1433,6 +4053,7 @@ def main():
     setup_page_config()
     init_and_migrate_db()
     auto_backup()
+    schedule_maintenance()
     
     # 初始化会话状态
     if "nav_page" not in st.session_state:
@@ -1513,9 +4134,26 @@ def _paragraph_is_list(paragraph: Paragraph) -> bool:
         return False
     return p.pPr.numPr is not None
 
-def _paragraph_is_code(paragraph: Paragraph) -> bool:
+def _docx_style_names(doc) -> dict:
+    """一次性建立段落 styleId → 小写样式名映射，避免 python-docx 每段线性查找样式"""
+    names = {}
+    for style in doc.styles:
+        if style.type == WD_STYLE_TYPE.PARAGRAPH:
+            names[style.style_id] = (style.name or "").lower()
+    default = doc.styles.default(WD_STYLE_TYPE.PARAGRAPH)
+    names[None] = (default.name or "").lower() if default is not None else ""
+    return names
+
+def _paragraph_style_name(paragraph: Paragraph, style_names: dict | None = None) -> str:
+    if style_names is None:
+        return (paragraph.style.name or "").lower() if paragraph.style and paragraph.style.name else ""
+    style_id = paragraph._p.style
+    return style_names.get(style_id, style_names.get(None, ""))
+
+def _paragraph_is_code(paragraph: Paragraph, style_name: str | None = None) -> bool:
     """判断段落是否为代码块"""
-    style_name = (paragraph.style.name or "").lower() if paragraph.style else ""
+    if style_name is None:
+        style_name = _paragraph_style_name(paragraph)
     code_keywords = ("code", "等宽", "monospace")
     if any(token in style_name for token in code_keywords):
         return True
@@ -1537,97 +4175,193 @@ def _heading_level_from_style(style_name: str) -> int:
             pass
     return 1
 
-def _docx_paragraph_to_markdown(paragraph: Paragraph) -> str:
+def _docx_paragraph_to_markdown(paragraph: Paragraph, style_names: dict | None = None) -> str:
     """将DOCX段落转换为Markdown"""
     text = paragraph.text.strip()
     if not text:
         return ""
-    style_name = (paragraph.style.name or "").lower() if paragraph.style and paragraph.style.name else ""
+    style_name = _paragraph_style_name(paragraph, style_names)
     if "heading" in style_name or "标题" in style_name:
         level = _heading_level_from_style(style_name)
         return f"{'#' * level} {text}"
-    if _paragraph_is_code(paragraph):
+    if _paragraph_is_code(paragraph, style_name):
         return f"```\n{text}\n```"
     if _paragraph_is_list(paragraph) or "list" in style_name or "列表" in style_name:
         return f"- {text}"
     return text
 
-def _docx_table_to_markdown(table: Table) -> str:
-    """将DOCX表格转换为Markdown"""
-    rows = []
-    for row in table.rows:
-        cells = []
-        for cell in row.cells:
-            cell_text = cell.text.strip()
-            cell_text = cell_text.replace("\n", "<br>")
-            cells.append(cell_text or " ")
-        rows.append(cells)
-    if not rows:
-        return ""
-    header = rows[0]
-    divider = ["---"] * len(header)
-    body = rows[1:] or [[]]
-    lines = [
-        "| " + " | ".join(header) + " |",
-        "| " + " | ".join(divider) + " |",
-    ]
-    if body and body[0]:
-        for row in body:
-            padded = row + [" "] * (len(header) - len(row))
-            lines.append("| " + " | ".join(padded[:len(header)]) + " |")
-    return "\n".join(lines)
+W_TR = qn("w:tr")
+W_TC = qn("w:tc")
+W_P = qn("w:p")
+W_SDT = qn("w:sdt")
+W_SDT_CONTENT = qn("w:sdtContent")
+W_TRPR = qn("w:trPr")
+W_TCPR = qn("w:tcPr")
+W_GRID_BEFORE = qn("w:gridBefore")
+W_GRID_SPAN = qn("w:gridSpan")
+W_VMERGE = qn("w:vMerge")
+W_VAL = qn("w:val")
+W_TEXT_TAGS = {qn("w:t"): None, qn("w:tab"): "\t", qn("w:br"): "\n", qn("w:cr"): "\n"}
 
-def _collect_docx_image_markdown(docx_bytes: bytes, origin_name: str) -> list[str]:
-    """从DOCX中提取图片"""
-    images = []
-    label_prefix = sanitize_filename(os.path.splitext(origin_name)[0] or "legacy_doc")
-    with zipfile.ZipFile(BytesIO(docx_bytes)) as archive:
-        for entry in archive.infolist():
-            if entry.is_dir():
-                continue
-            if not entry.filename.startswith("word/media/"):
+
+def _docx_cell_text(tc) -> str:
+    """与 python-docx 的 cell.text 一致：只取单元格直属段落，段落间换行"""
+    paragraphs = []
+    for p in tc.iterchildren(W_P):
+        parts = []
+        for node in p.iter(*W_TEXT_TAGS):
+            fixed = W_TEXT_TAGS[node.tag]
+            parts.append(fixed if fixed is not None else (node.text or ""))
+        paragraphs.append("".join(parts))
+    return "\n".join(paragraphs)
+
+
+def _iter_row_cells(tr):
+    """行内单元格：直属 w:tc，以及内容控件 w:sdt 包裹的 w:tc"""
+    for child in tr.iterchildren(W_TC, W_SDT):
+        if child.tag == W_TC:
+            yield child
+        else:
+            content = child.find(W_SDT_CONTENT)
+            if content is not None:
+                yield from content.iterchildren(W_TC)
+
+
+def _iter_docx_table_rows(tbl):
+    """
+    直接遍历 w:tr / w:tc 产出每行文本，单行工作量只与该行单元格数有关。
+    gridSpan 横向合并按 python-docx 的习惯在每个网格列重复文本；
+    vMerge 续接单元格沿用同一列上方起始单元格的文本；gridBefore 补空列。
+    """
+    merged_above = {}
+    for tr in tbl.iterchildren(W_TR):
+        row = []
+        trPr = tr.find(W_TRPR)
+        if trPr is not None:
+            before = trPr.find(W_GRID_BEFORE)
+            if before is not None:
+                row.extend([""] * int(before.get(W_VAL, "0") or 0))
+        for tc in _iter_row_cells(tr):
+            span = 1
+            vmerge = None
+            tcPr = tc.find(W_TCPR)
+            if tcPr is not None:
+                grid_span = tcPr.find(W_GRID_SPAN)
+                if grid_span is not None:
+                    span = max(1, int(grid_span.get(W_VAL, "1") or 1))
+                v_merge = tcPr.find(W_VMERGE)
+                if v_merge is not None:
+                    vmerge = v_merge.get(W_VAL, "continue")
+            col = len(row)
+            if vmerge == "continue":
+                text = merged_above.get(col, "")
+            else:
+                text = _docx_cell_text(tc)
+                if vmerge == "restart":
+                    merged_above[col] = text
+                else:
+                    merged_above.pop(col, None)
+            row.extend([text] * span)
+        yield row
+
+
+def _markdown_table_cell(text: str) -> str:
+    text = text.strip().replace("|", "\\|").replace("\n", "<br>")
+    return text or " "
+
+
+def iter_docx_table_markdown_lines(table):
+    """流式产出 Markdown 表格行；列数以首行为准，其余行补齐或截断"""
+    tbl = getattr(table, "_tbl", table)
+    width = None
+    for row in _iter_docx_table_rows(tbl):
+        cells = [_markdown_table_cell(text) for text in row]
+        if width is None:
+            if not cells:
                 continue
-            data = archive.read(entry.filename)
-            img_name = os.path.basename(entry.filename)
-            images.append(_persist_image_as_markdown(data, f"{label_prefix}_{img_name}"))
-    return images
+            width = len(cells)
+            yield "| " + " | ".join(cells) + " |"
+            yield "| " + " | ".join(["---"] * width) + " |"
+            continue
+        padded = cells + [" "] * (width - len(cells))
+        yield "| " + " | ".join(padded[:width]) + " |"
+
+
+def _docx_table_to_markdown(table) -> str:
+    """将DOCX表格转换为Markdown"""
+    return "\n".join(iter_docx_table_markdown_lines(table))
+
+
+DOCX_IMAGE_REF_ATTRS = {
+    qn("a:blip"): qn("r:embed"),
+    "{urn:schemas-microsoft-com:vml}imagedata": qn("r:id"),
+}
+
+
+def _docx_image_rids(element) -> list[str]:
+    """按文档顺序列出元素内引用的图片关系 ID（DrawingML 与旧式 VML）"""
+    rids = []
+    for node in element.iter(*DOCX_IMAGE_REF_ATTRS):
+        rid = node.get(DOCX_IMAGE_REF_ATTRS[node.tag])
+        if rid:
+            rids.append(rid)
+    return rids
 
-def _pandoc_convert(data_bytes: bytes, source_ext: str, target: str) -> bytes | None:
-    """使用Pandoc转换文档"""
+PANDOC_TIMEOUT = float(str(_get_setting("LAB_DIARY_PANDOC_TIMEOUT", "90")).strip() or "90")
+
+
+def _pandoc_convert(data_source, source_ext: str, target: str):
+    """
+    使用Pandoc转换文档（输入分块写入临时文件）。
+    target="docx" 时返回指向结果的 SpooledTemporaryFile，其余返回 UTF-8 bytes。
+    直接以子进程运行 pandoc，超过 LAB_DIARY_PANDOC_TIMEOUT 秒即终止。
+    """
     if not HAS_PYPANDOC:
         return None
+    try:
+        pandoc_path = pypandoc.get_pandoc_path()
+    except OSError:
+        return None
     suffix = source_ext if source_ext.startswith(".") else f".{source_ext}"
-    tmp_in = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    tmp_in.write(data_bytes)
-    tmp_in.close()
+    tmp_in_path = _copy_stream_to_tempfile(data_source, suffix)
+    out_suffix = ".docx" if target == "docx" else ".md"
+    fd, tmp_out_path = tempfile.mkstemp(suffix=out_suffix)
+    os.close(fd)
     try:
-        if target == "docx":
-            tmp_out = tempfile.NamedTemporaryFile(delete=False, suffix=".docx")
-            tmp_out_path = tmp_out.name
-            tmp_out.close()
-            pypandoc.convert_file(tmp_in.name, to="docx", format=source_ext.lstrip("."), outputfile=tmp_out_path)
-            with open(tmp_out_path, "rb") as fh:
-                return fh.read()
-        else:
-            result = pypandoc.convert_file(tmp_in.name, to=target, format=source_ext.lstrip("."))
-            return result.encode("utf-8")
-    except (OSError, RuntimeError):
+        subprocess.run(
+            [
+                pandoc_path, tmp_in_path,
+                "-f", pypandoc.normalize_format(source_ext.lstrip(".")),
+                "-t", pypandoc.normalize_format(target),
+                "-o", tmp_out_path,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=PANDOC_TIMEOUT,
+        )
+        with open(tmp_out_path, "rb") as fh:
+            if target == "docx":
+                return _spool_stream(fh)
+            return fh.read()
+    except (OSError, subprocess.SubprocessError):
         return None
     finally:
-        try:
-            os.remove(tmp_in.name)
-        except OSError:
-            pass
+        for path in (tmp_in_path, tmp_out_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-def _convert_doc_via_win32(data_bytes: bytes) -> bytes | None:
-    """在Windows环境下将DOC转为DOCX"""
+def _convert_doc_via_win32(data_source):
+    """在Windows环境下将DOC转为DOCX，返回 SpooledTemporaryFile"""
     if not HAS_WIN32_COM:
         return None
     temp_dir = tempfile.mkdtemp()
     doc_path = os.path.join(temp_dir, "legacy.doc")
     docx_path = os.path.join(temp_dir, "legacy.docx")
     with open(doc_path, "wb") as fh:
-        fh.write(data_bytes)
+        shutil.copyfileobj(_as_binary_stream(data_source), fh, UPLOAD_CHUNK_SIZE)
     converted = None
     word = None
     doc_obj = None
@@ -1641,7 +4375,7 @@ def _convert_doc_via_win32(data_bytes: bytes) -> bytes | None:
         doc_obj.SaveAs(docx_path, FileFormat=16)
         doc_obj.Close(False)
         with open(docx_path, "rb") as fh:
-            converted = fh.read()
+            converted = _spool_stream(fh)
     except Exception:
         converted = None
     finally:
@@ -1693,12 +4427,20 @@ def render_archive_page():
     with st.expander("🪄 一键迁移历史记录", expanded=False):
         st.caption("支持 Markdown / Word / TXT / CSV 等格式，保留原始记录内容")
         
-        legacy_files = st.file_uploader(
-            "选择旧实验记录文件",
-            accept_multiple_files=True,
-            type=["md", "markdown", "txt", "csv", "tsv", "doc", "docx", "rtf"],
-            key="legacy_import_files"
-        )
+        import_mode = st.radio("导入方式", ["选择文件", "ZIP 压缩包（整个文件夹）"], horizontal=True, key="legacy_import_mode")
+        zip_mode = import_mode != "选择文件"
+        legacy_files = None
+        legacy_zip = None
+        if zip_mode:
+            legacy_zip = st.file_uploader("选择 ZIP 压缩包", type=["zip"], key="legacy_import_zip")
+            folder_choice = st.selectbox("文件夹路径用作", ["标签", "类别", "忽略"], key="legacy_zip_folder_mode")
+        else:
+            legacy_files = st.file_uploader(
+                "选择旧实验记录文件",
+                accept_multiple_files=True,
+                type=["md", "markdown", "txt", "csv", "tsv", "doc", "docx", "rtf"],
+                key="legacy_import_files"
+            )
         
         col1, col2, col3 = st.columns(3)
         legacy_category = col1.selectbox("导入类别", ["科研", "临床", "课程", "其他"], key="legacy_category")
@@ -1707,34 +4449,74 @@ def render_archive_page():
         
         use_ai = st.checkbox("使用AI提取元数据（推荐）", value=True, key="use_ai_metadata")
         filename_date = st.checkbox("尝试根据文件名推断日期", value=True, key="filename_date")
+        recompress = st.checkbox(
+            "压缩文档内嵌图片（缩小尺寸并转换格式）",
+            value=new_image_import_stage()["recompress"],
+            disabled=not HAS_PIL,
+            key="legacy_recompress_images"
+        )
         
         if st.button("🚀 开始迁移", type="primary", use_container_width=True):
-            if not legacy_files:
+            import_kwargs = dict(
+                default_category=legacy_category,
+                default_tags=legacy_tags,
+                default_date=legacy_date,
+                prefer_filename_date=filename_date,
+                use_ai_metadata=use_ai,
+                recompress_images=recompress
+            )
+            incoming = getattr(legacy_zip, "size", 0) if zip_mode and legacy_zip else sum(getattr(f, "size", 0) for f in legacy_files or [])
+            quota_state = quota_status(incoming)
+            if quota_state == "hard":
+                st.error("本次导入会超出存储配额，达到上限后剩余文件将被跳过")
+            elif quota_state == "soft":
+                st.warning("本次导入后存储用量将超过提醒线")
+            import_results = None
+            if zip_mode:
+                if not legacy_zip:
+                    st.warning("请先选择 ZIP 压缩包")
+                else:
+                    progress_bar = st.progress(0.0, text="正在读取压缩包...")
+                    import_results = import_legacy_zip_archive(
+                        legacy_zip,
+                        folder_mode={"标签": "tags", "类别": "category"}.get(folder_choice, "none"),
+                        progress=lambda done, total: progress_bar.progress(done / total if total else 1.0, text=f"已处理 {done}/{total} 个文件"),
+                        **import_kwargs
+                    )
+                    progress_bar.progress(1.0, text=f"完成，共 {len(import_results)} 个文件")
+            elif not legacy_files:
                 st.warning("请先选择至少一个文件")
             else:
                 with st.spinner("正在解析并导入历史记录..."):
-                    import_results = import_legacy_records_preserve_original(
-                        legacy_files,
-                        default_category=legacy_category,
-                        default_tags=legacy_tags,
-                        default_date=legacy_date,
-                        prefer_filename_date=filename_date,
-                        use_ai_metadata=use_ai
-                    )
-                
+                    import_results = import_legacy_records_preserve_original(legacy_files, **import_kwargs)
+            
+            if import_results is not None:
                 # 显示结果
                 success_items = [item for item in import_results if item.get("success")]
                 failure_items = [item for item in import_results if not item.get("success")]
                 
                 if success_items:
                     st.success(f"✅ 成功导入 {len(success_items)} 条记录")
-                    for item in success_items:
-                        with st.expander(f"✅ {item['file']}"):
-                            st.write(f"**任务名**: {item['task_name']}")
-                            st.write(f"**日期**: {item['date']}")
-                            st.write(f"**类别**: {item['category']}")
-                            st.write(f"**标签**: {item['tags']}")
-                            st.write(f"**预览**: {item['content_preview']}")
+                    saved_bytes = sum(item.get("image_bytes_saved", 0) for item in success_items)
+                    if recompress and saved_bytes >= 0:
+                        st.info(f"🗜️ 图片压缩共节省 {format_bytes(saved_bytes)}")
+                    elif recompress:
+                        st.info(f"🗜️ 保留了原图，图片占用净增加 {format_bytes(-saved_bytes)}（可关闭 LAB_DIARY_IMPORT_KEEP_ORIGINALS）")
+                    if zip_mode:
+                        # 压缩包可能有上千个文件，用表格汇总
+                        st.dataframe(
+                            pd.DataFrame(success_items)[["file", "date", "task_name", "category", "tags"]],
+                            hide_index=True,
+                            use_container_width=True
+                        )
+                    else:
+                        for item in success_items:
+                            with st.expander(f"✅ {item['file']}"):
+                                st.write(f"**任务名**: {item['task_name']}")
+                                st.write(f"**日期**: {item['date']}")
+                                st.write(f"**类别**: {item['category']}")
+                                st.write(f"**标签**: {item['tags']}")
+                                st.write(f"**预览**: {item['content_preview']}")
                 
                 if failure_items:
                     st.error(f"❌ {len(failure_items)} 个文件导入失败")
@@ -1776,6 +4558,51 @@ def render_archive_page():
                     use_container_width=True
                 )
     
+    # 存储占用与孤立附件清理
+    with st.expander("🧹 存储空间与附件清理", expanded=False):
+        report = get_shard_storage_report()
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("数据库", format_bytes(report["db_bytes"]))
+        m2.metric("附件", format_bytes(report["upload_bytes"]), f"{report['upload_count']} 个文件", delta_color="off")
+        m3.metric("预览图", format_bytes(report["preview_bytes"]))
+        m4.metric("备份", format_bytes(report["backup_bytes"]), f"{report['backup_count']} 个文件", delta_color="off")
+        maintenance = _MAINTENANCE_REPORTS.get(get_storage_paths()["db_path"], {})
+        backup_report = maintenance.get("backup")
+        if backup_report and backup_report.get("backups"):
+            rotation = backup_report["backups"]
+            st.caption(
+                f"最近一次备份维护（{backup_report['finished_at']}）：保留 {rotation['kept']} 份，"
+                f"压缩 {rotation['compressed']} 份，删除 {rotation['deleted']} 份，"
+                f"回收 {format_bytes(rotation['reclaimed_bytes'])}"
+            )
+        sqlite_report = maintenance.get("sqlite")
+        if sqlite_report:
+            st.caption(
+                f"最近一次数据库维护（{sqlite_report['finished_at']}）：{'、'.join(sqlite_report['actions'])}，"
+                f"回收 {format_bytes(sqlite_report['reclaimed_bytes'])}，用时 {sqlite_report['seconds']}s"
+            )
+
+        grace_days = st.number_input("宽限期（天）", min_value=0.0, value=float(GC_GRACE_DAYS), step=1.0, key="gc_grace_days")
+        col_dry, col_run = st.columns(2)
+        gc_result = None
+        if col_dry.button("🔍 扫描孤立附件（不删除）", use_container_width=True):
+            gc_result = collect_orphaned_uploads(grace_days, dry_run=True)
+        if col_run.button("🗑️ 删除超过宽限期的孤立附件", use_container_width=True):
+            gc_result = collect_orphaned_uploads(grace_days, dry_run=False)
+        if gc_result is not None:
+            if not gc_result["orphans"]:
+                st.success("没有发现孤立附件")
+            else:
+                st.dataframe(
+                    pd.DataFrame(gc_result["orphans"]).drop(columns=["path"]),
+                    hide_index=True,
+                    use_container_width=True
+                )
+                if gc_result["dry_run"]:
+                    st.info(f"可回收 {format_bytes(gc_result['expired_bytes'])}（仅统计超过宽限期的文件）")
+                else:
+                    st.success(f"已回收 {format_bytes(gc_result['reclaimed_bytes'])}")
+
     # 查询记录
     base_sql = "SELECT * FROM tasks WHERE category='科研' AND details!=''"
     params = []
@@ -1794,22 +4621,51 @@ def render_archive_page():
     if df.empty:
         st.info("📭 暂时没有符合条件的实验记录")
     else:
-        # 批量导出
+        # 批量导出：只生成选中的格式，分批写入临时文件
         st.markdown("### 📤 批量导出")
-        archive_exports = get_archive_exports(df.to_dict('records'))
-        
-        if archive_exports:
-            exp_cols = st.columns(len(archive_exports))
-            for col, item in zip(exp_cols, archive_exports):
-                label, fname, data, mime = item
-                with col:
+        exp_col1, exp_col2 = st.columns([2, 1])
+        with exp_col1:
+            export_format = st.radio(
+                "导出格式",
+                list(ARCHIVE_EXPORT_FORMATS),
+                horizontal=True,
+                key="archive_export_format"
+            )
+        with exp_col2:
+            build_export = st.button("📦 生成导出文件", use_container_width=True)
+        if build_export:
+            export_bar = st.progress(0.0, text="正在导出…")
+
+            def _export_progress(done, total):
+                export_bar.progress(min(1.0, done / max(total, 1)), text=f"已导出 {done}/{total} 条")
+
+            try:
+                fname, handle, mime = export_archive(
+                    export_format,
+                    base_sql + " ORDER BY date DESC",
+                    tuple(params),
+                    progress=_export_progress,
+                    total=len(df)
+                )
+            except Exception as exc:
+                st.error(f"导出失败：{exc}")
+            else:
+                with handle:
+                    # Streamlit 的下载按钮只能从内存提供文件（不接受临时文件对象，也不能分块发送）：
+                    # 这里只读一次交给它，下载期间整个归档仍驻留在服务器内存里；
+                    # 更大的归档请在服务器上用 admin.py export 直接写文件
+                    handle.seek(0, os.SEEK_END)
+                    archive_bytes = handle.tell()
+                    handle.seek(0)
                     st.download_button(
-                        f"📄 导出{label}",
-                        data,
+                        f"📄 下载{export_format}（{format_bytes(archive_bytes)}）",
+                        handle.read(),
                         file_name=fname,
                         mime=mime,
                         use_container_width=True
                     )
+                    if archive_bytes > EXPORT_SPOOL_BYTES:
+                        st.caption("归档较大：网页下载会把整个文件载入服务器内存，管理员可用 `python admin.py export` 直接导出到磁盘")
         
         st.divider()
         
@@ -1821,7 +4677,7 @@ def render_archive_page():
                 col1, col2 = st.columns([3, 1])
                 with col1:
                     st.caption(f"🏷️ 标签：{r['tags'] or '-'} · 📂 类型：{r['category']}")
-                    st.markdown(r['details'])
+                    render_markdown_with_previews(r['details'], key_prefix=f"archive_{r['id']}")
                 with col2:
                     if st.button("📝 编辑", key=f"edit_{r['id']}", use_container_width=True):
                         show_record_editor_dialog(int(r['id']))
@@ -1924,41 +4780,246 @@ def render_analytics_page():
         )
 
 # ==================== 导出功能（继续） ====================
-def build_archive_markdown(rows):
-    """构建归档Markdown"""
-    sections = [build_record_markdown(r) for r in rows]
-    return "\n\n---\n\n".join(sections)
+def write_archive_markdown(chunks, out, progress=None, total=None):
+    """逐批把记录写成 Markdown 追加到 out，返回写入条数"""
+    written = 0
+    for chunk in chunks:
+        for row in chunk:
+            if written:
+                out.write(b"\n\n---\n\n")
+            out.write(build_record_markdown(row).encode("utf-8"))
+            written += 1
+        if progress:
+            progress(written, total)
+    return written
 
-def build_archive_docx_bytes(rows):
-    """构建归档DOCX"""
-    doc = Document()
-    for idx, row in enumerate(rows):
-        if idx > 0:
-            doc.add_page_break()
-        row = normalize_task_row(row)
-        doc.add_heading(row.get("task_name", "实验记录"), level=1)
-        doc.add_paragraph(f"日期：{row.get('date', '-')}")
-        doc.add_paragraph(f"类型：{row.get('category', '-')}")
-        doc.add_paragraph(f"标签：{row.get('tags') or '-'}")
-        doc.add_heading("实验记录", level=2)
-        doc.add_paragraph(row.get("details") or "(暂无实验记录)")
+def _docx_stream_template():
+    """拆出空白模板的各部件，document.xml 以 <w:body> 和 <w:sectPr 为界分成头尾"""
     bio = BytesIO()
-    doc.save(bio)
-    return bio.getvalue()
+    Document().save(bio)
+    with zipfile.ZipFile(bio) as tpl:
+        parts = {info.filename: tpl.read(info) for info in tpl.infolist()}
+    document_xml = parts.pop("word/document.xml")
+    body_open = document_xml.index(b"<w:body>") + len(b"<w:body>")
+    sect_start = document_xml.rindex(b"<w:sectPr")
+    return parts, document_xml[:body_open], document_xml[sect_start:]
 
-def get_archive_exports(rows):
-    """获取归档导出数据"""
-    if not rows:
-        return []
-    rows = [normalize_task_row(r) for r in rows]
-    timestamp = datetime.now().strftime("%Y%m%d")
-    base = f"lab_archive_{timestamp}"
-    md_bytes = build_archive_markdown(rows).encode("utf-8")
-    docx_bytes = build_archive_docx_bytes(rows)
-    return [
-        ("MD", f"{base}.md", md_bytes, "text/markdown"),
-        ("DOCX", f"{base}.docx", docx_bytes, "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
-    ]
+def _docx_body_fragment(doc) -> bytes:
+    """序列化临时文档 body 内除 sectPr 外的全部内容（命名空间已由模板根节点声明）"""
+    body = doc.element.body
+    for sect in body.findall(qn("w:sectPr")):
+        body.remove(sect)
+    if not len(body):
+        return b""
+    xml = etree.tostring(body, encoding="utf-8")
+    return xml[xml.index(b">") + 1:xml.rindex(b"</w:body>")]
+
+def _move_docx_images(scratch, zout, images: dict) -> None:
+    """
+    把临时文档的图片部件并入输出包：按 SHA1 去重，跨批次重复的图片只写一次，
+    并把 body 里的 r:embed 改成全局关系 ID。
+    """
+    remap = {}
+    for rid, rel in scratch.part.rels.items():
+        if rel.reltype != RT.IMAGE or rel.is_external:
+            continue
+        part = rel.target_part
+        entry = images.get(part.sha1)
+        if entry is None:
+            ext = os.path.splitext(str(part.partname))[1].lower()
+            entry = (f"rIdImg{len(images) + 1}", f"media/image{len(images) + 1}{ext}", part.content_type)
+            compress = zipfile.ZIP_STORED if ext in STORED_ASSET_EXTS else zipfile.ZIP_DEFLATED
+            zout.writestr(f"word/{entry[1]}", part.blob, compress_type=compress)
+            images[part.sha1] = entry
+        remap[rid] = entry[0]
+    if not remap:
+        return
+    embed = qn("r:embed")
+    for blip in scratch.element.body.iter(qn("a:blip")):
+        rid = blip.get(embed)
+        if rid in remap:
+            blip.set(embed, remap[rid])
+
+def _docx_package_index(parts: dict, images: dict) -> tuple[bytes, bytes]:
+    """在模板的 document.xml.rels 与 [Content_Types].xml 里登记图片"""
+    rels = parts["word/_rels/document.xml.rels"]
+    entries = "".join(
+        f'<Relationship Id="{rid}" Type="{RT.IMAGE}" Target="{target}"/>'
+        for rid, target, _ in images.values()
+    )
+    rels = rels.replace(b"</Relationships>", entries.encode("utf-8") + b"</Relationships>")
+    types = parts["[Content_Types].xml"]
+    defaults = {}
+    for _, target, content_type in images.values():
+        ext = os.path.splitext(target)[1].lstrip(".")
+        if f'Extension="{ext}"'.encode("utf-8") not in types:
+            defaults[ext] = content_type
+    entries = "".join(f'<Default Extension="{ext}" ContentType="{ct}"/>' for ext, ct in defaults.items())
+    types = types.replace(b"</Types>", entries.encode("utf-8") + b"</Types>")
+    return rels, types
+
+def write_archive_docx(chunks, out, progress=None, total=None):
+    """
+    流式生成归档 DOCX：每批记录写进一个临时 Document，只序列化其 body 片段
+    追加到 word/document.xml，内存占用与归档总量无关。
+    图片按内容去重后写入 word/media，关系表与内容类型最后补写。
+    """
+    parts, head, tail = _docx_stream_template()
+    written = 0
+    images = {}
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for name, data in parts.items():
+            if name not in ("word/_rels/document.xml.rels", "[Content_Types].xml"):
+                zout.writestr(name, data)
+        # 图片部件要边渲染边写进包里，正文先暂存到临时文件，最后整体拷入 document.xml
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as body:
+            body.write(head)
+            for chunk in chunks:
+                scratch = Document()
+                style_ids = _docx_style_ids(scratch)
+                for row in chunk:
+                    if written:
+                        scratch.add_page_break()
+                    append_record_to_docx(scratch, row, style_ids)
+                    written += 1
+                _move_docx_images(scratch, zout, images)
+                body.write(_docx_body_fragment(scratch))
+                if progress:
+                    progress(written, total)
+            body.write(tail)
+            body.seek(0)
+            with zout.open("word/document.xml", "w", force_zip64=True) as target:
+                shutil.copyfileobj(body, target, UPLOAD_CHUNK_SIZE)
+        rels, types = _docx_package_index(parts, images)
+        zout.writestr("word/_rels/document.xml.rels", rels)
+        zout.writestr("[Content_Types].xml", types)
+    return written
+
+UPLOAD_PATH_RE = re.compile(r"[\w.:\\/-]*uploads[\\/]+[^\s()\[\]<>\"'\\/]+")
+
+def _unique_asset_arcname(assets: dict, name: str) -> str:
+    """assets/ 下不重名的包内路径；不同文件同名时加 _2、_3 后缀"""
+    taken = set(assets.values())
+    stem, ext = os.path.splitext(name)
+    arcname = f"assets/{name}"
+    suffix = 2
+    while arcname in taken:
+        arcname = f"assets/{stem}_{suffix}{ext}"
+        suffix += 1
+    return arcname
+
+def _bundle_asset(zout, assets: dict, path: str) -> str:
+    """附件按真实路径只写入一次 assets/，返回包内相对路径（旧版根目录与分片目录里的同名文件各存一份）"""
+    key = os.path.realpath(path)
+    arcname = assets.get(key)
+    if arcname is None:
+        name = os.path.basename(path)
+        arcname = _unique_asset_arcname(assets, name)
+        compress = zipfile.ZIP_STORED if os.path.splitext(name)[1].lower() in STORED_ASSET_EXTS else zipfile.ZIP_DEFLATED
+        zout.write(path, arcname, compress_type=compress)
+        assets[key] = arcname
+    return arcname
+
+def _bundle_inline_image(zout, assets: dict, mime: str, payload: str) -> str | None:
+    """内联 base64 图片落成独立文件；内容与已有附件相同时复用该附件"""
+    try:
+        data = base64.b64decode(payload)
+    except (ValueError, TypeError):
+        return None
+    digest = hashlib.sha256(data).hexdigest()
+    stored_name = _lookup_upload_by_digest(digest)
+    if stored_name:
+        stored_path = os.path.join(get_storage_paths()["upload_dir"], stored_name)
+        if os.path.isfile(stored_path):
+            return _bundle_asset(zout, assets, stored_path)
+    ext = next((e for e, m in IMAGE_MIME_MAP.items() if m == mime), ".bin")
+    key = f"inline:{digest}"
+    if key not in assets:
+        arcname = _unique_asset_arcname(assets, f"inline_{digest[:16]}{ext}")
+        zout.writestr(arcname, data, compress_type=zipfile.ZIP_STORED if ext in STORED_ASSET_EXTS else zipfile.ZIP_DEFLATED)
+        assets[key] = arcname
+    return assets[key]
+
+def _rewrite_markdown_assets(text: str, zout, assets: dict) -> str:
+    """把正文里的附件路径和内联图片改写为 assets/ 下的相对路径，并写入对应文件"""
+    def replace_image(match):
+        data_match = DATA_URI_RE.match(match.group(2))
+        if not data_match:
+            return match.group(0)
+        arcname = _bundle_inline_image(zout, assets, data_match.group(1), data_match.group(2))
+        return f"![{match.group(1)}]({arcname})" if arcname else match.group(0)
+
+    def replace_path(match):
+        target = match.group(0)
+        # `_原图已保存：path_` 的斜体结尾会被一并匹配到
+        for candidate in (target, target.rstrip("_")):
+            local = _resolve_local_upload(candidate)
+            if local:
+                return _bundle_asset(zout, assets, local) + target[len(candidate):]
+        return target
+
+    text = MARKDOWN_IMAGE_RE.sub(replace_image, text or "")
+    # 先整体改写链接目标（文件名可含空格与括号），剩下的裸路径再按正则匹配
+    pieces = []
+    last = 0
+    for start, end, target in iter_markdown_link_targets(text):
+        if not UPLOAD_TARGET_RE.search(target):
+            continue
+        local = _resolve_local_upload(target) or _resolve_local_upload(urllib.parse.unquote(target))
+        if not local:
+            continue
+        arcname = _bundle_asset(zout, assets, local)
+        if re.search(r"[\s()]", arcname) and text[start - 1:start] != "<":
+            arcname = f"<{arcname}>"
+        pieces.append(UPLOAD_PATH_RE.sub(replace_path, text[last:start]))
+        pieces.append(arcname)
+        last = end
+    pieces.append(UPLOAD_PATH_RE.sub(replace_path, text[last:]))
+    return "".join(pieces)
+
+def write_archive_zip(chunks, out, progress=None, total=None):
+    """
+    每条记录一个 Markdown 文件，引用的附件统一放进 assets/ 且只存一份，
+    链接改写为相对路径；压缩包边读边写。
+    """
+    written = 0
+    assets = {}
+    used_names = set()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for chunk in chunks:
+            for row in chunk:
+                row = dict(normalize_task_row(row))
+                base = sanitize_filename(f"{row.get('date', '')}_{row.get('task_name', 'record')}")
+                if base in used_names:
+                    base = f"{base}_{row.get('id', written)}"
+                used_names.add(base)
+                row["details"] = _rewrite_markdown_assets(row.get("details") or "", zout, assets)
+                zout.writestr(f"{base}.md", build_record_markdown(row))
+                written += 1
+            if progress:
+                progress(written, total)
+    return written
+
+ARCHIVE_EXPORT_FORMATS = {
+    "MD": (".md", "text/markdown", write_archive_markdown),
+    "DOCX": (".docx", DOCX_MIME, write_archive_docx),
+    "ZIP": (".zip", "application/zip", write_archive_zip),
+}
+
+def export_archive(fmt, q, p=(), progress=None, total=None):
+    """
+    按所选格式分批读取查询结果并写入临时文件（小文件留在内存，超过阈值落盘），
+    返回 (文件名, 已回到开头的文件对象, MIME)。
+    """
+    ext, mime, writer = ARCHIVE_EXPORT_FORMATS[fmt]
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        writer(iter_query_chunks(q, p, EXPORT_CHUNK_SIZE), out, progress, total)
+    except Exception:
+        out.close()
+        raise
+    out.seek(0)
+    return f"lab_archive_{datetime.now().strftime('%Y%m%d')}{ext}", out, mime
 
 def build_weekly_report_fallback(records, start_date, end_date):
     """无AI时的简单周报拼接"""
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lab_diary_optimized as lab  # noqa: E402
+
+
+@pytest.fixture
+def shard(tmp_path, monkeypatch):
+    """在临时目录里建一个空的本地分片（legacy 路径均为相对路径）"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("LAB_DIARY_USER_EMAIL", raising=False)
+    lab.init_and_migrate_db()
+    return lab.get_storage_paths()
@@ -0,0 +1,71 @@
+import os
+import time
+import zipfile
+from io import BytesIO
+
+import lab_diary_optimized as lab
+
+OLD_NAMES = ("photo (1).png", "my file.pdf")
+DETAILS = "![photo (1).png](uploads/photo (1).png)\n\n附件：[my file.pdf](uploads/my file.pdf)"
+
+
+def _write_old_upload(shard, name: str) -> str:
+    path = os.path.join(shard["upload_dir"], name)
+    with open(path, "wb") as fh:
+        fh.write(name.encode("utf-8"))
+    past = time.time() - 30 * 86400
+    os.utime(path, (past, past))
+    return path
+
+
+def test_link_targets_keep_spaces_and_parentheses():
+    targets = [target for _, _, target in lab.iter_markdown_link_targets(
+        '![a](uploads/photo (1).png) [b](<uploads/a b.png>) [c](uploads/c.png "标题")'
+    )]
+    assert targets == ["uploads/photo (1).png", "uploads/a b.png", "uploads/c.png"]
+    assert set(OLD_NAMES) <= lab.extract_asset_refs(DETAILS)
+
+
+def test_gc_keeps_referenced_uploads_with_spaces(shard):
+    paths = [_write_old_upload(shard, name) for name in OLD_NAMES]
+    orphan = _write_old_upload(shard, "unused file.txt")
+    lab.insert_task_record("2024-01-01", "旧记录", "科研", DETAILS, "")
+    result = lab.collect_orphaned_uploads(grace_days=1, dry_run=False)
+    assert all(os.path.exists(path) for path in paths)
+    assert not os.path.exists(orphan)
+    assert [item["name"] for item in result["orphans"]] == ["unused file.txt"]
+
+
+def test_zip_export_bundles_uploads_with_spaces(shard):
+    for name in OLD_NAMES:
+        _write_old_upload(shard, name)
+    out = BytesIO()
+    lab.write_archive_zip([[{"id": 1, "date": "2024-01-01", "task_name": "旧记录", "details": DETAILS}]], out)
+    with zipfile.ZipFile(out) as archive:
+        names = set(archive.namelist())
+        body = archive.read([n for n in names if n.endswith(".md")][0]).decode("utf-8")
+    assert {"assets/photo (1).png", "assets/my file.pdf"} <= names
+    assert "](<assets/photo (1).png>)" in body
+    assert "](<assets/my file.pdf>)" in body
+    assert "uploads/" not in body
+
+
+def test_zip_export_keeps_same_named_uploads_apart(shard, monkeypatch):
+    with open(os.path.join(shard["upload_dir"], "x.png"), "wb") as fh:
+        fh.write(b"legacy")
+    monkeypatch.setenv("LAB_DIARY_USER_EMAIL", "someone@example.com")
+    user_paths = lab.get_storage_paths()
+    user_file = os.path.join(user_paths["upload_dir"], "x.png")
+    with open(user_file, "wb") as fh:
+        fh.write(b"shard")
+    rows = [
+        {"id": 1, "date": "2024-01-01", "task_name": "旧", "details": "![a](uploads/x.png)"},
+        {"id": 2, "date": "2024-01-02", "task_name": "新", "details": f"![b]({user_file})"},
+    ]
+    out = BytesIO()
+    lab.write_archive_zip([rows], out)
+    with zipfile.ZipFile(out) as archive:
+        assert archive.read("assets/x.png") == b"legacy"
+        assert archive.read("assets/x_2.png") == b"shard"
+        assert "](assets/x.png)" in archive.read("2024-01-01_旧.md").decode("utf-8")
+        assert "](assets/x_2.png)" in archive.read("2024-01-02_新.md").decode("utf-8")
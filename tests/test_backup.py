@@ -0,0 +1,77 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import lab_diary_optimized as lab
+
+
+def _task_names(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in conn.execute("SELECT task_name FROM tasks ORDER BY id")]
+    finally:
+        conn.close()
+
+
+def _snapshot(shard):
+    day = datetime.now().strftime("%Y-%m-%d")
+    return lab.backup_database(shard["db_path"], os.path.join(shard["backup_dir"], f"lab_data_{day}.db"), pause=0)
+
+
+def test_point_in_time_restore_replays_unexported_changes(shard, tmp_path):
+    lab.insert_task_record("2024-01-01", "快照前", "科研", "", "")
+    _snapshot(shard)
+    lab.insert_task_record("2024-01-02", "快照后", "科研", "", "")
+
+    dest = str(tmp_path / "restored.db")
+    result = lab.restore_point_in_time(shard["backup_dir"], dest, live_db_path=shard["db_path"])
+
+    assert _task_names(dest) == ["快照前", "快照后"]
+    # 快照前的那条也还没导出过，一并写入增量文件，但回放时按快照水位跳过
+    assert result["flushed_changes"] == 2
+    assert result["applied_changes"] == 1
+    assert result["recovery_point"] > result["snapshot_taken_at"]
+
+
+def test_failed_backup_leaves_no_partial(shard, monkeypatch):
+    def interrupted(_seconds):
+        raise KeyboardInterrupt
+
+    lab.insert_task_record("2024-01-01", "a", "科研", "x" * 8192, "")
+    dest = os.path.join(shard["backup_dir"], "lab_data_2024-01-01.db")
+    with monkeypatch.context() as patch:
+        patch.setattr(lab.time, "sleep", interrupted)
+        try:
+            lab.backup_database(shard["db_path"], dest, pages=1, pause=1)
+        except KeyboardInterrupt:
+            pass
+        else:
+            raise AssertionError("expected the interrupted backup to raise")
+    assert not os.path.exists(dest + ".partial")
+    assert not os.path.exists(dest)
+
+
+def test_rotation_prunes_and_compresses_safety_copies(shard):
+    os.makedirs(shard["backup_dir"], exist_ok=True)
+    for n in range(5):
+        lab.backup_database(shard["db_path"], os.path.join(shard["backup_dir"], f"pre_restore_20240101_00000{n}.db"), pause=0)
+    lab.rotate_backups(shard["backup_dir"])
+    left = sorted(name for name in os.listdir(shard["backup_dir"]) if name.startswith("pre_restore_"))
+    assert left == [f"pre_restore_20240101_00000{n}.db.gz" for n in (2, 3, 4)]
+
+
+def test_failed_compression_leaves_no_partial(shard, monkeypatch):
+    def disk_full(*_args, **_kwargs):
+        raise OSError(28, "No space left on device")
+
+    path = os.path.join(shard["backup_dir"], "lab_data_2024-01-01.db")
+    lab.backup_database(shard["db_path"], path, pause=0)
+    with monkeypatch.context() as patch:
+        patch.setattr(lab.shutil, "copyfileobj", disk_full)
+        try:
+            lab.compress_backup(path, codec="gz")
+        except OSError:
+            pass
+        else:
+            raise AssertionError("expected the compression to fail")
+    assert os.listdir(shard["backup_dir"]) == ["lab_data_2024-01-01.db"]
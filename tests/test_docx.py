@@ -0,0 +1,57 @@
+import os
+from io import BytesIO
+
+from docx import Document
+from PIL import Image
+
+import lab_diary_optimized as lab
+
+
+def _png(color: str) -> BytesIO:
+    out = BytesIO()
+    Image.new("RGB", (16, 16), color).save(out, format="PNG")
+    out.seek(0)
+    return out
+
+
+def _sample_docx() -> BytesIO:
+    doc = Document()
+    doc.add_paragraph("实验步骤")
+    doc.add_picture(_png("red"))
+    table = doc.add_table(rows=2, cols=2)
+    for row, values in zip(table.rows, (("样品", "浓度"), ("A", "0.5 mM"))):
+        for cell, value in zip(row.cells, values):
+            cell.text = value
+    doc.add_paragraph("结果")
+    doc.add_picture(_png("red"))
+    doc.add_picture(_png("blue"))
+    out = BytesIO()
+    doc.save(out)
+    out.seek(0)
+    return out
+
+
+def test_docx_to_markdown_keeps_order_tables_and_images(shard):
+    markdown = lab.docx_to_markdown_with_assets(_sample_docx(), "记录.docx")
+    blocks = markdown.split("\n\n")
+    assert blocks[0] == "实验步骤"
+    table = "| 样品 | 浓度 |\n| --- | --- |\n| A | 0.5 mM |"
+    assert table in blocks
+    # 图片出现在所在段落之后：第一张在表格前，重复的那张与第二张在“结果”之后
+    first_image = next(i for i, block in enumerate(blocks) if "data:image/png;base64," in block)
+    assert first_image < blocks.index(table) < blocks.index("结果")
+    after = blocks[blocks.index("结果") + 1:]
+    # 同一张图第二次出现只引用附件路径，不再内联 base64
+    assert after[0].startswith("![") and "(uploads/" in after[0] and "base64" not in after[0]
+    assert os.path.isfile(after[0][after[0].index("(") + 1:-1])
+    assert sum("data:image/png;base64," in block for block in blocks) == 2
+    df = lab.run_query("SELECT COUNT(*) AS n FROM upload_assets", fetch=True)
+    assert df["n"][0] == 2
+
+
+def test_docx_to_markdown_text_only(shard):
+    markdown = lab.docx_to_markdown_with_assets(_sample_docx(), "记录.docx", with_images=False)
+    assert "![" not in markdown
+    assert "| A | 0.5 mM |" in markdown
+    df = lab.run_query("SELECT COUNT(*) AS n FROM upload_assets", fetch=True)
+    assert df["n"][0] == 0
@@ -0,0 +1,30 @@
+import pytest
+
+import lab_diary_optimized as lab
+
+GBK_SAMPLES = [
+    "37℃孵育 10μL",
+    "Incubate at 37°C … 5 μL ±0.1",
+    "PCR: 95℃ 30s … ×35",
+    "小鼠称重：25.3 g，给药 ①腹腔注射 → 观察",
+]
+
+
+@pytest.mark.parametrize("text", GBK_SAMPLES)
+def test_gbk_lab_notes_with_symbols(text):
+    data = text.encode("gbk")
+    assert lab.detect_text_encoding(data, complete=True) == "gb18030"
+    assert lab.decode_text_stream(data) == text
+
+
+@pytest.mark.parametrize("text, encoding", [
+    ("温度 37℃", "utf-8"),
+    ("温度 37℃", "utf-16"),
+    ("café crème brûlée", "latin-1"),
+])
+def test_other_encodings_round_trip(text, encoding):
+    assert lab.decode_text_stream(text.encode(encoding)) == text
+
+
+def test_pure_ascii_is_undecided():
+    assert lab.detect_text_encoding(b"plain ascii") is None
@@ -0,0 +1,44 @@
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import lab_diary_optimized as lab
+
+
+def _large_png() -> bytes:
+    # 随机噪声的 PNG 体积大，重新编码后明显变小
+    image = Image.frombytes("RGB", (600, 600), os.urandom(600 * 600 * 3))
+    out = BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("keep_originals", [True, False])
+def test_recompression_saving_accounts_for_kept_originals(shard, keep_originals):
+    data = _large_png()
+    stage = lab.new_image_import_stage(True)
+    stage.update(workers=1, min_bytes=0, keep_originals=keep_originals)
+    lab._persist_image_batch([("scan.png", lambda: BytesIO(data))], stage)
+
+    assert stage["recompressed"] == 1
+    saved = stage["original_bytes"] - stage["stored_bytes"]
+    if keep_originals:
+        # 原图也留在磁盘上：不是节省，而是净增加了压缩版的大小
+        assert saved < 0
+    else:
+        assert saved > 0
+    on_disk = sum(entry.stat().st_size for entry in os.scandir(shard["upload_dir"]) if entry.is_file())
+    assert stage["stored_bytes"] == on_disk
+
+
+def test_inline_image_cache_is_keyed_by_digest():
+    out = BytesIO()
+    Image.new("RGB", (8, 8), "green").save(out, format="WEBP")
+    payload = lab.base64.b64encode(out.getvalue()).decode("ascii")
+    first = lab._inline_png_for_docx(payload)
+    assert first.startswith(b"\x89PNG")
+    assert lab._inline_png_for_docx(payload) is first
+    assert payload not in lab._INLINE_PNG_CACHE
+    assert all(len(key) == 64 for key in lab._INLINE_PNG_CACHE)
@@ -0,0 +1,32 @@
+import zipfile
+from datetime import date
+from io import BytesIO
+
+import lab_diary_optimized as lab
+
+
+def _zip_with_corrupt_member() -> BytesIO:
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("good.md", "# 正常记录\n\n内容")
+        archive.writestr("bad.md", "# 损坏记录\n\nCORRUPTME")
+    data = bytearray(buf.getvalue())
+    pos = data.index(b"CORRUPTME")
+    data[pos:pos + 9] = b"XXXXXXXXX"
+    return BytesIO(bytes(data))
+
+
+def test_zip_import_isolates_corrupt_member(shard):
+    results = lab.import_legacy_zip_archive(
+        _zip_with_corrupt_member(),
+        default_category="科研",
+        default_tags="",
+        default_date=date(2024, 1, 1),
+        use_ai_metadata=False,
+    )
+    by_file = {item["file"]: item for item in results}
+    assert set(by_file) == {"good.md", "bad.md"}
+    assert by_file["good.md"]["success"] is True
+    assert by_file["bad.md"]["success"] is False
+    df = lab.run_query("SELECT COUNT(*) AS n FROM tasks", fetch=True)
+    assert df["n"][0] == 1
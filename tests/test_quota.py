@@ -0,0 +1,41 @@
+import os
+from io import BytesIO
+
+from PIL import Image
+
+import lab_diary_optimized as lab
+from test_writer import _docx_with_image
+
+
+def test_usage_sees_backups_written_outside_the_ledger(shard):
+    lab.reconcile_usage(shard)
+    assert lab.get_shard_usage(shard)["backup_bytes"] == 0
+    os.makedirs(shard["backup_dir"], exist_ok=True)
+    info = lab.backup_database(shard["db_path"], os.path.join(shard["backup_dir"], "lab_data_2024-01-01.db"))
+    assert lab.get_shard_usage(shard)["backup_bytes"] == info["bytes"]
+
+
+def test_pooled_conversion_reports_written_uploads(shard):
+    lab.reconcile_usage(shard)
+    # 文件数多于工作进程，每个工作进程都会连续转换好几个文件
+    colors = ("red", "blue", "green", "yellow", "purple", "orange")
+    docs = [(f"doc{i}.docx", ".docx", _docx_with_image(f"第{i}份", color)) for i, color in enumerate(colors)]
+    for name, outcome in lab.convert_documents_streaming(docs, workers=2, timeout=30):
+        assert not isinstance(outcome, Exception), f"{name}: {outcome!r}"
+    on_disk = lab.get_shard_storage_report(shard)
+    assert lab.get_shard_usage(shard)["upload_bytes"] == on_disk["upload_bytes"] + on_disk["preview_bytes"]
+    assert on_disk["upload_bytes"] > 0
+
+
+def test_concurrent_preview_is_counted_once(shard, monkeypatch):
+    lab.reconcile_usage(shard)
+    image = BytesIO()
+    Image.new("RGB", (64, 64), "red").save(image, format="PNG")
+    first = lab.ensure_image_preview(BytesIO(image.getvalue()), "same_key")
+    size = os.path.getsize(first)
+    # 模拟另一个会话在存在性检查之后才发现文件已被生成
+    real_exists = os.path.exists
+    with monkeypatch.context() as patch:
+        patch.setattr(os.path, "exists", lambda path: False if path == first else real_exists(path))
+        assert lab.ensure_image_preview(BytesIO(image.getvalue()), "same_key") == first
+    assert lab.get_shard_usage(shard)["upload_bytes"] == size
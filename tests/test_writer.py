@@ -0,0 +1,70 @@
+import time
+from io import BytesIO
+
+from docx import Document
+from PIL import Image
+
+import lab_diary_optimized as lab
+
+
+def _docx_with_image(text: str, color: str) -> BytesIO:
+    image = BytesIO()
+    Image.new("RGB", (32, 32), color).save(image, format="PNG")
+    image.seek(0)
+    doc = Document()
+    doc.add_paragraph(text)
+    doc.add_picture(image)
+    out = BytesIO()
+    doc.save(out)
+    out.seek(0)
+    return out
+
+
+def test_writes_from_sessions_are_committed(shard):
+    task_id = lab.insert_task_record("2024-01-01", "a", "科研", "d", "t")
+    lab.run_query("UPDATE tasks SET is_done=1 WHERE id=?", (task_id,))
+    df = lab.run_query("SELECT id, is_done FROM tasks", fetch=True)
+    assert df.values.tolist() == [[task_id, 1]]
+
+
+def test_failed_write_only_rolls_back_itself(shard):
+    try:
+        lab.run_query("INSERT INTO missing_table VALUES (1)")
+    except Exception:
+        pass
+    else:
+        raise AssertionError("expected the bad statement to raise")
+    assert lab.insert_task_record("2024-01-01", "b", "科研", "", "") > 0
+
+
+def test_pooled_conversion_after_write(shard):
+    # 写线程启动后再 fork 出转换进程：子进程不能继承父进程的写队列
+    lab.insert_task_record("2024-01-01", "before", "科研", "", "")
+    docs = [(f"doc{i}.docx", ".docx", _docx_with_image(f"第{i}份", color)) for i, color in enumerate(("red", "blue"))]
+    results = dict(lab.convert_documents_streaming(docs, workers=2, timeout=30))
+    for name, outcome in results.items():
+        assert not isinstance(outcome, Exception), f"{name}: {outcome!r}"
+        assert "uploads" in outcome["markdown"]
+    df = lab.run_query("SELECT COUNT(*) AS n FROM upload_assets", fetch=True)
+    assert df["n"][0] == 2
+
+
+def test_slow_files_time_out_without_failing_queued_ones(shard, monkeypatch):
+    real_convert = lab._convert_document_file
+
+    def convert(path, origin_name, ext, recompress):
+        if origin_name.startswith("slow"):
+            time.sleep(60)
+        return real_convert(path, origin_name, ext, recompress)
+
+    # 子进程由 fork 启动，会沿用这里替换后的函数
+    monkeypatch.setattr(lab, "_convert_document_file", convert)
+    names = ["slow0.docx", "slow1.docx", "fast0.docx", "fast1.docx", "fast2.docx"]
+    docs = [(name, ".docx", _docx_with_image(name, "red")) for name in names]
+    started = time.monotonic()
+    results = dict(lab.convert_documents_streaming(docs, workers=2, timeout=2))
+    assert time.monotonic() - started < 30
+    assert isinstance(results["slow0.docx"], TimeoutError)
+    assert isinstance(results["slow1.docx"], TimeoutError)
+    for name in ("fast0.docx", "fast1.docx", "fast2.docx"):
+        assert not isinstance(results[name], Exception), f"{name}: {results[name]!r}"